@@ -4,19 +4,64 @@ Twistd plugin to run Vellumbot
 
 from zope.interface import implements
 
-from twisted.python import usage
+from twisted.python import usage, log
 from twisted.plugin import IPlugin
 from twisted.application.service import IServiceMaker
 
-from vellumbot.user import userDatabase
+from vellumbot.user import (userDatabase, memoryDatabase, sqliteSettings,
+        SQLITE_PROFILES, DB_FILE_NAME, parseURI)
+from vellumbot.server import workqueue
 
 class Options(usage.Options):
     optParameters = [['port', 'p', '6667', 'Port to connect to'],
                      ['server', 's', 'irc.freenode.net', 'IRC server to connect to'],
                      ['serverEncoding', 'e', 'utf-8', 'The preferred encoding of the server we are connecting to'],
+                     ['parseCacheSize', None, '512', 'Number of parsed verb phrases and dice expressions to remember'],
+                     ['commitWindow', None, '0', 'Milliseconds that database changes may wait to be committed together with others (0 to commit every message); a crash loses at most this much'],
+                     ['commitBatch', None, '50', 'With commitWindow, commit as soon as this many messages are waiting'],
+                     ['sendInterval', None, '1000', 'Milliseconds between lines sent, after a burst (see sendBurst); set to suit the server\'s flood limit', int],
+                     ['sendBurst', None, '5', 'Lines that may be sent at once before sendInterval applies', int],
+                     ['lineSeparator', None, ' | ', 'Joins short replies to the same person or channel into one line; empty to send each on its own line'],
+                     ['userLimit', None, '10/0.5', 'What one user may ask of the bot: a burst of this many tokens, then this many a second (a line costs 1, a lookup 5)'],
+                     ['channelLimit', None, '30/2', 'What may be asked of the bot in one channel, as for userLimit'],
+                     ['workQueueSize', None, '20', 'Lines that may wait to be answered in one channel (or from one user, in private)', int],
+                     ['workBudget', None, '5', 'Lines answered at a time, before the bot goes back to reading and sending', int],
+                     ['workOverflow', None, 'newest', 'Which line to drop when a channel has too many waiting: newest or oldest'],
+                     ['backend', None, 'sqlite', 'Where users, aliases and sessions are kept: sqlite (in the database file) or memory (in RAM, loaded from and saved to the database file)'],
+                     ['snapshotInterval', None, '60', 'With the memory backend, seconds between saves to the database file', int],
+                     ['sqliteProfile', None, 'default', 'sqlite settings for the user database: %s' % (', '.join(sorted(SQLITE_PROFILES)),)],
+                     ['journalMode', None, None, 'sqlite journal_mode, overriding the profile (e.g. WAL, DELETE)'],
+                     ['synchronous', None, None, 'sqlite synchronous, overriding the profile (OFF, NORMAL, FULL)'],
+                     ['cacheSize', None, None, 'sqlite cache_size, overriding the profile (pages, or -KiB)', int],
+                     ['mmapSize', None, None, 'sqlite mmap_size in bytes, overriding the profile', int],
+                     ['busyTimeout', None, None, 'Milliseconds to wait for a locked database, overriding the profile', int],
+                     ['tempStore', None, None, 'sqlite temp_store, overriding the profile (DEFAULT, FILE, MEMORY)'],
                      ]
     optFlags = [['dev', None, 'Enable development features such as /sandbox']]
 
+    def postOptions(self):
+        for key in ('userLimit', 'channelLimit'):
+            try:
+                burst, rate = self[key].split('/')
+                self[key] = (int(burst), float(rate))
+            except ValueError:
+                raise usage.UsageError("%s must be burst/rate, not %r" % (
+                    key, self[key]))
+        if self['workOverflow'] not in workqueue.OVERFLOW_POLICIES:
+            raise usage.UsageError("No workOverflow policy %r" % (
+                self['workOverflow'],))
+        if self['backend'] not in ('sqlite', 'memory'):
+            raise usage.UsageError("No backend %r" % (self['backend'],))
+        if self['sqliteProfile'] not in SQLITE_PROFILES:
+            raise usage.UsageError("No sqlite profile %r" % (
+                self['sqliteProfile'],))
+        tuning = SQLITE_PROFILES[self['sqliteProfile']].copy()
+        for key in ('journalMode', 'synchronous', 'cacheSize', 'mmapSize',
+                'busyTimeout', 'tempStore'):
+            if self[key] is not None:
+                tuning[key] = self[key]
+        self['tuning'] = tuning
+
 
 class VellumbotServerMaker(object):
     """
@@ -42,11 +87,48 @@ class VellumbotServerMaker(object):
             except ImportError:
                 pass
         from vellumbot.server.irc import VellumTalkFactory
+        from vellumbot.server import linesyntax
+        linesyntax.verbPhraseCache.resize(int(options['parseCacheSize']))
+        linesyntax.diceCache.resize(int(options['parseCacheSize']))
         from twisted.application.internet import TCPClient
+        from twisted.application.service import MultiService
+        from vellumbot.server.database import Database
         f = VellumTalkFactory('#vellum')
-        f.store = userDatabase()
         f.serverEncoding = options['serverEncoding']
-        svc = TCPClient(options['server'], int(options['port']), f)
+        f.sendInterval = options['sendInterval'] / 1000.0
+        f.sendBurst = options['sendBurst']
+        f.lineSeparator = options['lineSeparator'] or None
+        f.userLimit = options['userLimit']
+        f.channelLimit = options['channelLimit']
+        f.workQueueSize = options['workQueueSize']
+        f.workBudget = options['workBudget']
+        f.workOverflow = options['workOverflow']
+        svc = MultiService()
+        if options['backend'] == 'memory':
+            # nothing waits on the disk, but snapshots copy the store in
+            # the database thread, away from the reactor
+            f.database = Database(memoryDatabase)
+            f.database.setServiceParent(svc)
+            from vellumbot.server.snapshot import Snapshots
+            Snapshots(f.database, parseURI(DB_FILE_NAME)[0],
+                    options['snapshotInterval']).setServiceParent(svc)
+        else:
+            # the store is opened in the database thread, as the service
+            # starts
+            def openStore():
+                store = userDatabase(tuning=options['tuning'])
+                log.msg("User database (%s profile): %s" % (
+                    options['sqliteProfile'], sqliteSettings(store)))
+                return store
+            f.database = Database(openStore)
+            f.database.setServiceParent(svc)
+        window = int(options['commitWindow'])
+        if window > 0:
+            from vellumbot.server.writebehind import GroupCommit
+            GroupCommit(f.database, window / 1000.0,
+                    int(options['commitBatch'])).setServiceParent(svc)
+        TCPClient(options['server'], int(options['port']), f
+                ).setServiceParent(svc)
         return svc
 
 # Now construct an object which *provides* the relevant interfaces
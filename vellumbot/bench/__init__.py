@@ -0,0 +1 @@
+"""Benchmarks for vellumbot's hot paths, run by hand from a source checkout."""
@@ -0,0 +1,84 @@
+"""
+Benchmark rolling dice expressions: walking the parse tree with dice.roll,
+the compiled DiceProgram one die at a time, and the bulk engine.
+
+    python -m vellumbot.bench.dicebench
+"""
+import sys
+import timeit
+
+from twisted.python import usage
+
+from playtools import dice
+
+from vellumbot.server import linesyntax, bulkdice, diceprogram
+
+EXPRESSIONS = ['1d20+5', '3d6', '1d20+3x50', '20d6', '100d4', '10000d6']
+
+
+def timeRoll(roll, repeat):
+    """
+    Milliseconds per call of roll(), best of 3
+    """
+    return min(timeit.repeat(roll, number=repeat, repeat=3)) / repeat * 1e3
+
+
+def measure(expression, repeat):
+    """
+    Return (interpreted, one at a time, bulk) milliseconds per roll of
+    expression
+    """
+    parsed = linesyntax.parseDice(expression)
+    interpreted = lambda: list(dice.roll(parsed, 0))
+
+    threshold = bulkdice.BULK_THRESHOLD
+    try:
+        bulkdice.BULK_THRESHOLD = sys.maxint
+        single = diceprogram.compileRoll(parsed)
+        bulkdice.BULK_THRESHOLD = 0
+        bulk = diceprogram.compileRoll(parsed)
+    finally:
+        bulkdice.BULK_THRESHOLD = threshold
+
+    ret = [timeRoll(interpreted, repeat)]
+    for roll in single, bulk:
+        if roll is None:
+            ret.append(None)
+        else:
+            ret.append(timeRoll(roll, repeat))
+    return ret
+
+
+class Options(usage.Options):
+    optParameters = [['repeat', 'n', '20', 'Rolls to time for each expression'],
+                     ]
+
+    def parseArgs(self, *expressions):
+        self['expressions'] = expressions or EXPRESSIONS
+
+
+def run(argv=None):
+    if argv is None:
+        argv = sys.argv
+    o = Options()
+    try:
+        o.parseOptions(argv[1:])
+    except usage.UsageError, e:
+        print str(o)
+        print str(e)
+        return 1
+
+    if bulkdice.nrandom is None:
+        print 'bulk engine: pure Python (NumPy is not installed)'
+    else:
+        print 'bulk engine: NumPy'
+    print '%-12s %14s %14s %14s' % ('ms/roll', 'dice.roll', 'one at a time',
+            'bulk')
+    fmt = lambda ms: ms is None and '(not compiled)' or '%.4f' % (ms,)
+    for expression in o['expressions']:
+        times = measure(expression, int(o['repeat']))
+        print '%-12s %14s %14s %14s' % ((expression,) + tuple(map(fmt, times)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(run())
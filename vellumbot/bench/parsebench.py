@@ -0,0 +1,183 @@
+"""
+Benchmark the linesyntax parsers against a recorded IRC corpus.
+
+Every line of the corpus is timed through parseSentence, and the lines that
+contain them through parseCommand, parseVerbPhrase and parseDice.  Results are
+reported per category of line as lines/sec, p50 and p99.
+
+    python -m vellumbot.bench.parsebench --save baseline.json
+    (change the parser)
+    python -m vellumbot.bench.parsebench --baseline baseline.json
+
+Comparing against a baseline exits with status 1 if any measurement got
+slower by more than the tolerance.
+"""
+import os
+import sys
+import json
+import timeit
+
+from twisted.python import usage
+
+from simpleparse.error import ParserSyntaxError
+
+from vellumbot.server import linesyntax
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'corpus.txt')
+
+
+def readCorpus(filename=CORPUS):
+    """
+    Return a list of (category, line) from the corpus file
+    """
+    ret = []
+    for line in open(filename):
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+        category, message = line.split('\t', 1)
+        ret.append((category, message.decode('utf-8')))
+    return ret
+
+
+def percentile(samples, p):
+    """
+    The p-th percentile of samples, which must be sorted
+    """
+    n = int(round(p / 100.0 * (len(samples) - 1)))
+    return samples[n]
+
+
+def timeCall(f, arg, repeat):
+    """
+    Seconds per call of f(arg), averaged over repeat calls.  Parse errors
+    are expected for some lines and count as work done.
+    """
+    timer = timeit.default_timer
+    start = timer()
+    for n in xrange(repeat):
+        try:
+            f(arg)
+        except (RuntimeError, ParserSyntaxError):
+            pass
+    return (timer() - start) / repeat
+
+
+def _cold(f):
+    """
+    Wrap f so the parse caches are empty every time it is called
+    """
+    def cold(arg):
+        linesyntax.verbPhraseCache.clear()
+        linesyntax.diceCache.clear()
+        return f(arg)
+    return cold
+
+
+def workload(corpus):
+    """
+    Return a list of (function name, category, argument) to be timed
+    """
+    ret = []
+    for category, line in corpus:
+        ret.append(('parseSentence', category, line))
+        if linesyntax.commandLeader.match(line):
+            ret.append(('parseCommand', category, line))
+        for vc in linesyntax.scanSentence(line)[1]:
+            ret.append(('parseVerbPhrase', category, vc))
+            try:
+                vp = linesyntax.parseVerbPhrase(vc)
+            except (RuntimeError, ParserSyntaxError):
+                continue
+            if vp.diceExpression is not None:
+                ret.append(('parseDice', category,
+                    vp.diceExpression.format()))
+    return ret
+
+
+def measure(corpus, repeat=200, cold=False):
+    """
+    Return {'function/category': {'lines/sec':, 'p50':, 'p99':, 'count':}}
+    with p50 and p99 in microseconds per call
+    """
+    samples = {}
+    for name, category, arg in workload(corpus):
+        f = getattr(linesyntax, name)
+        if cold:
+            f = _cold(f)
+        samples.setdefault('%s/%s' % (name, category), []).append(
+                timeCall(f, arg, repeat))
+
+    results = {}
+    for key, times in samples.items():
+        times.sort()
+        results[key] = {'lines/sec': len(times) / sum(times),
+                        'p50': percentile(times, 50) * 1e6,
+                        'p99': percentile(times, 99) * 1e6,
+                        'count': len(times),
+                        }
+    return results
+
+
+def report(results, baseline=None, tolerance=0.2):
+    """
+    Print the results, comparing them with baseline if given.  Return the
+    keys that regressed.
+    """
+    regressed = []
+    print '%-34s %6s %12s %10s %10s' % ('', 'lines', 'lines/sec', 'p50 us',
+            'p99 us')
+    for key in sorted(results):
+        r = results[key]
+        note = ''
+        if baseline is not None and key in baseline:
+            was = baseline[key]['lines/sec']
+            change = (r['lines/sec'] - was) / was
+            note = '%+.0f%%' % (change * 100,)
+            if change < -tolerance:
+                note = note + ' REGRESSION'
+                regressed.append(key)
+        print '%-34s %6d %12.0f %10.1f %10.1f  %s' % (key, r['count'],
+                r['lines/sec'], r['p50'], r['p99'], note)
+    return regressed
+
+
+class Options(usage.Options):
+    optParameters = [['corpus', 'c', CORPUS, 'Corpus of categorized lines'],
+                     ['repeat', 'n', '200', 'Calls to time for each line'],
+                     ['save', 's', None, 'Save the results as a baseline file'],
+                     ['baseline', 'b', None, 'Compare with a saved baseline file'],
+                     ['tolerance', 't', '0.2', 'Slowdown (as a fraction) that counts as a regression'],
+                     ]
+    optFlags = [['cold', None, 'Empty the parse caches before every call']]
+
+
+def run(argv=None):
+    if argv is None:
+        argv = sys.argv
+    o = Options()
+    try:
+        o.parseOptions(argv[1:])
+    except usage.UsageError, e:
+        print str(o)
+        print str(e)
+        return 1
+
+    results = measure(readCorpus(o['corpus']), int(o['repeat']), o['cold'])
+
+    baseline = None
+    if o['baseline']:
+        baseline = json.load(open(o['baseline']))
+    regressed = report(results, baseline, float(o['tolerance']))
+
+    if o['save']:
+        json.dump(results, open(o['save'], 'w'), indent=1, sort_keys=True)
+
+    if regressed:
+        print '** %s measurements regressed' % (len(regressed),)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -0,0 +1,104 @@
+"""
+Benchmark the user database under each sqlite settings profile.
+
+Every profile gets a fresh database file, and a run of units of work like
+the ones a busy channel makes: a user rolls a dice expression, which sets
+one of their aliases, and the unit is committed.  Results are units/sec,
+p50 and p99 milliseconds per unit.
+
+    python -m vellumbot.bench.storebench
+    python -m vellumbot.bench.storebench --units 2000 safe fast
+"""
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import timeit
+
+from twisted.python import usage
+
+from vellumbot import user
+from vellumbot.usersql import SQL_SCRIPT
+from vellumbot.bench.parsebench import percentile
+
+
+def makeDatabase(directory, profile):
+    """
+    A new user database file in directory, opened with the settings of
+    profile
+    """
+    filename = os.path.join(directory, '%s.db' % (profile,))
+    connection = sqlite3.connect(filename)
+    for sql in SQL_SCRIPT:
+        connection.execute(sql)
+    connection.commit()
+    connection.close()
+    return user.userDatabase('sqlite:' + filename,
+            user.SQLITE_PROFILES[profile])
+
+
+def measure(store, units, players=6):
+    """
+    Return the sorted seconds taken by each of units units of work
+    """
+    users = []
+    for n in range(players):
+        u = user.User()
+        u.name = u'Player%s' % (n,)
+        store.add(u)
+        users.append(u)
+    store.commit()
+
+    timer = timeit.default_timer
+    times = []
+    for n in xrange(units):
+        u = users[n % players]
+        start = timer()
+        user.unitOfWork(store, u.setAlias, (u'attack', u'%s' % (n % 20,)),
+                u'1d20+%s' % (n % 7,))
+        times.append(timer() - start)
+    times.sort()
+    return times
+
+
+class Options(usage.Options):
+    optParameters = [['units', 'n', '500', 'Units of work for each profile'],
+                     ]
+
+    def parseArgs(self, *profiles):
+        for profile in profiles:
+            if profile not in user.SQLITE_PROFILES:
+                raise usage.UsageError("No sqlite profile %r" % (profile,))
+        self['profiles'] = profiles or sorted(user.SQLITE_PROFILES)
+
+
+def run(argv=None):
+    if argv is None:
+        argv = sys.argv
+    o = Options()
+    try:
+        o.parseOptions(argv[1:])
+    except usage.UsageError, e:
+        print str(o)
+        print str(e)
+        return 1
+
+    directory = tempfile.mkdtemp()
+    try:
+        print '%-10s %12s %10s %10s  %s' % ('profile', 'units/sec', 'p50 ms',
+                'p99 ms', 'settings')
+        for profile in o['profiles']:
+            store = makeDatabase(directory, profile)
+            settings = user.sqliteSettings(store)
+            times = measure(store, int(o['units']))
+            store.close()
+            print '%-10s %12.1f %10.3f %10.3f  %s' % (profile,
+                    len(times) / sum(times), percentile(times, 50) * 1e3,
+                    percentile(times, 99) * 1e3, settings)
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(run())
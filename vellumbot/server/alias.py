@@ -3,23 +3,81 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle
+import time
+import weakref
 
-from playtools import dice
-from playtools.parser import diceparser
+from twisted.python import log
 
-_alias_hooks = {}
+from . import diceprogram
 
-def registerAliasHook(alias, hook):
-    """Register a handler for a particular alias.  Handlers must
-    take two arguments, username and evaluated result.
+class _WeakMethod(object):
+    """
+    A bound method that doesn't keep its object alive.  Calling it returns
+    the bound method, or None if the object is gone.
+    """
+    def __init__(self, method):
+        self.obj = weakref.ref(method.im_self)
+        self.func = method.im_func
+
+    def __call__(self):
+        obj = self.obj()
+        if obj is None:
+            return None
+        return self.func.__get__(obj, type(obj))
+
+
+class AliasHooks(object):
+    """
+    Handlers for particular aliases, called after the alias is rolled.
+    Handlers must take two arguments, the user and the evaluated result.
 
-    # def rememberInitiative(user, initroll):
-    # ....iniatives.append((initroll, user))
-    # >>> addAliasHook(('init',), rememberInitiative)
+    Bound methods are held by weak reference, so registering one doesn't
+    keep its object alive; it is dropped once the object is gone.  Other
+    callables are held normally.
 
-    Now rememberInitiative will get called any time someone uses "[init ..]"
+    Every call is timed: timings maps (alias, handler name) to [calls,
+    seconds], and calls slower than slowHook seconds are logged.
     """
-    _alias_hooks.setdefault(alias, []).append(hook)
+    slowHook = 0.05
+
+    def __init__(self):
+        self._hooks = {}
+        self.timings = {}
+
+    def register(self, alias, hook):
+        """
+        Call hook any time someone rolls alias, a tuple of words
+        """
+        if getattr(hook, 'im_self', None) is not None:
+            ref = _WeakMethod(hook)
+        else:
+            ref = lambda: hook
+        self._hooks.setdefault(alias, []).append(ref)
+
+    def call(self, alias, user, rolled):
+        """
+        Call the handlers for alias, if any
+        """
+        refs = self._hooks.get(alias, None)
+        if not refs:
+            return
+        for ref in refs[:]:
+            hook = ref()
+            if hook is None:
+                refs.remove(ref)
+                continue
+            start = time.time()
+            hook(user, rolled)
+            elapsed = time.time() - start
+
+            name = getattr(hook, '__name__', repr(hook))
+            timing = self.timings.setdefault((alias, name), [0, 0.0])
+            timing[0] = timing[0] + 1
+            timing[1] = timing[1] + elapsed
+            if elapsed > self.slowHook:
+                log.msg("Slow alias hook %s for %r took %.3fs" % (name,
+                    alias, elapsed))
+
 
 def shortFormatAliases(user):
     """
@@ -35,52 +93,54 @@ def shortFormatAliases(user):
         formatted_aliases.append('%s=%s' % (key, value))
     return ', '.join(formatted_aliases)
 
-def resolve(actor, words, parsed_dice=None, temp_modifier=0, target=None):
+def resolve(actor, words, parsed_dice=None, temp_modifier=0, target=None,
+        hooks=None):
     """
     If there is a known alias or a dice expression in there, return the
     message result from processing it.
 
     If neither a known alias nor a dice expression, return None.
     """
-    rolled = getResult(actor, words, parsed_dice, temp_modifier, target=target)
+    rolled = getResult(actor, words, parsed_dice, temp_modifier, target=target,
+            hooks=hooks)
     if rolled is None:
         return None
     else:
         return formatAlias(actor.name, words, rolled, parsed_dice, temp_modifier)
 
-def callAliasHooks(words, user, rolled):
+def callAliasHooks(words, user, rolled, hooks=None):
     """
-    After rolling an alias, do the hooks
+    After rolling an alias, do the hooks in hooks (an AliasHooks, usually
+    the session's the roll was made in), if given
     """
-    hooks = _alias_hooks.get(words, [])
-    for hook in hooks:
-        hook(user, rolled)
+    if hooks is not None:
+        hooks.call(words, user, rolled)
 
-def getResult(actor, words, parsed_dice=None, temp_modifier=0, target=None):
+def getResult(actor, words, parsed_dice=None, temp_modifier=0, target=None,
+        hooks=None):
     """
     Return a list of dice result
     """
     # targets - TODO
-    parse = diceparser.parseDice
     unparse = lambda x: x.format()
 
     # verb phrases with dice expressions set a new expression
     if parsed_dice is not None:
         if words:
             actor.setAlias(words, unparse(parsed_dice))
+        program = diceprogram.programFor(parsed_dice)
     else: # without dice expression, look it up or regard it as empty
-        _dict = actor.getAliases()
-        looked_up = _dict.get(' '.join(words), None)
+        looked_up = actor.getAlias(words)
         if looked_up is None:
-            parsed_dice = None
+            program = None
         else:
-            parsed_dice = parse(looked_up)
+            program = diceprogram.compileDice(looked_up)
 
-    if parsed_dice is None:
+    if program is None:
         rolled = None
     else:
-        rolled = list(dice.roll(parsed_dice, temp_modifier))
-    callAliasHooks(words, actor, rolled)
+        rolled = program.roll(temp_modifier)
+    callAliasHooks(words, actor, rolled, hooks)
     return rolled
 
 def formatAlias(actor, verbs, results, parsed_dice, temp_modifier=0, target=None):
@@ -0,0 +1,55 @@
+"""
+Rolling a lot of dice at once.
+
+[fireball 20d6], [swarm 100d4] or a GM's 1d20+3x50 are drawn in one batch
+rather than one die at a time.  NumPy is used to draw and reduce the batch if
+it is installed; otherwise a pure Python version is used.
+"""
+import random
+
+try:
+    from numpy import random as nrandom
+except ImportError:
+    nrandom = None
+
+# fewer dice than this are rolled faster one at a time than in a batch
+BULK_THRESHOLD = 16
+
+
+def _rollPython(count, size, repeat):
+    rand = random.random
+    counts = xrange(count)
+    return [[int(rand() * size) + 1 for n in counts] for r in xrange(repeat)]
+
+
+def _rollNumpy(count, size, repeat):
+    return nrandom.randint(1, size + 1, (repeat, count)).tolist()
+
+
+def _sumsPython(count, size, repeat):
+    return [sum(rolls) for rolls in _rollPython(count, size, repeat)]
+
+
+def _sumsNumpy(count, size, repeat):
+    return nrandom.randint(1, size + 1, (repeat, count)).sum(axis=1).tolist()
+
+
+if nrandom is None:
+    _roll, _sums = _rollPython, _sumsPython
+else:
+    _roll, _sums = _rollNumpy, _sumsNumpy
+
+
+def rollBulk(count, size, repeat=1):
+    """
+    Roll count dice of the given size, repeat times.  Return a list of repeat
+    lists of count ints each.
+    """
+    return _roll(count, size, repeat)
+
+
+def rollSums(count, size, repeat=1):
+    """
+    Like rollBulk, but return only the total of each repeat
+    """
+    return _sums(count, size, repeat)
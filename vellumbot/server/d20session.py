@@ -2,7 +2,7 @@
 
 import bisect
 
-from vellumbot.server import alias, session, reference
+from vellumbot.server import session, reference
 
 
 class InitRoll(object):
@@ -26,7 +26,7 @@ class D20Session(session.Session):
     def __init__(self, isDefaultSession=False):
         session.Session.__init__(self, isDefaultSession)
         self.initiatives = SortedRing()
-        alias.registerAliasHook(('init',), self.doInitiative)
+        self.aliasHooks.register(('init',), self.doInitiative)
 
     __storm_loaded__ = __init__  
 
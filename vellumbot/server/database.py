@@ -0,0 +1,116 @@
+"""
+The thread the bot's database work is done in.
+
+A Storm store belongs to the thread that uses it, and a query that waits on
+a lock or a slow disk stops that thread.  So all of the bot's work with the
+store (and with sessions and users, which are Storm objects) is done by one
+worker thread, a unit of work at a time and in the order it was asked for,
+while the reactor thread goes on talking to the irc server.
+"""
+import threading
+
+from twisted.application import service
+from twisted.internet import defer, threads
+from twisted.python import threadpool, failure
+
+from vellumbot.user import unitOfWork
+
+
+class Stopped(Exception):
+    """
+    The database thread isn't running, so the work was refused
+    """
+
+
+class Database(service.Service):
+    """
+    Run functions on a store, returning Deferreds.
+
+    open is called to make the store.  sqlite connections only work in the
+    thread that made them, so when threaded, the store is opened in the
+    database thread as the service starts, and can't be used before that.
+
+    With threaded=False the store is opened at once, and everything is
+    done immediately in the calling thread, as the tests (and a bot without
+    a running service) want.  Otherwise work asked for before the service
+    starts, or once it is stopping, fails with Stopped.
+    """
+    def __init__(self, open, threaded=True, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.open = open
+        self.threaded = threaded
+        self.reactor = reactor
+        self.pool = None
+        self.store = None
+        if not threaded:
+            self.store = open()
+
+    def startService(self):
+        service.Service.startService(self)
+        if self.threaded:
+            self.pool = threadpool.ThreadPool(1, 1, 'vellumbot-database')
+            self.pool.start()
+            self.store = self._blockingCall(self.open)
+
+    def _blockingCall(self, f):
+        """
+        Call f in the database thread, and wait for it
+        """
+        done = threading.Event()
+        result = []
+        def call():
+            try:
+                result.append((True, f()))
+            except:
+                result.append((False, failure.Failure()))
+            done.set()
+        self.pool.callInThread(call)
+        done.wait()
+        ok, value = result[0]
+        if not ok:
+            value.raiseException()
+        return value
+
+    def stopService(self):
+        """
+        Finish the work already asked for, then stop the thread
+        """
+        service.Service.stopService(self)
+        if self.pool is None:
+            return
+        # the work asked for from now on is refused, so this is the last
+        d = threads.deferToThreadPool(self.reactor, self.pool, lambda: None)
+        def stop(result):
+            self.pool.stop()
+            self.pool = None
+            return result
+        return d.addBoth(stop)
+
+    def call(self, f, *a, **kw):
+        """
+        Call f(*a, **kw) in the database thread, and return a Deferred that
+        fires with its result
+        """
+        if not self.threaded:
+            return defer.maybeDeferred(f, *a, **kw)
+        if self.pool is None or not self.running:
+            return defer.fail(Stopped())
+        return threads.deferToThreadPool(self.reactor, self.pool, f, *a, **kw)
+
+    def run(self, f, *a, **kw):
+        """
+        Call f(*a, **kw) in the database thread as one unit of work (see
+        vellumbot.user.unitOfWork)
+        """
+        return self.call(unitOfWork, self.store, f, *a, **kw)
+
+    def toReactor(self, f, *a, **kw):
+        """
+        Call f(*a, **kw) in the reactor thread: database work uses this to
+        hand over what it found
+        """
+        if not self.threaded:
+            f(*a, **kw)
+        else:
+            self.reactor.callFromThread(f, *a, **kw)
@@ -0,0 +1,133 @@
+"""
+Dice expressions compiled for rolling.
+
+A DiceProgram does all the work that doesn't depend on the dice ahead of
+time, so rolling it is a few calls to the random number generator and some
+arithmetic.  Programs are interned: everyone who rolls "1d20+2" shares one.
+"""
+import random
+
+from playtools import dice
+
+from . import linesyntax, bulkdice
+from ..util import lru
+
+
+class DiceProgram(object):
+    """
+    A parsed dice expression, and the fastest way we know to roll it
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        self.text = expression.format()
+        self.sort = expression.sort
+        self.roll = compileRoll(expression) or self._interpret
+
+    def __repr__(self):
+        return '<DiceProgram %s>' % (self.text,)
+
+    def _interpret(self, temp_modifier=0):
+        """
+        Roll by walking the parsed expression
+        """
+        return list(dice.roll(self.expression, temp_modifier))
+
+
+def _renderings(count, size, modifier, repeat, sort):
+    """
+    The ways playtools could write out an expression with these parts
+    """
+    cores = ['%sd%s' % (count, size)]
+    if count == 1:
+        cores.append('d%s' % (size,))
+    rest = []
+    if modifier:
+        rest.append('%+d' % (modifier,))
+    if repeat != 1:
+        rest.append('x%s' % (repeat,))
+    if sort:
+        rest.append('sort')
+    rest = ''.join(rest)
+    return [core + rest for core in cores]
+
+
+def plainParts(expression):
+    """
+    Return (count, dieSize, modifier, repeat) for a plain NdS+M xR
+    expression, or None for anything else (constants, filters).
+
+    To be sure the parts were read correctly, they must write out the same
+    text that the expression does.
+    """
+    count = getattr(expression, 'count', None)
+    size = getattr(expression, 'dieSize', None)
+    modifier = getattr(expression, 'dieModifier', None) or 0
+    repeat = getattr(expression, 'repeat', None) or 1
+    for n in (count, size, modifier, repeat):
+        if type(n) not in (int, long):
+            return None
+    if count < 1 or size < 1 or getattr(expression, 'filterCount', None):
+        return None
+    if not set([str(expression), expression.format()]) & set(
+            _renderings(count, size, modifier, repeat, expression.sort)):
+        return None
+    return count, size, modifier, repeat
+
+
+def compileRoll(expression):
+    """
+    Return a function of temp_modifier that rolls expression the same way
+    dice.roll does, or None if the expression can't be compiled.
+
+    Large pools are drawn in one batch by bulkdice.  Only plain expressions
+    (see plainParts) are compiled; anything else is left to dice.roll.
+    """
+    parts = plainParts(expression)
+    if parts is None:
+        return None
+    count, size, modifier, repeat = parts
+
+    DiceResult = dice.DiceResult
+
+    if count * repeat >= bulkdice.BULK_THRESHOLD:
+        rollBulk = bulkdice.rollBulk
+
+        def roll(temp_modifier=0):
+            return [DiceResult(rolls, modifier, temp_modifier) for rolls in
+                    rollBulk(count, size, repeat)]
+        return roll
+
+    rand = random.random
+    counts = xrange(count)
+    repeats = xrange(repeat)
+
+    def roll(temp_modifier=0):
+        return [DiceResult([int(rand() * size) + 1 for n in counts],
+                           modifier, temp_modifier) for r in repeats]
+    return roll
+
+
+# the interned programs, keyed on expression text
+programs = lru.LRUCache(1024)
+
+def compileDice(text):
+    """
+    The shared DiceProgram for the expression in text
+    """
+    program = programs.get(text, None)
+    if program is None:
+        program = programFor(linesyntax.parseDice(text))
+        programs[text] = program
+    return program
+
+
+def programFor(expression):
+    """
+    The shared DiceProgram for an already parsed expression
+    """
+    text = expression.format()
+    program = programs.get(text, None)
+    if program is None:
+        program = DiceProgram(expression)
+        programs[text] = program
+    return program
@@ -3,30 +3,66 @@ Vellum's face.  The bot that answers actions in the channel.
 """
 # twisted imports
 from twisted.words.protocols import irc
-from twisted.internet import reactor, protocol, task
+from twisted.internet import reactor, protocol, task, defer
 from twisted.python import log
 
-import textwrap
+import re
+import time
 
-from storm.locals import Store
-
-from vellumbot.server import linesyntax, d20session
+from vellumbot.server import (linesyntax, session, d20session, outbound,
+        ratelimit, workqueue)
+from vellumbot.server.database import Database
 
 from simpleparse.error import ParserSyntaxError
 
 
-MAX_LINE = 420
+# the most an irc line may hold, not counting the CRLF.  The server relays
+# a PRIVMSG with the sender's nick!user@host in front, and that counts too.
+MAX_LINE = 510
+# the smallest piece a long line is split into, however long the prefix
+MIN_LINE = 100
+# until the server says, assume the longest user@host it allows
+UNKNOWN_USERHOST = '%s@%s' % ('u' * 10, 'h' * 63)
 
 
 def splitTextIRCWise(s, width):
     """
-    Split s into lines, and for each line longer than width, split it into
-    (at most) width-long segments.  Attempt to word break the line.
+    Split the byte string s into lines, and each line longer than width
+    bytes into pieces of at most width bytes, breaking between words where
+    possible.  Words longer than width are broken where they must, but never
+    inside a UTF-8 character.  Blank lines are dropped.
     """
-    lines = s.splitlines()
     ret = []
-    for line in lines:
-        ret.extend(textwrap.wrap(line, width))
+    for line in s.splitlines():
+        line = line.rstrip()
+        pos = 0
+        while len(line) - pos > width:
+            end = pos + width
+            if line[end] == ' ':
+                cut = end
+            else:
+                cut = line.rfind(' ', pos, end)
+            if cut > pos:
+                nextSpace = line.find(' ', cut + 1)
+                if nextSpace == -1:
+                    nextSpace = len(line)
+                if nextSpace - cut - 1 <= width:
+                    # the next word fits on a line of its own
+                    ret.append(line[pos:cut].rstrip())
+                    pos = cut + 1
+                    while line[pos:pos + 1] == ' ':
+                        pos = pos + 1
+                    continue
+            # fill the line with as much of a long word as fits, backing up
+            # over UTF-8 continuation bytes to the start of a character
+            cut = end
+            while (cut > max(end - 3, pos + 1) and
+                    '\x80' <= line[cut] <= '\xbf'):
+                cut = cut - 1
+            ret.append(line[pos:cut])
+            pos = cut
+        if pos < len(line):
+            ret.append(line[pos:])
     return ret
 
 
@@ -49,6 +85,204 @@ class Request(object):
         self.recipients = recipients
 
 
+def transactional(method):
+    """
+    Decorate a VellumTalk callback so that it runs in the database thread
+    as one unit of work: committed once when it is done, or rolled back if
+    it fails.  The callback returns a Deferred, which fails if it does (see
+    logFailures for callbacks nobody waits for).
+
+    Membership events still waiting in a MembershipBatch are applied first.
+    """
+    def callback(self, *a, **kw):
+        if self.database is None:
+            return defer.maybeDeferred(method, self, *a, **kw)
+        if self.membership.events:
+            self.membership.flush()
+        return self.database.run(method, self, *a, **kw)
+    callback.__name__ = method.__name__
+    callback.__doc__ = method.__doc__
+    return callback
+
+
+def logFailures(method):
+    """
+    Decorate a VellumTalk callback returning a Deferred that nobody waits
+    for, as IRCClient's are, so that its failures are logged
+    """
+    def callback(self, *a, **kw):
+        d = method(self, *a, **kw)
+        d.addErrback(log.err, "Error in %s" % (method.__name__,))
+        return d
+    callback.__name__ = method.__name__
+    callback.__doc__ = method.__doc__
+    return callback
+
+
+class MembershipBatch(object):
+    """
+    Other people's joins, parts, quits and renames all pass through here on
+    the way to the database thread.  Normally each is sent on at once.
+
+    Those that arrive in a burst (a netsplit, or the network healing
+    afterwards) are queued instead, and applied once per reactor tick: one
+    removeNick and addNick per session, instead of a round trip to the
+    database for every event.
+
+    A quit message naming two servers starts a burst, as does seeing more
+    than burstRate events in a second.  Events keep being queued until
+    none have arrived for burstLinger seconds.
+
+    Lines waiting in the bot's work queues (see
+    vellumbot.server.workqueue) when an event arrives are answered first,
+    as the people and sessions were when they were said: those in the
+    channel for a join or part, and all of them for a quit or rename.
+    """
+    burstRate = 20
+    burstLinger = 2.0
+    netsplit = re.compile(r'^[^\s.]+(\.[^\s.]+)+ [^\s.]+(\.[^\s.]+)+$')
+
+    def __init__(self, bot, clock=reactor):
+        self.bot = bot
+        self.clock = clock
+        self.events = []
+        self.queued = 0          # events that waited for a batch, ever
+        self._call = None
+        self._burstUntil = 0
+        self._window = (0, 0)    # (second, events seen in it)
+
+    def queueing(self, quitMessage=None):
+        """
+        Count an event, and say whether it is part of a burst and should be
+        queued
+        """
+        now = self.clock.seconds()
+        second, seen = self._window
+        if int(now) != second:
+            second, seen = int(now), 0
+        seen = seen + 1
+        self._window = second, seen
+        if seen > self.burstRate or (quitMessage is not None and
+                self.netsplit.match(quitMessage)):
+            self._burstUntil = now + self.burstLinger
+        elif now < self._burstUntil:
+            self._burstUntil = now + self.burstLinger
+        return bool(self.events) or now < self._burstUntil
+
+    def add(self, quitMessage, *event):
+        """
+        Apply event, a tuple ('join', nick, channel), ('part', nick,
+        channel), ('quit', nick) or ('rename', old, new), now or with the
+        rest of its burst
+        """
+        work = self.bot.work
+        if work is not None:
+            if event[0] in ('join', 'part'):
+                work.flush([event[2].lower()])
+            else:
+                work.flush()
+        queueing = self.queueing(quitMessage)
+        self.events.append(event)
+        if not queueing:
+            return self.flush()
+        self.queued = self.queued + 1
+        if self._call is None:
+            self._call = self.clock.callLater(0, self.flush)
+
+    def flush(self):
+        """
+        Apply the queued events, with the fewest calls on each session
+        """
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+        events, self.events = self.events, []
+        if not events:
+            return
+        database = self.bot.database
+        if database is None:
+            return defer.maybeDeferred(self._apply, events)
+        d = database.run(self._apply, events)
+        d.addErrback(log.err, "Error applying membership events")
+        return d
+
+    def _apply(self, events):
+        start = time.time()
+
+        bot = self.bot
+        changes = {}  # session => {folded nick => (member?, nick)}
+        renames = {}  # session => {folded new nick => nick before renames}
+        order = []    # sessions in the order they were first changed
+        retired = []  # (old, new) of every rename
+
+        def change(ss, nick, member):
+            if ss not in changes:
+                changes[ss] = {}
+                renames[ss] = {}
+                order.append(ss)
+            changes[ss][nick.lower()] = (member, nick)
+            renames[ss].pop(nick.lower(), None)
+
+        def sessionsOf(nick):
+            """
+            The sessions nick (a byte string, decoded with the encoding of
+            each session) is in, counting the events seen so far
+            """
+            found = set(bot.sessionIndex.find(nick))
+            for ss, nicks in changes.items():
+                try:
+                    folded = nick.decode(ss.encoding).lower()
+                except UnicodeDecodeError:
+                    continue
+                if folded in nicks:
+                    if nicks[folded][0]:
+                        found.add(ss)
+                    else:
+                        found.discard(ss)
+            if not found and bot.defaultSession is not None:
+                # like findSessions
+                found.add(bot.defaultSession)
+            return found
+
+        for event in events:
+            if event[0] in ('join', 'part'):
+                ss = bot.findSessions(event[2])[0]
+                change(ss, event[1].decode(ss.encoding), event[0] == 'join')
+            elif event[0] == 'quit':
+                for ss in sessionsOf(event[1]):
+                    change(ss, event[1].decode(ss.encoding), False)
+            elif event[0] == 'rename':
+                for ss in sessionsOf(event[1]):
+                    old = event[1].decode(ss.encoding)
+                    new = event[2].decode(ss.encoding)
+                    first = renames.get(ss, {}).get(old.lower(), old)
+                    change(ss, old, False)
+                    change(ss, new, True)
+                    renames[ss][new.lower()] = first
+                    if (old, new) not in retired:
+                        retired.append((old, new))
+
+        if retired:
+            store = bot.store
+            for old, new in retired:
+                session.retireUser(store, old, new)
+
+        for ss in order:
+            nicks = changes[ss]
+            moved = []
+            for folded, first in renames[ss].items():
+                moved.append((first, nicks.pop(folded)[1]))
+                nicks.pop(first.lower(), None)
+            added = [n for member, n in nicks.values() if member]
+            removed = [n for member, n in nicks.values() if not member]
+            bot.sendResponse(ss.changeNicks(added, removed, moved))
+
+        if len(events) > 1:
+            log.msg("Applied %s membership events to %s sessions in %.1fms" % (
+                len(events), len(order), (time.time() - start) * 1000))
+
+
 class VellumTalk(irc.IRCClient):
     """
     An IRC bot that handles D&D game sessions.
@@ -56,6 +290,15 @@ class VellumTalk(irc.IRCClient):
     """
     
     nickname = "VellumTalk"
+    sendInterval = 1.0       # seconds between lines, once sendBurst lines
+    sendBurst = 5            # have been sent at once
+    lineSeparator = ' | '    # joins short replies to one person in one
+                             # line; None to send each on its own
+    userLimit = (10, 0.5)    # (burst, per second) of request costs
+    channelLimit = (30, 2.0) # from one user, and in one channel
+    workQueueSize = 20       # lines waiting to be answered in a channel
+    workBudget = 5           # lines answered each reactor tick
+    workOverflow = workqueue.DROP_NEWEST # dropped from a full queue
 
     def __init__(self, *args, **kwargs):
         self.wtf = 0                 # number of times a "wtf" has occurred
@@ -63,13 +306,24 @@ class VellumTalk(irc.IRCClient):
 
         self.store = None            # storm Store instance, needed for
                                      # sessions
+        self.database = None         # runs all work with the store
+        self.outbound = None         # the lines waiting to be sent
+        self.inbound = None          # what each user and channel may ask
+        self.work = None             # the lines waiting to be answered
+        self.userhost = None         # my user@host, as the server sees
+                                     # me, once it has said
 
         # reset wtf's every 30 seconds 
         self.resetter = task.LoopingCall(self._resetWtfCount)
         self.resetter.start(30.0)
 
         self.sessions = []           # list of the sessions the bot is in
+        self.sessionIndex = session.SessionIndex() # the same, for lookups
         self.defaultSession = None
+        self._names = {}             # channel => [time of first NAMES
+                                     # reply, replies, nicks] until
+                                     # ENDOFNAMES
+        self.membership = MembershipBatch(self)
         # TODO - analyze, do i *really* need responding?
         self.responding = 0          # don't start responding until I join a
                                      # channel
@@ -83,16 +337,7 @@ class VellumTalk(irc.IRCClient):
         Otherwise, return the defaultSession, usually indicating that someone
         has /msg'd the bot and that person is not in a channel with the bot.
         """
-        found = []
-        for ss in self.sessions:
-            try:
-                _channel = channel.decode(ss.encoding)
-                if _channel == ss.name:
-                    found.append(ss)
-                if ss.matchNick(_channel):
-                    found.append(ss)
-            except UnicodeDecodeError:
-                continue
+        found = self.sessionIndex.find(channel)
         if found == []:
             found = [self.defaultSession]
         return found
@@ -110,51 +355,118 @@ class VellumTalk(irc.IRCClient):
             log.msg("Spam blocking tripped. WTF counter exceeded.")
             self.wtf = self.wtf + 1
     
-    def msgSlowly(self, channel, lines, delay=700):
-        """Send multiple lines to the channel with delays in the middle
-        delay is given in ms
-        """
-        send = lambda line: self.msg(channel, line)
-        send(lines[0])
-        for n, line in enumerate(lines[1:]):
-            from . import irc as myself
-            if getattr(myself, 'TESTING', False):
-                send(line)
-            else:
-                reactor.callLater(n*(delay/1000.0), send, line)
+    def sendResponse(self, response, lane=None):
+        """
+        Send the messages of response.  They are worked out in the calling
+        (database) thread, and sent from the reactor.
 
-    def sendResponse(self, response):
+        lane is the vellumbot.server.outbound lane for all of them; by
+        default, messages to channels are sent before private ones.
+        """
         if response is None:
             return
         _already = {}
+        messages = []
         for channel, text, encoding in response.getMessages():
             # don't send messages to any users twice
             if (channel, text) in _already:
                 continue
+            _already[(channel, text)] = True
 
-            _channel = channel.name.encode(encoding)
-
+            if lane is not None:
+                _lane = lane
+            elif channel.name.startswith(u'#'):
+                _lane = outbound.CHANNEL
+            else:
+                _lane = outbound.PRIVATE
             # twisted's abstract sockets insist that data be as byte strings.
-            text = text.encode(encoding)
+            messages.append((channel.name.encode(encoding),
+                text.encode(encoding), _lane))
+        if self.database is None:
+            self._sendMessages(messages)
+        else:
+            self.database.toReactor(self._sendMessages, messages)
 
-            splittext = splitTextIRCWise(text, MAX_LINE)
+    def _sendMessages(self, messages):
+        for _channel, text, lane in messages:
             log.msg("====> %s:    %s" % (_channel, text[:160]))
-            if len(splittext) > 1:
-                self.msgSlowly(_channel, splittext)
-            else:
-                self.msg(_channel, text)
-            _already[(channel, text)] = True
+            for line in splitTextIRCWise(text, self.lineBudget(_channel)):
+                self.outbound.queue(_channel, line, lane)
+        from . import irc as myself
+        if getattr(myself, 'TESTING', False):
+            self.outbound.flush()
+
+    def lineBudget(self, target):
+        """
+        The most bytes of text one PRIVMSG to target can carry, once the
+        server has put my nick!user@host in front of it
+        """
+        prefix = ':%s!%s PRIVMSG %s :' % (self.nickname,
+                self.userhost or UNKNOWN_USERHOST, target)
+        return max(MAX_LINE - len(prefix), MIN_LINE)
+
+    def _privmsg(self, target, line):
+        """
+        Send one line, already split to fit.  (IRCClient.msg would split it
+        again, to a length that assumes the longest nick!user@host.)
+        """
+        self.sendLine('PRIVMSG %s :%s' % (target, line))
+
+    def _limitNotice(self, target, text):
+        """
+        Tell target they're being ignored, in a notice paced with
+        everything else the bot sends
+        """
+        self.outbound.queue(target, text, outbound.PRIVATE, notice=True)
 
-    # callbacks for irc events
     # callbacks for irc events
     def connectionMade(self):
-        self.store = self.factory.store
+        self.database = getattr(self.factory, 'database', None)
+        if self.database is None:
+            store = self.factory.store
+            self.database = Database(lambda: store, threaded=False)
+        self.store = self.database.store
         self.serverEncoding = self.factory.serverEncoding
+        self.outbound = outbound.OutboundQueue(self._privmsg,
+                getattr(self.factory, 'sendInterval', self.sendInterval),
+                getattr(self.factory, 'sendBurst', self.sendBurst),
+                self.lineBudget,
+                getattr(self.factory, 'lineSeparator', self.lineSeparator),
+                notice=self.notice)
+        self.inbound = ratelimit.InboundLimiter(self._limitNotice,
+                *(getattr(self.factory, 'userLimit', self.userLimit) +
+                  getattr(self.factory, 'channelLimit', self.channelLimit)))
+        self.work = workqueue.WorkQueues(
+                getattr(self.factory, 'workQueueSize', self.workQueueSize),
+                getattr(self.factory, 'workBudget', self.workBudget),
+                getattr(self.factory, 'workOverflow', self.workOverflow))
         irc.IRCClient.connectionMade(self)
 
     def connectionLost(self, reason):
+        log.msg("Line classifier: %s" % (linesyntax.classifier,))
+        log.msg("Verb phrase cache: %s" % (linesyntax.verbPhraseCache,))
+        log.msg("Dice expression cache: %s" % (linesyntax.diceCache,))
+        log.msg("Outbound lines: %s" % (self.outbound,))
+        log.msg("Inbound limits: %s" % (self.inbound,))
+        log.msg("Work queues: %s" % (self.work,))
+        self.work.stop()
+        self.outbound.stop()
         irc.IRCClient.connectionLost(self, reason)
 
+    def irc_RPL_WELCOME(self, prefix, params):
+        # most servers welcome us as nick!user@host
+        mask = params[-1].split()[-1]
+        if '!' in mask and '@' in mask:
+            self.userhost = mask.split('!', 1)[1]
+        irc.IRCClient.irc_RPL_WELCOME(self, prefix, params)
+
+    def irc_JOIN(self, prefix, params):
+        # our own joins show our user@host
+        nick, _, userhost = prefix.partition('!')
+        if nick == self.nickname and userhost:
+            self.userhost = userhost
+        irc.IRCClient.irc_JOIN(self, prefix, params)
+
     def signedOn(self):
         """Called when bot has succesfully signed on to server."""
         # create a session to respond to private messages from nicks
@@ -162,12 +474,23 @@ class VellumTalk(irc.IRCClient):
 
         self.ircNetwork = u'TODO' # TODO 
 
+        d = self._findDefaultSession()
+        # join my default channel
+        d.addCallback(lambda _: self.join(self.factory.channel))
+        def failed(f):
+            # without a default session, no private message can be answered
+            log.err(f, "Error finding the default session, disconnecting")
+            self.transport.loseConnection()
+        return d.addErrback(failed)
+
+    @transactional
+    def _findDefaultSession(self):
         self.defaultSession = self.store.find(d20session.D20Session,
                 d20session.D20Session.name == u'#@@default@@').one()
         self.defaultSession.isDefaultSession = True
-        # join my default channel
-        self.join(self.factory.channel)
 
+    @logFailures
+    @transactional
     def joined(self, channel):
         """
         When the bot joins a channel, find or make a session and start
@@ -186,73 +509,68 @@ class VellumTalk(irc.IRCClient):
                 ss = d20session.D20Session()
                 ss.name = channel.decode(ss.encoding)
                 self.store.add(ss)
-                Store.of(ss).commit()
 
             self.sessions.append(ss)
+            self.sessionIndex.addSession(ss)
 
         self.responding = 1
 
+    @logFailures
+    @transactional
     def left(self, channel):
         """
         When the bot parts a channel.
         """
         ss = self.findSessions(channel)[0]
         self.sessions.remove(ss)
+        self.sessionIndex.removeSession(ss)
 
+    @logFailures
+    @transactional
     def kickedFrom(self, channel, kicker, message):
         """
         Don't let the door hit the bot's ass on the way out.
         """
         ss = self.findSessions(channel)[0]
         self.sessions.remove(ss)
+        self.sessionIndex.removeSession(ss)
 
     def userJoined(self, user, channel):
         """
         Some other person joins a channel the bot is already watching.
         """
-        ss = self.findSessions(channel)[0]
-        user = user.decode(ss.encoding)
-        r = ss.addNick(user)
-        self.sendResponse(r)
+        return self.membership.add(None, 'join', user, channel)
 
     def userLeft(self, user, channel):
         """
         Some other person leaves a channel the bot is already watching.
         """
-        ss = self.findSessions(channel)[0]
-        user = user.decode(ss.encoding)
-        self.sendResponse(ss.removeNick(user))
+        return self.membership.add(None, 'part', user, channel)
 
     def userQuit(self, user, quitmessage):
         """
         Some other person leaves a channel the bot is already watching (by
         quitting).
         """
-        sessions = self.findSessions(user)
-        for ss in sessions:
-            user = user.decode(ss.encoding)
-            self.sendResponse(ss.removeNick(user))
+        return self.membership.add(quitmessage, 'quit', user)
 
     def userKicked(self, user, channel, kicker, kickmessage):
-        ss = self.findSessions(channel)[0]
-        user = user.decode(ss.encoding)
-        self.sendResponse(ss.removeNick(user))
+        return self.membership.add(None, 'part', user, channel)
 
     def userRenamed(self, old, new):
         """
         Some other person does a /nick change in a channel the bot is
         watching.
         """
-        sessions = self.findSessions(old)
-        for ss in sessions:
-            old = old.decode(ss.encoding)
-            new = new.decode(ss.encoding)
-            self.sendResponse(ss.rename(old, new))
+        return self.membership.add(None, 'rename', old, new)
 
     def irc_RPL_NAMREPLY(self, prefix, (user, _, channel, names)):
         """
         After joining a channel, the irc server tells us who's there, this
         gets called to keep track.
+
+        The server may send several of these for a big channel, so the nicks
+        are kept until irc_RPL_ENDOFNAMES, and added all at once.
         """
         nicks = names.split()
         for nick in nicks[:]:
@@ -260,12 +578,39 @@ class VellumTalk(irc.IRCClient):
                 nicks.remove(nick)
                 nicks.append(nick[1:])
 
+        pending = self._names.get(channel, None)
+        if pending is None:
+            pending = self._names[channel] = [time.time(), 0, []]
+        pending[1] = pending[1] + 1
+        pending[2].extend(nicks)
+
+    def irc_RPL_ENDOFNAMES(self, prefix, params):
+        """
+        The irc server has told us everybody in a channel.  Add them.
+        """
+        channel = params[1]
+        # taken here, in the reactor thread, so that the replies of another
+        # NAMES for the channel are kept for the ENDOFNAMES after them
+        pending = self._names.pop(channel, None)
+        if pending is None:
+            return
+        return self._addNames(channel, *pending)
+
+    @logFailures
+    @transactional
+    def _addNames(self, channel, firstReply, replies, nicks):
+        """
+        Add the nicks of replies NAMES replies, the first at firstReply, to
+        the session for channel
+        """
+        start = time.time()
         ss = self.findSessions(channel)[0]
         _nicks = [n.decode(ss.encoding) for n in nicks]
         self.sendResponse(ss.addNick(*_nicks))
-
-    def irc_RPL_ENDOFNAMES(self, prefix, params):
-        pass
+        end = time.time()
+        log.msg("Added %s nicks to %s from %s NAMES replies in %.1fms "
+                "(%.1fms after the first reply)" % (len(nicks), channel,
+                    replies, (end - start) * 1000, (end - firstReply) * 1000))
 
     def irc_unknown(self, prefix, command, params):
         log.msg('|||'.join((prefix, command, repr(params))))
@@ -282,6 +627,29 @@ class VellumTalk(irc.IRCClient):
         log.msg(user, channel, msg)
         if not self.responding:
             return
+        # most chatter is not meant for the bot, don't bother parsing it
+        if not linesyntax.classifier.mightBeSyntax(msg):
+            return
+        if channel.lower() == self.nickname.lower():
+            limitedChannel = None
+            key = user.lower()
+        else:
+            limitedChannel = channel
+            key = channel.lower()
+        if not self.inbound.allow(user, limitedChannel,
+                ratelimit.cost(msg, self.nickname)):
+            return
+        d = self.work.add(key, self._respond, user, channel, msg)
+        def failed(f):
+            if f.check(workqueue.Dropped, defer.CancelledError) is None:
+                log.err(f, "Error answering %s" % (user,))
+        return d.addErrback(failed)
+
+    @transactional
+    def _respond(self, user, channel, msg):
+        """
+        Answer msg, which might be for the bot
+        """
         # Check to see if they're sending me a private message
         # If so, the return channel is the user.
         observers = []
@@ -316,7 +684,10 @@ class VellumTalk(irc.IRCClient):
                 response = ss.privateCommand(req, *_observers)
             else:
                 response = ss.command(req)
-            self.sendResponse(response)
+            if sentence.command == u'help':
+                self.sendResponse(response, outbound.BULK)
+            else:
+                self.sendResponse(response)
         elif sentence.verbPhrases:
             if respondTo == user:
                 response = ss.privateInteraction(req, *_observers)
@@ -347,12 +718,22 @@ class VellumTalkFactory(protocol.ClientFactory):
         self.channel = channel
         self.store = None
         self.serverEncoding = None
+        self.database = None     # a vellumbot.server.database.Database,
+                                 # used instead of store if set
+        self.sendInterval = VellumTalk.sendInterval
+        self.sendBurst = VellumTalk.sendBurst
+        self.lineSeparator = VellumTalk.lineSeparator
+        self.userLimit = VellumTalk.userLimit
+        self.channelLimit = VellumTalk.channelLimit
+        self.workQueueSize = VellumTalk.workQueueSize
+        self.workBudget = VellumTalk.workBudget
+        self.workOverflow = VellumTalk.workOverflow
         # no protocol.ClientFactory.__init__ to call
 
     def startFactory(self):
         assert self.serverEncoding is not None, "Must set %s.store before starting!" % (
                 self.__class__.__name__,)
-        assert self.store is not None, "Must set %s.serverEncoding before starting!" % (
+        assert self.store is not None or self.database is not None, "Must set %s.serverEncoding before starting!" % (
                 self.__class__.__name__,)
 
     def clientConnectionLost(self, connector, reason):
@@ -12,34 +12,21 @@ Lines may contain the following syntax:
     - A target starts with @ and there may be more than one.
 """
 
+import copy
 import re
-import shlex
 
 from simpleparse import parser, dispatchprocessor as disp
 from simpleparse.error import ParserSyntaxError
+from simpleparse.stt.TextTools.TextTools import tag
 from simpleparse.common import numbers # importing for side effect
 numbers # shut up pyflakes
 from playtools.parser import diceparser
 
+from ..util import lru
+
 grammar = ( # {{{
-r'''# irc bot commands and recognized sentences
+r'''# verb phrases, the part of a sentence inside brackets
 <ws>                    := [ \t]*
-<identifier>            := [a-zA-Z], [a-zA-Z0-9_]*
-
-<commandLeader>         := '.'
-commandIdentifier       := identifier
-
-botname                 := identifier
-
-<hail>                  := botname, ws, (':'/','), ws
-
-<CHAR>                  := -[[]/'['  
-
-commandArgs             := CHAR+ 
-
-command                 := (hail/commandLeader), ws, !, commandIdentifier, ([ \t]+, commandArgs)?, ws
-
-commandRoot             := ws,command
 
 <word>                  := [a-zA-Z0-9{}\/';":.,!@#$%^&*()-=_+]+  
 nonDiceWords            := (?-(diceExpression),word,ws)+  
@@ -55,7 +42,115 @@ nonDiceWords            := (?-(diceExpression),word,ws)+
 >verbPhrase<            := '[', !, vContent, ']'
 
 verbPhraseRoot          := ws,verbPhrase
+''') # }}}
 
+# commands and the rest of a sentence are scanned by hand, see scanCommand
+# and scanSentence.
+identifier = re.compile(r'[a-zA-Z][a-zA-Z0-9_]*')
+# a hail is the bot's name followed by : or ,
+commandLeader = re.compile(r'[ \t]*(?:([a-zA-Z][a-zA-Z0-9_]*)[ \t]*[:,]|\.)[ \t]*')
+_sentenceMarks = re.compile(r'[][*@]')
+_argQuoting = re.compile(r'[\'"\\]')
+_argSeparator = re.compile(r'[ \t\r\n]+')
+_phraseSpace = re.compile(r'[ \t]+')
+
+# parsed verb phrases and dice expressions, shared by everyone who says them
+verbPhraseCache = lru.LRUCache(512)
+diceCache = lru.LRUCache(512)
+
+
+class LineClassifier(object):
+    """
+    A cheap test, made before any parsing, of whether a line could possibly
+    be a command or contain a verb phrase.  Most of what is said in a channel
+    is neither, and can be dismissed without touching the grammar.
+
+    hits counts the lines dismissed this way; misses counts the lines that
+    had to be handed to the parser.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def mightBeSyntax(self, s):
+        """
+        False if s can be neither a command nor a sentence with a verb phrase
+        """
+        if '[' in s or commandLeader.match(s):
+            self.misses = self.misses + 1
+            return True
+        self.hits = self.hits + 1
+        return False
+
+    def hitRate(self):
+        """
+        The fraction of lines dismissed without parsing
+        """
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def __str__(self):
+        return 'dismissed %s of %s lines without parsing (%.1f%%)' % (
+                self.hits, self.hits + self.misses, self.hitRate() * 100)
+
+classifier = LineClassifier()
+
+
+def _syntaxError(s, position, production):
+    """
+    The same error simpleparse raises when a line passes the point of no
+    return in a production and then fails to match
+    """
+    e = ParserSyntaxError()
+    e.buffer = s
+    e.position = position
+    e.production = production
+    e.expected = production
+    return e
+
+
+def scanCommand(s):
+    """
+    Scan a command off the front of s, returning (botName, commandName,
+    commandArgs, end), or None if s does not start like a command.
+
+    botName and commandArgs may be None.  Anything after end could not be
+    scanned as part of the command.
+
+    Once the '.' or the bot's name has been seen, failing to find the command
+    name is a ParserSyntaxError.
+    """
+    m = commandLeader.match(s)
+    if m is None:
+        return None
+    botName = m.group(1)
+    if botName is not None:
+        botName = botName.lower()
+
+    i = m.end()
+    m = identifier.match(s, i)
+    if m is None:
+        raise _syntaxError(s, i, 'commandIdentifier')
+    commandName = m.group()
+
+    i = m.end()
+    end = len(s)
+    rest = s[i:].lstrip(' \t')
+    if rest == '':
+        return botName, commandName, None, end
+    if len(rest) == end - i:
+        # something other than whitespace right after the command name
+        return botName, commandName, None, i
+    return botName, commandName, rest, end
+
+
+def parseCommand(s):
+    scanned = scanCommand(s)
+    if scanned is None or not scanned[3] == len(s):
+        raise RuntimeError('%s is not a command' % (s,))
+    return [scanned[:3]]
 
 
 # you could say:
@@ -71,47 +166,127 @@ verbPhraseRoot          := ws,verbPhrase
 # or
 # word word
 
-words                   := (word,ws)+  
-
-nonCommand              := ?-(command),CHAR*
-
->sentence<              := command/nonCommand
-sentenceRoot            := ws,sentence
-''') # }}}
-
-# do a half-assed parse with re to eliminate any non-syntax from a person's
-# sentence.
-verbsMaybe = re.compile(r'\[[^]]*\]')
-target = re.compile(r'@[a-zA-Z][a-zA-Z0-9_]*')
-actor = re.compile(r'\*[a-zA-Z][a-zA-Z0-9_]*')
-
-
-class CommandProcessor(disp.DispatchProcessor):
-    commandArgsFound = None
-    commandName = None
-    botName = None
-
-    def commandIdentifier(self, (t,s1,s2,sub), buffer):
-        disp.dispatchList(self, sub, buffer)
-        self.commandName = buffer[s1:s2]
-
-    def commandArgs(self, (t,s1,s2,sub), buffer):
-        self.commandArgsFound = buffer[s1:s2]
-
-    def command(self, (t,s1,s2,sub), buffer):
-        disp.dispatchList(self, sub, buffer)
-        return self.botName, self.commandName, self.commandArgsFound
-
-    def botname(self, (t,s1,s2,sub), buffer):
-        self.botName = buffer[s1:s2].lower()
-
-def parseCommand(s):
-    commandParser = parser.Parser(grammar, root="commandRoot")
-    succ, children, end = commandParser.parse(s, processor=CommandProcessor())
-    if not succ or not end == len(s):
-        raise RuntimeError('%s is not a command' % (s,))
-    return children
-
+def scanSentence(s):
+    """
+    Scan s once, returning (actors, verbCandidates, targets).
+
+    verbCandidates are the bracketed parts of s, brackets included; each
+    runs from a [ to the next ].  Actors and targets are names without the
+    leading * or @, and are found inside brackets too.
+    """
+    actors = []
+    verbCandidates = []
+    targets = []
+    opened = None
+    for m in _sentenceMarks.finditer(s):
+        i = m.start()
+        c = s[i]
+        if c == '[':
+            if opened is None:
+                opened = i
+        elif c == ']':
+            if opened is not None:
+                verbCandidates.append(s[opened:i+1])
+                opened = None
+        else:
+            name = identifier.match(s, i + 1)
+            if name is not None:
+                if c == '*':
+                    actors.append(name.group())
+                else:
+                    targets.append(name.group())
+    return actors, verbCandidates, targets
+
+
+def splitArgs(s):
+    """
+    Split command arguments on whitespace, keeping quoted strings together,
+    the same way shlex.split does.
+
+    Raises ValueError for an unclosed quotation or a trailing backslash.
+    """
+    if _argQuoting.search(s) is None:
+        s = s.strip(' \t\r\n')
+        if not s:
+            return []
+        return _argSeparator.split(s)
+
+    ret = []
+    token = None
+    quote = None
+    i = 0
+    end = len(s)
+    while i < end:
+        c = s[i]
+        if quote is None:
+            if c in ' \t\r\n':
+                if token is not None:
+                    ret.append(''.join(token))
+                    token = None
+            else:
+                if token is None:
+                    token = []
+                if c == '"' or c == "'":
+                    quote = c
+                elif c == '\\':
+                    i = i + 1
+                    if i == end:
+                        raise ValueError("No escaped character")
+                    token.append(s[i])
+                else:
+                    token.append(c)
+        elif c == quote:
+            quote = None
+        elif c == '\\' and quote == '"':
+            i = i + 1
+            if i == end:
+                raise ValueError("No escaped character")
+            if s[i] not in ('"', '\\'):
+                token.append(c)
+            token.append(s[i])
+        else:
+            token.append(c)
+        i = i + 1
+    if quote is not None:
+        raise ValueError("No closing quotation")
+    if token is not None:
+        ret.append(''.join(token))
+    return ret
+
+
+class CompiledProduction(object):
+    """
+    One root production of the grammar, compiled into a TextTools tag table
+    a single time and then reused, along with its processor, for every line
+    the bot hears.
+    """
+    def __init__(self, root, processor):
+        self.root = root
+        self.processor = processor
+        self.parser = parser.Parser(grammar, root=root)
+        self.table = self.parser.buildTagger(root, processor)
+
+    def parse(self, s):
+        """
+        Parse s from the root production, returning (success, children, end)
+        just like simpleparse's Parser.parse
+        """
+        self.processor.reset()
+        return self.processor(tag(s, self.table, 0, len(s)), s)
+
+
+_productions = {}
+
+def getProduction(root):
+    """
+    The CompiledProduction for the named root production, compiling the
+    grammar the first time it is asked for
+    """
+    production = _productions.get(root, None)
+    if production is None:
+        production = CompiledProduction(root, _processorClasses[root]())
+        _productions[root] = production
+    return production
 
 
 class Sentence(object):
@@ -125,14 +300,11 @@ class Sentence(object):
         self.targets = []
 
     def get_commandArgs(self):
-        return [s.decode('ascii') for s in self._commandArgs]
+        return [unicode(s) for s in self._commandArgs]
 
     def set_commandArgs(self, s):
-        if type(s) is unicode:    # FIXME - working around python bug 1548891 
-            s = s.encode('ascii') # in shlex.split()                          
-        # blah - shlex.split(None) blocks waiting for input, so protect it
         try:
-            self._commandArgs = shlex.split(s or '')
+            self._commandArgs = splitArgs(s or '')
         except ValueError, e:
             if e.message == "No closing quotation":
                 self._commandArgs = [s]
@@ -181,34 +353,27 @@ class Sentence(object):
         return ''.join(ret)
 
 
-class SentenceProcessor(CommandProcessor):
-    def nonCommand(self, (t,s1,s2,sub), buffer):
-        return buffer
-
 def parseSentence(s):
-    sp = SentenceProcessor()
     sent = Sentence()
-    sentenceParser = parser.Parser(grammar, root="sentenceRoot")
-    succ, children, end = sentenceParser.parse(s, processor=sp)
-    if not succ or not end == len(s):
-        # this might happen if you start with something that looks like a
-        # command but isn't
-        raise RuntimeError('%s is not a sentence' % (s,))
-
-    if sp.commandName:
-        sent.botName = sp.botName
-        sent.command = sp.commandName
-        sent.commandArgs = sp.commandArgsFound
+    scanned = scanCommand(s)
+    if scanned is not None:
+        botName, commandName, commandArgs, end = scanned
+        if not end == len(s):
+            # this might happen if you start with something that looks like a
+            # command but isn't
+            raise RuntimeError('%s is not a sentence' % (s,))
+        sent.botName = botName
+        sent.command = commandName
+        sent.commandArgs = commandArgs
         return sent
     else:
-        actors = actor.findall(children[0])
+        actors, verbCandidates, targets = scanSentence(s)
         if len(actors) > 1:
             raise RuntimeError('Too many actors (only one allowed): %s' %
                     (actors,))
         elif len(actors) == 1:  
-            sent.actor = actors[0][1:]
+            sent.actor = actors[0]
 
-        verbCandidates = verbsMaybe.findall(children[0])
         for vc in verbCandidates:
             try:
                 sent.verbPhrases.append(parseVerbPhrase(vc))
@@ -219,16 +384,29 @@ def parseSentence(s):
         if len(sent.verbPhrases) == 0:
             raise RuntimeError('No verb phrase or command')
 
-        for t in target.findall(children[0]):
-            sent.targets.append(t[1:])
+        sent.targets.extend(targets)
 
         return sent
 
 
 class VerbPhrase(object):
+    """
+    The parsed contents of a bracketed phrase.  Once frozen (as every
+    VerbPhrase returned by parseVerbPhrase is) it cannot be changed, because
+    it is shared by everyone who says the same phrase.
+    """
     dieModifier = None
     diceExpression = None
     nonDiceWords = None
+    _frozen = False
+
+    def __setattr__(self, name, value):
+        if self._frozen:
+            raise AttributeError("%r is frozen" % (self,))
+        object.__setattr__(self, name, value)
+
+    def freeze(self):
+        self._frozen = True
     def __repr__(self):
         return '<Sentence %s>' % (str(self),)
 
@@ -251,10 +429,16 @@ class VerbPhrase(object):
 class VerbPhraseProcessor(disp.DispatchProcessor):
     def __init__(self, *a, **kw):
         # disp.DispatchProcessor.__init__(self, *a, **kw)
+        self.reset()
+
+    def reset(self):
+        """
+        Start a fresh VerbPhrase, so this processor can be reused
+        """
         self.verbPhrase = VerbPhrase()
 
     def diceExpression(self, (t,s1,s2,sub), buffer):
-        self.verbPhrase.diceExpression = diceparser.parseDice(buffer[s1:s2])
+        self.verbPhrase.diceExpression = parseDice(buffer[s1:s2])
 
     def nonDiceWords(self, (t,s1,s2,sub), buffer):
         b = buffer[s1:s2]
@@ -264,10 +448,38 @@ class VerbPhraseProcessor(disp.DispatchProcessor):
         self.verbPhrase.dieModifier = int(buffer[s1:s2])
 
 def parseVerbPhrase(s):
-    verbPhraseParser = parser.Parser(grammar, root="verbPhraseRoot")
-    proc = VerbPhraseProcessor()
-    succ, children, end = verbPhraseParser.parse(s, processor=proc)
-    if not succ or not end == len(s):
-        raise RuntimeError('%s is not a verb phrase' % (s,))
-    return proc.verbPhrase
+    """
+    The frozen VerbPhrase for s, from verbPhraseCache if it has been parsed
+    recently
+    """
+    key = _phraseSpace.sub(' ', s).lstrip(' ')
+    verbPhrase = verbPhraseCache.get(key, None)
+    if verbPhrase is None:
+        production = getProduction("verbPhraseRoot")
+        succ, children, end = production.parse(key)
+        if not succ or not end == len(key):
+            raise RuntimeError('%s is not a verb phrase' % (s,))
+        verbPhrase = production.processor.verbPhrase
+        verbPhrase.freeze()
+        verbPhraseCache[key] = verbPhrase
+    return verbPhrase
+
+
+def parseDice(s):
+    """
+    diceparser.parseDice, remembering recently parsed expressions in
+    diceCache.  Each call returns a copy of the cached expression, so
+    changing it doesn't change the next parse of s.
+    """
+    parsed = diceCache.get(s, None)
+    if parsed is None:
+        parsed = diceparser.parseDice(s)
+        diceCache[s] = parsed
+    # its attributes are all numbers and strings
+    return copy.copy(parsed)
+
+
+_processorClasses = {
+        'verbPhraseRoot': VerbPhraseProcessor,
+        }
 
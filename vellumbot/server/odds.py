@@ -0,0 +1,254 @@
+"""
+Exact odds for dice expressions.
+
+The distribution of NdS is worked out by convolving the distributions of
+smaller pools, counting ways with Python's unbounded ints so nothing is
+approximated.  Pools are cached, so once 3d6 or 1d20 has been asked for (or
+used on the way to 40d6) it is never computed again.
+
+Pools that keep only their highest or lowest dice (4d6h3, 2d20l1) are
+worked out by counting the ways of rolling each face, from the best face
+down, while the dice kept are summed.  That takes longer, so it is only
+done for small pools.
+"""
+from __future__ import division
+
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import diceprogram
+from ..util import lru
+
+# pools with more possible totals than this take too long to work out
+MAX_OUTCOMES = 1000
+# and pools that keep some of their dice are refused if they'd take more
+# than this many steps (see steps)
+MAX_KEPT_STEPS = 500000
+
+_constant = re.compile(r'^(\d+)([-+]\d+)?(?:[xX](\d+))?(?:sort)?$')
+
+
+class Distribution(object):
+    """
+    The outcomes of a roll: ways[i] is the number of ways of rolling
+    lowest+i, out of total equally likely ways
+    """
+    def __init__(self, lowest, ways):
+        self.lowest = lowest
+        self.ways = ways
+        self.total = sum(ways)
+
+    def highest(self):
+        return self.lowest + len(self.ways) - 1
+
+    def shifted(self, n):
+        """
+        This distribution with n added to every outcome
+        """
+        return Distribution(self.lowest + n, self.ways)
+
+    def probability(self, n):
+        """
+        The chance of rolling exactly n
+        """
+        i = n - self.lowest
+        if 0 <= i < len(self.ways):
+            return self.ways[i] / self.total
+        return 0.0
+
+    def atLeast(self, n):
+        """
+        The chance of rolling n or better
+        """
+        i = max(n - self.lowest, 0)
+        return sum(self.ways[i:]) / self.total
+
+    def mean(self):
+        return sum((self.lowest + i) * w
+            for i, w in enumerate(self.ways)) / self.total
+
+    def mostLikely(self):
+        """
+        The list of outcomes that are most likely, lowest first
+        """
+        top = max(self.ways)
+        return [self.lowest + i for i, w in enumerate(self.ways) if w == top]
+
+
+def convolve(a, b):
+    """
+    The ways of getting each sum of one outcome from a and one from b
+    """
+    if numpy is not None:
+        return numpy.convolve(numpy.array(a, dtype=object),
+                numpy.array(b, dtype=object)).tolist()
+    ret = [0] * (len(a) + len(b) - 1)
+    for i, x in enumerate(a):
+        for j, y in enumerate(b):
+            ret[i + j] = ret[i + j] + x * y
+    return ret
+
+
+_pools = lru.LRUCache(256)
+
+def pool(count, size):
+    """
+    The Distribution of the sum of count dice of the given size
+    """
+    key = (count, size)
+    found = _pools.get(key, None)
+    if found is not None:
+        return found
+    if count == 1:
+        found = Distribution(1, [1] * size)
+    else:
+        half = pool(count // 2, size)
+        ways = convolve(half.ways, half.ways)
+        if count % 2:
+            ways = convolve(ways, pool(1, size).ways)
+        found = Distribution(count, ways)
+    _pools[key] = found
+    return found
+
+
+_keptPools = lru.LRUCache(64)
+
+def keptPool(count, size, keep, highest=True):
+    """
+    The Distribution of the sum of the keep highest (or lowest) of count
+    dice of the given size
+    """
+    key = (count, size, keep, highest)
+    found = _keptPools.get(key, None)
+    if found is not None:
+        return found
+    # choose[n][c] is n choose c
+    choose = [[1]]
+    for n in range(count):
+        row = choose[-1]
+        choose.append([1] + [row[c] + row[c + 1] for c in range(n)] + [1])
+
+    # placed => {sum of the dice kept => ways}, having decided how many dice
+    # show each face so far; the first keep dice placed are the ones kept
+    states = {0: {0: 1}}
+    if highest:
+        faces = range(size, 0, -1)
+    else:
+        faces = range(1, size + 1)
+    for face in faces:
+        nextStates = {}
+        for placed, sums in states.items():
+            left = count - placed
+            for c in range(left + 1):
+                ways = choose[left][c]
+                added = (min(keep, placed + c) - min(keep, placed)) * face
+                into = nextStates.setdefault(placed + c, {})
+                for total, w in sums.items():
+                    into[total + added] = into.get(total + added, 0) + w * ways
+        states = nextStates
+
+    sums = states[count]
+    lowest = min(sums)
+    found = Distribution(lowest, [sums.get(n, 0)
+        for n in range(lowest, max(sums) + 1)])
+    _keptPools[key] = found
+    return found
+
+
+def keptParts(expression):
+    """
+    Return (count, dieSize, keep, highest, modifier, repeat) for an
+    expression like 4d6h3 or 2d20l1+2, or None for anything else
+    """
+    direction = getattr(expression, 'filterDirection', None)
+    keep = getattr(expression, 'filterCount', None)
+    count = getattr(expression, 'count', None)
+    size = getattr(expression, 'dieSize', None)
+    modifier = getattr(expression, 'dieModifier', None) or 0
+    repeat = getattr(expression, 'repeat', None) or 1
+    if direction is None or direction.lower() not in ('h', 'l'):
+        return None
+    for n in (count, size, keep, modifier, repeat):
+        if type(n) not in (int, long):
+            return None
+    if count < 1 or size < 1 or keep < 1:
+        return None
+    return (count, size, min(keep, count), direction.lower() == 'h',
+            modifier, repeat)
+
+
+def steps(expression):
+    """
+    Roughly how many steps it takes to work out the odds of a parsed
+    expression, or None if they can't be worked out
+    """
+    parts = diceprogram.plainParts(expression)
+    if parts is not None:
+        count, size, modifier, repeat = parts
+        outcomes = count * (size - 1) + 1
+        if outcomes > MAX_OUTCOMES:
+            return None
+        return outcomes * outcomes
+
+    parts = keptParts(expression)
+    if parts is not None:
+        count, size, keep, highest, modifier, repeat = parts
+        outcomes = keep * (size - 1) + 1
+        work = size * (count + 1) * (count + 2) // 2 * outcomes
+        if outcomes > MAX_OUTCOMES or work > MAX_KEPT_STEPS:
+            return None
+        return work
+
+    if _constant.match(expression.format()) is not None:
+        return 1
+    return None
+
+
+def distribution(expression):
+    """
+    Return (Distribution, repeat) for a parsed dice expression, or None if
+    the odds of expression can't be worked out.  Each of the repeat rolls has
+    the same Distribution.
+    """
+    if steps(expression) is None:
+        return None
+
+    parts = diceprogram.plainParts(expression)
+    if parts is not None:
+        count, size, modifier, repeat = parts
+        return pool(count, size).shifted(modifier), repeat
+
+    parts = keptParts(expression)
+    if parts is not None:
+        count, size, keep, highest, modifier, repeat = parts
+        return keptPool(count, size, keep, highest).shifted(modifier), repeat
+
+    m = _constant.match(expression.format())
+    if m is not None:
+        n, modifier, repeat = m.groups()
+        return Distribution(int(n) + int(modifier or 0), [1]), int(repeat or 1)
+    return None
+
+
+def formatOdds(text, dist, repeat=1, target=None):
+    """
+    Describe dist as an irc message
+    """
+    best = dist.mostLikely()
+    if len(best) > 2:
+        bestText = '%s-%s' % (best[0], best[-1])
+    else:
+        bestText = ' or '.join(map(str, best))
+    ret = ['%s: %s to %s, average %.2f, most likely %s (%.2f%%)' % (text,
+        dist.lowest, dist.highest(), dist.mean(), bestText,
+        dist.probability(best[0]) * 100)]
+    if repeat > 1:
+        ret.append(' on each of %s rolls' % (repeat,))
+    if target is not None:
+        ret.append('.  %s or better: %.2f%%' % (target,
+            dist.atLeast(target) * 100))
+    return ''.join(ret)
@@ -0,0 +1,217 @@
+"""
+The lines the bot sends, paced to stay under the server's flood limit.
+
+irc servers let a client send a few lines at once, and then about one line
+per second or two; a client that goes faster is throttled or disconnected.
+So everything the bot says goes through one OutboundQueue per connection,
+which sends lines as a token bucket allows, and when it has to hold lines
+back, sends the most urgent first: dice rolled in a channel before private
+replies, and private replies before long texts like help.  Short lines for
+one target are sent together in one PRIVMSG where they fit, since the
+server counts lines, not bytes.
+"""
+import collections
+
+from twisted.python import log
+
+
+# lanes, most urgent first
+CHANNEL, PRIVATE, BULK = range(3)
+LANE_NAMES = ['channel', 'private', 'bulk']
+
+
+def coalesce(lines, separator, maxLine):
+    """
+    Join lines with separator into as few lines of at most maxLine bytes
+    as they fit in, keeping their order
+    """
+    ret = []
+    for line in lines:
+        if ret and len(ret[-1]) + len(separator) + len(line) <= maxLine:
+            ret[-1] = ret[-1] + separator + line
+        else:
+            ret.append(line)
+    return ret
+
+
+class OutboundQueue(object):
+    """
+    Call send(target, line) for each line queued (or notice(target, line),
+    for the lines queued as notices), at most burst lines at once and then
+    one every interval seconds.  Each lane is sent in the order it was
+    queued, and a lane is only sent when the lanes before it are empty.
+
+    Lines are put in their lanes at the end of the reactor turn they were
+    queued in.  Then, unless separator is None, the lines for each target
+    (in one lane) are joined with separator into as few lines of at most
+    lineBudget(target) bytes as possible, along with a line for the same
+    target still waiting at the end of the lane.  coalesced counts the
+    lines saved.  Notices are never joined with other lines.
+
+    For each lane, sent counts the lines sent, waited the total seconds
+    they were queued, and longestWait the longest; mostQueued is the
+    greatest number of lines ever waiting at once.
+    """
+    slowLine = 10.0
+
+    def __init__(self, send, interval=1.0, burst=5, lineBudget=None,
+            separator=' | ', clock=None, notice=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.send = send
+        self.notice = notice or send
+        self.interval = interval
+        self.burst = burst
+        if lineBudget is None:
+            # short enough for any target
+            lineBudget = lambda target: 400
+        self.lineBudget = lineBudget
+        self.separator = separator
+        self.clock = clock
+        self.lanes = [collections.deque() for name in LANE_NAMES]
+        self.sent = [0] * len(LANE_NAMES)
+        self.waited = [0.0] * len(LANE_NAMES)
+        self.longestWait = [0.0] * len(LANE_NAMES)
+        self.mostQueued = 0
+        self.coalesced = 0
+        self._tokens = float(burst)
+        self._filled = clock.seconds()
+        self._turn = []           # (time, lane, target, line, notice?)
+                                  # queued this reactor turn
+        self._turnCall = None
+        self._call = None
+
+    def queue(self, target, line, lane=PRIVATE, notice=False):
+        """
+        Send line to target, as a notice if notice is true, as soon as the
+        rate and the more urgent lanes allow
+        """
+        self._turn.append((self.clock.seconds(), lane, target, line, notice))
+        if self._turnCall is None:
+            self._turnCall = self.clock.callLater(0, self._endTurn)
+
+    def _endTurn(self):
+        self._turnCall = None
+        self._enqueue()
+        self._drain()
+
+    def _enqueue(self):
+        """
+        Put the lines queued this turn in their lanes, coalescing them
+        """
+        turn, self._turn = self._turn, []
+        groups = {}
+        order = []
+        for queued, lane, target, line, notice in turn:
+            key = (lane, target, notice)
+            if key not in groups:
+                groups[key] = (queued, [])
+                order.append(key)
+            groups[key][1].append(line)
+
+        for lane, target, notice in order:
+            queued, lines = groups[(lane, target, notice)]
+            waiting = self.lanes[lane]
+            if self.separator is not None and not notice:
+                if waiting and waiting[-1][1:3] == (target, False):
+                    queued, _, _, line = waiting.pop()
+                    lines.insert(0, line)
+                merged = coalesce(lines, self.separator,
+                        self.lineBudget(target))
+                self.coalesced = self.coalesced + len(lines) - len(merged)
+                lines = merged
+            for line in lines:
+                waiting.append((queued, target, notice, line))
+        self.mostQueued = max(self.mostQueued, len(self))
+
+    def __len__(self):
+        return sum([len(l) for l in self.lanes])
+
+    def depths(self):
+        """
+        The number of lines waiting in each lane
+        """
+        return [len(l) for l in self.lanes]
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self._tokens = min(self.burst,
+                self._tokens + (now - self._filled) / self.interval)
+        self._filled = now
+
+    def _next(self):
+        """
+        Take the first line of the most urgent lane, and count it as sent.
+        Returns the function to send it with, its target and the line.
+        """
+        for lane, lines in enumerate(self.lanes):
+            if lines:
+                queued, target, notice, line = lines.popleft()
+                wait = self.clock.seconds() - queued
+                self.sent[lane] = self.sent[lane] + 1
+                self.waited[lane] = self.waited[lane] + wait
+                if wait > self.longestWait[lane]:
+                    self.longestWait[lane] = wait
+                    if wait > self.slowLine:
+                        log.msg("A %s line waited %.1fs to be sent (%s "
+                                "waiting)" % (LANE_NAMES[lane], wait,
+                                    len(self)))
+                if notice:
+                    return self.notice, target, line
+                return self.send, target, line
+
+    def _tick(self):
+        self._call = None
+        self._drain()
+
+    def _drain(self):
+        self._refill()
+        while self._tokens >= 1 and len(self):
+            self._tokens = self._tokens - 1
+            send, target, line = self._next()
+            send(target, line)
+        if len(self) and self._call is None:
+            self._call = self.clock.callLater(
+                    (1 - self._tokens) * self.interval, self._tick)
+
+    def flush(self):
+        """
+        Send everything waiting, now, whatever the rate
+        """
+        if self._turnCall is not None:
+            self._turnCall.cancel()
+            self._turnCall = None
+        self._enqueue()
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        while len(self):
+            send, target, line = self._next()
+            send(target, line)
+
+    def stop(self):
+        """
+        Forget everything waiting
+        """
+        self._turn = []
+        if self._turnCall is not None:
+            self._turnCall.cancel()
+            self._turnCall = None
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        for lines in self.lanes:
+            lines.clear()
+
+    def __str__(self):
+        ret = []
+        for lane, name in enumerate(LANE_NAMES):
+            average = 0.0
+            if self.sent[lane]:
+                average = self.waited[lane] / self.sent[lane]
+            ret.append('%s: %s sent, %s waiting, waited %.2fs average, '
+                    '%.2fs longest' % (name, self.sent[lane],
+                        len(self.lanes[lane]), average,
+                        self.longestWait[lane]))
+        return '; '.join(ret) + '; most waiting %s; %s coalesced' % (
+                self.mostQueued, self.coalesced)
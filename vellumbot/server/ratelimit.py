@@ -0,0 +1,196 @@
+"""
+Limits on how much one user, or one channel, can ask of the bot.
+
+Each line the bot will answer has a cost (see cost): most are 1, but
+lookups, huge dice pools and the odds of big pools cost more, and lines meant for someone else
+cost nothing.  The cost is taken from a token bucket for the user who said
+it and one for the channel it was said in.  Lines that can't be paid for
+are dropped, and the user or channel is told so once, in a notice, until
+their bucket lets them in again.
+"""
+import re
+
+from simpleparse.error import ParserSyntaxError
+
+from vellumbot.server import linesyntax, odds
+
+
+# what a command costs, if not 1
+COMMAND_COSTS = {'lookup': 5, 'help': 3, 'odds': 2}
+# an extra token for every this many dice rolled
+DICE_PER_TOKEN = 100
+# and for every this many steps taken working out odds (see odds.steps)
+ODDS_STEPS_PER_TOKEN = 100000
+
+_dice = re.compile(r'(\d*)[dD]\d+(?:[^]]*?[xX](\d+))?')
+
+
+def cost(msg, nickname):
+    """
+    The number of tokens it costs the bot, called nickname, to answer msg:
+    0 if it won't answer, as when msg is a command for someone else or has
+    no verb phrase
+    """
+    try:
+        scanned = linesyntax.scanCommand(msg)
+    except ParserSyntaxError:
+        return 0
+    if scanned is not None:
+        botName, command, args, end = scanned
+        if end != len(msg):
+            return 0
+        if botName is not None and botName != nickname.lower():
+            return 0
+        if command.lower() == 'odds':
+            return oddsCost(args)
+        return COMMAND_COSTS.get(command.lower(), 1)
+    actors, verbs, targets = linesyntax.scanSentence(msg)
+    if len(actors) > 1:
+        return 0
+    phrases = 0
+    rolled = 0
+    for verb in verbs:
+        try:
+            linesyntax.parseVerbPhrase(verb)
+        except (RuntimeError, ParserSyntaxError):
+            continue
+        phrases = phrases + 1
+        for count, repeat in _dice.findall(verb):
+            rolled = rolled + int(count or 1) * int(repeat or 1)
+    if phrases == 0:
+        return 0
+    return phrases * max(len(targets), 1) + rolled // DICE_PER_TOKEN
+
+
+def oddsCost(args):
+    """
+    The cost of the odds command with args, which grows with the work of
+    working out the odds
+    """
+    args = list(args or ())
+    if len(args) > 2 and args[-2].lower() == u'vs':
+        del args[-2:]
+    try:
+        expression = linesyntax.parseDice(u''.join(args))
+    except (RuntimeError, ParserSyntaxError):
+        return COMMAND_COSTS['odds']
+    steps = odds.steps(expression) or 0
+    return COMMAND_COSTS['odds'] + steps // ODDS_STEPS_PER_TOKEN
+
+
+class TokenBuckets(object):
+    """
+    A token bucket for each key, holding up to burst tokens and filling at
+    rate tokens a second.  Taking more than burst tokens takes burst.
+    Buckets that have filled up are forgotten.
+    """
+    sweepInterval = 60
+
+    def __init__(self, burst, rate, clock):
+        self.burst = burst
+        self.rate = rate
+        self.clock = clock
+        self.buckets = {}       # key => [tokens, when they were counted]
+        self._lastSweep = clock.seconds()
+
+    def take(self, key, tokens):
+        """
+        Take tokens from key's bucket and return True, or return False if
+        it doesn't have that many
+        """
+        tokens = min(tokens, self.burst)
+        now = self.clock.seconds()
+        if now - self._lastSweep > self.sweepInterval:
+            self.sweep(now)
+        bucket = self.buckets.get(key, None)
+        if bucket is None:
+            bucket = self.buckets[key] = [float(self.burst), now]
+        else:
+            bucket[0] = min(self.burst,
+                    bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < tokens:
+            return False
+        bucket[0] = bucket[0] - tokens
+        return True
+
+    def give(self, key, tokens):
+        """
+        Put back tokens taken from key's bucket
+        """
+        bucket = self.buckets.get(key, None)
+        if bucket is not None:
+            bucket[0] = min(self.burst, bucket[0] + min(tokens, self.burst))
+
+    def sweep(self, now=None):
+        """
+        Forget the buckets that would be full by now
+        """
+        if now is None:
+            now = self.clock.seconds()
+        self._lastSweep = now
+        for key, (tokens, counted) in self.buckets.items():
+            if tokens + (now - counted) * self.rate >= self.burst:
+                del self.buckets[key]
+
+
+class InboundLimiter(object):
+    """
+    Decide whether to answer each line, from its cost and the buckets of the
+    user who said it and the channel it was said in (None for private
+    messages).  notice(target, text) is called to tell a user or channel
+    they're being ignored, once each time it starts.
+
+    allowed and dropped count lines, spent the tokens they cost, and
+    limited the times a user or channel started being ignored.
+    """
+    def __init__(self, notice, userBurst=10, userRate=0.5, channelBurst=30,
+            channelRate=2.0, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.notice = notice
+        self.users = TokenBuckets(userBurst, userRate, clock)
+        self.channels = TokenBuckets(channelBurst, channelRate, clock)
+        self.allowed = 0
+        self.dropped = 0
+        self.spent = 0
+        self.limited = 0
+        self._silenced = set()   # (kind, key) told they're being ignored
+
+    def allow(self, user, channel, cost):
+        """
+        True if the bot should answer a line costing cost from user in
+        channel.  Lines that cost nothing are always answered, and not
+        counted.
+        """
+        if not cost:
+            return True
+        if not self.users.take(user.lower(), cost):
+            return self._drop('user', user.lower(), user,
+                    "%s: you're asking too much too fast; I'll ignore you "
+                    "for a few seconds." % (user,))
+        if channel is not None and not self.channels.take(channel.lower(),
+                cost):
+            self.users.give(user.lower(), cost)
+            return self._drop('channel', channel.lower(), channel,
+                    "I'm being asked too much too fast in %s; I'll ignore "
+                    "it for a few seconds." % (channel,))
+        self._silenced.discard(('user', user.lower()))
+        if channel is not None:
+            self._silenced.discard(('channel', channel.lower()))
+        self.allowed = self.allowed + 1
+        self.spent = self.spent + cost
+        return True
+
+    def _drop(self, kind, key, target, text):
+        self.dropped = self.dropped + 1
+        if (kind, key) not in self._silenced:
+            self._silenced.add((kind, key))
+            self.limited = self.limited + 1
+            self.notice(target, text)
+        return False
+
+    def __str__(self):
+        return ('%s lines allowed (%s tokens), %s dropped, %s times a user '
+                'or channel was limited' % (self.allowed, self.spent,
+                    self.dropped, self.limited))
@@ -8,9 +8,12 @@ from twisted.python import log
 
 from storm import locals as L
 
-from . import alias
+from simpleparse.error import ParserSyntaxError
+
+from . import alias, linesyntax, odds
 from .fs import fs
-from ..user import User
+from ..user import (User, aliasCacheFor, userMapFor, insertUsers,
+        undoable)
 from .interface import IMessageRecipient, ISessionResponse
 
 
@@ -123,6 +126,9 @@ class Session(object):
                                   # bindings when nicks are removed or added
         self.observers = set()
         self.isDefaultSession = isDefaultSession
+        self.aliasHooks = alias.AliasHooks()
+        self.memberNicks = {}     # case-folded nick => number of members
+        self.index = None         # the SessionIndex I'm in, if any
 
     __storm_loaded__ = __init__
 
@@ -160,6 +166,30 @@ class Session(object):
         """Greet the speaker."""
         return 'Hello %s.' % (actor.name,)
 
+    def respondTo_odds(self, request, actor, args):
+        """Chances of a dice roll: odds <dice> [vs <target>]"""
+        args = list(args)
+        target = None
+        if len(args) > 2 and args[-2].lower() == u'vs':
+            try:
+                target = int(args[-1])
+            except ValueError:
+                return u'** "%s" is not a number' % (args[-1],)
+            del args[-2:]
+        if not args:
+            return u'** Usage: .odds <dice> [vs <target>]'
+
+        text = u''.join(args)
+        try:
+            expression = linesyntax.parseDice(text)
+        except (RuntimeError, ParserSyntaxError):
+            return u'** "%s" is not a dice expression' % (text,)
+        found = odds.distribution(expression)
+        if found is None:
+            return u"** Sorry, I can't work out the odds for %s" % (text,)
+        dist, repeat = found
+        return odds.formatOdds(text, dist, repeat, target)
+
     def respondTo_aliases(self, request, actor, characters):
         """
         Show aliases for a character or for myself
@@ -192,7 +222,7 @@ class Session(object):
             character = actor
 
         removed = character.removeAlias(key)
-        if removed is not None:
+        if removed:
             return u"%s, removed your alias for %s" % (character.name, key)
         else:
             return u"** No alias \"%s\" for %s" % (key, character.name)
@@ -220,7 +250,43 @@ class Session(object):
     def matchNick(self, nick):
         """True if nick is part of this session."""
         assert type(nick) is unicode
-        return nick.lower() in map(unicode.lower, [n.name for n in self.subSessions])
+        return nick.lower() in self.memberNicks
+
+    def _addMembers(self, members):
+        """
+        Put members into subSessions, keeping memberNicks and my index up to
+        date
+        """
+        fresh = set(members) - self.subSessions
+        self.subSessions |= fresh
+        added = []
+        for m in fresh:
+            folded = m.name.lower()
+            n = self.memberNicks.get(folded, 0)
+            self.memberNicks[folded] = n + 1
+            if n == 0:
+                added.append(folded)
+        if added and self.index is not None:
+            self.index.nicksAdded(self, added)
+
+    def _removeMembers(self, members):
+        """
+        Take members out of subSessions, keeping memberNicks and my index up
+        to date
+        """
+        gone = set(members) & self.subSessions
+        self.subSessions -= gone
+        removed = []
+        for m in gone:
+            folded = m.name.lower()
+            n = self.memberNicks[folded] - 1
+            if n == 0:
+                del self.memberNicks[folded]
+                removed.append(folded)
+            else:
+                self.memberNicks[folded] = n
+        if removed and self.index is not None:
+            self.index.nicksRemoved(self, removed)
 
     def privateInteraction(self, request, *observers):
         # if user is one of self.observers, we don't want to send another
@@ -265,7 +331,8 @@ class Session(object):
                 formatted = alias.resolve(actor,    
                                           verbs,
                                           parsed_dice=vp.diceExpression,
-                                          temp_modifier=vp.dieModifier)
+                                          temp_modifier=vp.dieModifier,
+                                          hooks=self.aliasHooks)
                 assert type(formatted) in [unicode, type(None)], "formatted is %r" % (formatted,)
                 if formatted is not None:
                     strings.append(formatted)
@@ -275,7 +342,8 @@ class Session(object):
                                               verbs,
                                               parsed_dice=vp.diceExpression,
                                               temp_modifier=vp.dieModifier,
-                                              target=target)
+                                              target=target,
+                                              hooks=self.aliasHooks)
                     assert type(formatted) is unicode
                     if formatted is not None:
                         strings.append(formatted)
@@ -298,7 +366,8 @@ class Session(object):
         """
         Return an appropriate IMessageRecipient for the given name
         """
-        name = name.decode(self.encoding)
+        if isinstance(name, str):
+            name = name.decode(self.encoding)
         if name == self.name:
             ss = self
         elif name.startswith(u'#'):
@@ -321,14 +390,12 @@ class Session(object):
         was a nick hijacking and this person is possibly artificial
         """
         store = L.Store.of(self)
-        ret = store.find(User,
-                User.name.like(name, case_sensitive=False)).one()
+        ret = userMapFor(store).find(name)
         if ret is None:
             if createFlag:
                 ret = User()
                 ret.name = name
                 store.add(ret)
-                store.commit()
         if ret is None:
             raise MissingActor("Actor did not exist and was not created", name)
         return ret
@@ -354,7 +421,9 @@ class Session(object):
         actor = self._nameToUser(request.user)
 
         try:
-            response = m(request, actor, request.sentence.commandArgs)
+            # a command that fails undoes only what it did itself
+            response = undoable(L.Store.of(self), m, request, actor,
+                    request.sentence.commandArgs)
             if ISessionResponse.providedBy(response):
                 return response
             return Response(response, request)
@@ -365,8 +434,11 @@ class Session(object):
             from . import session as myself
             if getattr(myself, 'TESTING', True):
                 raise
-            text = u'** Sorry, %s: %s' % (request.user,
-                    e.decode(self.encoding))
+            try:
+                reason = unicode(e)
+            except UnicodeDecodeError:
+                reason = str(e).decode(self.encoding, 'replace')
+            text = u'** Sorry, %s: %s' % (request.user, reason)
             return Response(text, request)
 
     def getCommandMethod(self, command):
@@ -376,27 +448,32 @@ class Session(object):
     def addNick(self, *nicks):
         """
         Add a nick to the session list, and make sure that nick is known in
-        the database as a User object, too
+        the database as a User object, too.  However many nicks there are,
+        this is one query for the known ones, and a few INSERTs for the new.
         """
         assert [n for n in nicks if type(n) is unicode]
-        self.subSessions |= set(self._nameToRecipient(n) for n in nicks)
+        self._addMembers(self._nameToRecipient(n) for n in nicks)
         store = L.Store.of(self)
+        found = userMapFor(store).findMany(nicks)
+        users = found.values()
+        missing = []
         for nick in nicks:
-            user = L.Store.of(self).find(User, User.name.like(nick,
-                case_sensitive=False)).one()
-            if user is None:
-                u = User()
-                u.name = nick
-                store.add(u)
-        store.commit()
+            folded = nick.lower()
+            if folded not in found:
+                found[folded] = None
+                missing.append(nick)
+                users.append(self._nameToRecipient(nick))
+        insertUsers(store, missing)
+        # have their aliases ready before they start rolling
+        aliasCacheFor(store).warm(users)
         nicks = u', '.join(nicks)
         return self.reportNicks(u'Added %s' % (nicks,))
 
     def removeNick(self, *nicks):
         assert [n for n in nicks if type(n) is unicode]
-        self.subSessions -= set(self._nameToRecipient(n) for n in nicks)
-        # also update self.observers
         toRemove = [self._nameToRecipient(n) for n in nicks]
+        self._removeMembers(toRemove)
+        # also update self.observers
         self.observers -= set(toRemove)
         nicks = u', '.join(nicks)
         return self.reportNicks(u'Removed %s' % (nicks,))
@@ -410,17 +487,14 @@ class Session(object):
         assert type(old) is type(new) is unicode
 
         _new = self._nameToUser(new, True)
-        _old = self._nameToUser(old)
-
-        assert _old is not None, "strangely, attempting to remove user %r who does not exist" % (old,)
         assert _new is not None, "strangely, user %r did not exist and was not created" % (new,)
 
         store = L.Store.of(self)
-        store.remove(_old)
-        store.commit()
+        retireUser(store, old, new)
 
-        self.subSessions -= set((_old,))
-        self.subSessions |= set((_new,))
+        _old = self._nameToRecipient(old)
+        self._removeMembers([_old])
+        self._addMembers([_new])
         # also update self.observers
         if _old in self.observers:
             self.observers -= set((_old,))
@@ -428,3 +502,123 @@ class Session(object):
         # TODO - rename old's aliases so they work for new
         return self.reportNicks(u'%s renamed to %s' % (old, new))
 
+    def changeNicks(self, added=(), removed=(), renamed=()):
+        """
+        Make several membership changes at once: add the nicks in added,
+        remove the ones in removed, and for each (old, new) in renamed,
+        replace old with new.  The database users for renamed must already
+        have been dealt with; see retireUser.
+        """
+        transfers = []
+        for old, new in renamed:
+            if self._nameToRecipient(old) in self.observers:
+                transfers.append(new)
+        removed = list(removed) + [old for old, new in renamed]
+        added = list(added) + [new for old, new in renamed]
+        if removed:
+            self.removeNick(*removed)
+        if added:
+            self.addNick(*added)
+        self.observers |= set(self._nameToRecipient(n) for n in transfers)
+        return self.reportNicks(u'Added %s, removed %s' % (
+            u', '.join(added), u', '.join(removed)))
+
+
+def retireUser(store, old, new):
+    """
+    old is now called new, so remove the user named old, unless that is
+    also the user named new (only the case changed) or old is already gone.
+    Does not commit.
+    """
+    users = userMapFor(store)
+    _old = users.find(old)
+    if _old is None or old.lower() == new.lower():
+        return
+    aliasCacheFor(store).discard((_old.name, _old.network))
+    users.discard(_old)
+    store.remove(_old)
+
+
+class SessionIndex(object):
+    """
+    The sessions the bot is in, indexed for routing irc events: by channel
+    name, and by the case-folded nick of each member.
+
+    Sessions in the index tell it when their members change (see
+    Session.addNick, removeNick and rename), so finding where a nick is
+    costs the same with one channel or hundreds.
+    """
+    def __init__(self):
+        self.channels = {}   # session name => session
+        self.nicks = {}      # case-folded nick => set of sessions
+        self.encodings = {}  # encoding => number of sessions using it
+        self._order = {}     # session => when it was added
+        self._added = 0
+
+    def __contains__(self, ss):
+        return ss in self._order
+
+    def __len__(self):
+        return len(self._order)
+
+    def addSession(self, ss):
+        """
+        Index ss and the members it already has
+        """
+        if ss in self._order:
+            return
+        self._added = self._added + 1
+        self._order[ss] = self._added
+        self.channels[ss.name] = ss
+        self.encodings[ss.encoding] = self.encodings.get(ss.encoding, 0) + 1
+        ss.index = self
+        self.nicksAdded(ss, ss.memberNicks.keys())
+
+    def removeSession(self, ss):
+        """
+        Forget ss and its members
+        """
+        if ss not in self._order:
+            return
+        self.nicksRemoved(ss, ss.memberNicks.keys())
+        del self._order[ss]
+        del self.channels[ss.name]
+        n = self.encodings[ss.encoding] - 1
+        if n == 0:
+            del self.encodings[ss.encoding]
+        else:
+            self.encodings[ss.encoding] = n
+        ss.index = None
+
+    def nicksAdded(self, ss, folded):
+        for nick in folded:
+            self.nicks.setdefault(nick, set()).add(ss)
+
+    def nicksRemoved(self, ss, folded):
+        for nick in folded:
+            found = self.nicks.get(nick)
+            if found is None:
+                continue
+            found.discard(ss)
+            if not found:
+                del self.nicks[nick]
+
+    def find(self, name):
+        """
+        The sessions named name, or having name (a nick) as a member, in the
+        order they were added.  name is a byte string, decoded with the
+        encoding of each session it is compared to.
+        """
+        found = set()
+        for encoding in self.encodings:
+            try:
+                _name = name.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+            ss = self.channels.get(_name)
+            if ss is not None and ss.encoding == encoding:
+                found.add(ss)
+            for ss in self.nicks.get(_name.lower(), ()):
+                if ss.encoding == encoding:
+                    found.add(ss)
+        return sorted(found, key=self._order.get)
@@ -0,0 +1,147 @@
+"""
+Snapshots of an in-memory user database, saved to the database file.
+
+With the memory backend (see vellumbot.user.memoryDatabase) users, aliases
+and sessions live only in RAM, so handling a message never waits on the
+disk.  Every so often, and when the bot stops, the rows are copied out of
+the store in the database thread (if anything has changed since the last
+copy), and a worker thread writes the copy to a new sqlite file, syncs it
+to the disk and renames it over the old one.  The store goes on changing
+while the copy is written, and a crash loses the changes since the last
+snapshot, but never the last snapshot itself.
+"""
+import os
+import sqlite3
+
+from twisted.application import service
+from twisted.internet import defer, task, threads
+from twisted.python import log
+
+from vellumbot import user
+from vellumbot.usersql import SQL_SCRIPT
+
+
+def writeSnapshot(filename, tables):
+    """
+    Write tables (as from vellumbot.user.tableRows) to the sqlite database
+    filename, replacing it all at once when it's done
+    """
+    temp = filename + '.snapshot'
+    if os.path.exists(temp):
+        os.remove(temp)
+    connection = sqlite3.connect(temp)
+    try:
+        for sql in SQL_SCRIPT:
+            connection.execute(sql)
+        connection.execute('DELETE FROM session')
+        for (table, columns), rows in zip(user.TABLES, tables):
+            connection.executemany('INSERT INTO %s (%s) VALUES (%s)' % (table,
+                ', '.join(columns), ', '.join(['?'] * len(columns))), rows)
+        connection.commit()
+    finally:
+        connection.close()
+    # all of it must be on the disk before it replaces the last snapshot
+    f = open(temp, 'rb+')
+    try:
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(temp, filename)
+    if hasattr(os, 'O_DIRECTORY'):
+        # and so must the rename
+        directory = os.open(os.path.dirname(os.path.abspath(filename)),
+                os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+def totalChanges(store):
+    """
+    The number of rows changed in store since it was opened
+    """
+    return store.execute('SELECT total_changes()').get_one()[0]
+
+
+class Snapshots(service.Service):
+    """
+    Save the store of database (a vellumbot.server.database.Database) to
+    the sqlite file filename every interval seconds, if it has changed, and
+    when the service stops.  Start the database first.
+
+    The rows are copied as a unit of work in the database thread, in turn
+    with the bot's other work, so the copy is consistent and the reactor
+    doesn't wait for it.
+    """
+    def __init__(self, database, filename, interval=60, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.database = database
+        self.filename = filename
+        self.interval = interval
+        self.clock = clock
+        self.snapshots = 0    # snapshots written
+        self._saved = None    # totalChanges when the rows were copied last
+        self._lock = defer.DeferredLock()
+        self._loop = None
+
+    def startService(self):
+        service.Service.startService(self)
+        # what was loaded needn't be written back
+        def loaded(changes):
+            self._saved = changes
+        self.database.run(totalChanges, self.database.store
+                ).addCallback(loaded)
+        self._loop = task.LoopingCall(self._tick)
+        self._loop.clock = self.clock
+        self._loop.start(self.interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self._loop.stop()
+        # copy the rows now, before the database stops too; the copy is
+        # written once any snapshot still being written is done
+        copied = self.database.run(self._copy, self.database.store)
+        d = self._lock.run(lambda: copied.addCallback(self._write))
+        def stopped(result):
+            log.msg("Snapshots: %s written to %s" % (self.snapshots,
+                self.filename))
+            return result
+        return d.addCallback(stopped)
+
+    def _tick(self):
+        if not self._lock.locked:
+            self.snapshot().addErrback(log.err, "Error in snapshot")
+
+    def snapshot(self):
+        """
+        Copy the rows of the store, and write them to the file if they have
+        changed.  Returns a Deferred that fires when the file is written.
+        """
+        return self._lock.run(self._snapshot)
+
+    def _snapshot(self):
+        d = self.database.run(self._copy, self.database.store)
+        return d.addCallback(self._write)
+
+    def _copy(self, store):
+        """
+        (totalChanges, tableRows) of store, or None if nothing has changed
+        since the last copy.  Called in the database thread.
+        """
+        changes = totalChanges(store)
+        if changes == self._saved:
+            return None
+        return changes, user.tableRows(store)
+
+    def _write(self, copied):
+        if copied is None:
+            return
+        changes, tables = copied
+        d = threads.deferToThread(writeSnapshot, self.filename, tables)
+        def saved(_):
+            self._saved = changes
+            self.snapshots = self.snapshots + 1
+        return d.addCallback(saved)
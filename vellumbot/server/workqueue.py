@@ -0,0 +1,161 @@
+"""
+The lines the bot has been asked to answer, taken in turns.
+
+Answering a line means parsing it, working with the store, rolling dice
+and formatting the reply, and the lines of one busy channel shouldn't keep
+every other channel waiting.  So each line goes into a queue for the
+channel it was said in (or, in private, for the user who said it), and a
+cooperative task answers them a line at a time, taking the channels in
+turn, a few lines each reactor tick.  While a line is being answered in the
+database thread, the next waits; the reactor goes on talking to the server.
+
+Each queue holds a few lines; when a line arrives for a full queue, either
+it or the oldest line waiting is dropped.
+"""
+import collections
+
+from twisted.internet import defer, task
+from twisted.python import log
+
+
+# what to drop when a queue is full
+DROP_NEWEST = 'newest'
+DROP_OLDEST = 'oldest'
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST)
+
+
+class Dropped(Exception):
+    """
+    The work was dropped because its queue was full
+    """
+
+
+class WorkQueues(object):
+    """
+    A queue of at most maxQueued pieces of work for each key, done one at a
+    time, a piece from each key in turn, at most budget pieces each tick of
+    the reactor.  Work that returns a Deferred is finished when it fires.
+
+    When work is added to a full queue, overflow says whether the new work
+    (DROP_NEWEST) or the oldest waiting (DROP_OLDEST) is dropped.
+
+    done counts the work done, dropped the work dropped, and mostQueued is
+    the most work ever waiting for one key.
+    """
+    def __init__(self, maxQueued=20, budget=5, overflow=DROP_NEWEST,
+            clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        assert overflow in OVERFLOW_POLICIES, overflow
+        self.maxQueued = maxQueued
+        self.budget = budget
+        self.overflow = overflow
+        self.clock = clock
+        self.queues = {}        # key => deque of (Deferred, f, a, kw)
+        self.done = 0
+        self.dropped = 0
+        self.mostQueued = 0
+        self._turns = collections.deque()   # keys with work, in turn
+        self._task = None
+        self._cooperator = task.Cooperator(
+                terminationPredicateFactory=self._tickBudget,
+                scheduler=lambda tick: clock.callLater(0, tick))
+
+    def _tickBudget(self):
+        counted = [0]
+        def spent():
+            counted[0] = counted[0] + 1
+            return counted[0] >= self.budget
+        return spent
+
+    def add(self, key, f, *a, **kw):
+        """
+        Call f(*a, **kw) when key's turn comes.  Returns a Deferred that
+        fires with its result, or fails with Dropped, or with CancelledError
+        if the queues are stopped first.
+        """
+        d = defer.Deferred()
+        queue = self.queues.get(key, None)
+        if queue is None:
+            queue = self.queues[key] = collections.deque()
+            self._turns.append(key)
+        if len(queue) >= self.maxQueued:
+            self.dropped = self.dropped + 1
+            if self.overflow == DROP_NEWEST:
+                log.msg("Work queue for %s is full, dropping the newest" % (
+                    key,))
+                d.errback(Dropped(key))
+                return d
+            log.msg("Work queue for %s is full, dropping the oldest" % (
+                key,))
+            queue.popleft()[0].errback(Dropped(key))
+        queue.append((d, f, a, kw))
+        self.mostQueued = max(self.mostQueued, len(queue))
+        if self._task is None:
+            self._task = self._cooperator.cooperate(self._work())
+        return d
+
+    def __len__(self):
+        return sum([len(q) for q in self.queues.values()])
+
+    def _work(self):
+        while self._turns:
+            yield self._step()
+        self._task = None
+
+    def _step(self):
+        """
+        Do the next piece of work, returning a Deferred that fires when it
+        is finished
+        """
+        key = self._turns.popleft()
+        queue = self.queues[key]
+        work = queue.popleft()
+        if queue:
+            self._turns.append(key)
+        else:
+            del self.queues[key]
+        return self._do(work)
+
+    def _do(self, (d, f, a, kw)):
+        self.done = self.done + 1
+        finished = defer.maybeDeferred(f, *a, **kw)
+        # the caller gets the result; the task only waits for it
+        finished.chainDeferred(d)
+        return finished
+
+    def flush(self, keys=None):
+        """
+        Do the work waiting for each of keys (or for every key), now,
+        whatever the budget
+        """
+        if keys is None:
+            keys = list(self._turns)
+        for key in keys:
+            queue = self.queues.pop(key, None)
+            if queue is None:
+                continue
+            self._turns.remove(key)
+            while queue:
+                self._do(queue.popleft())
+        if not self._turns and self._task is not None:
+            self._task.stop()
+            self._task = None
+
+    def stop(self):
+        """
+        Forget the work waiting, failing its Deferreds with CancelledError
+        """
+        queues = self.queues.values()
+        self.queues = {}
+        self._turns.clear()
+        if self._task is not None:
+            self._task.stop()
+            self._task = None
+        for queue in queues:
+            for d, f, a, kw in queue:
+                d.errback(defer.CancelledError())
+
+    def __str__(self):
+        return ('%s done, %s waiting, %s dropped, most waiting for one key '
+                '%s' % (self.done, len(self), self.dropped, self.mostQueued))
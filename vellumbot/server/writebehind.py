@@ -0,0 +1,91 @@
+"""
+Group commit: the units of work of several messages share one commit.
+
+With a GroupCommit running, a finished unit of work is left uncommitted
+until the next commit, at most window seconds away, so that the units
+finishing after it go to the disk with it.  The price is that a crash
+loses the last window of changes.  A unit that fails undoes only itself,
+back to a savepoint, and the others still waiting with it are kept.
+"""
+from twisted.application import service
+from twisted.internet import task
+from twisted.python import log
+
+from vellumbot import user
+
+
+class GroupCommit(service.Service):
+    """
+    Commit the store of database (a vellumbot.server.database.Database)
+    every window seconds, or as soon as maxPending units of work are
+    waiting.  Everything waiting is committed when the service stops.
+
+    The commits are made in the database thread, like all other work with
+    the store.  Start the database first.
+    """
+    def __init__(self, database, window=0.2, maxPending=50, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.database = database
+        self.store = None
+        self.window = window
+        self.maxPending = maxPending
+        self.clock = clock
+        self.pending = 0      # units done but not committed
+        self.commits = 0      # commits made
+        self.units = 0        # units committed
+        self.lost = 0         # units rolled back after they were done
+        self._loop = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.store = self.database.store
+        user.setCommitter(self.store, self)
+        self._loop = task.LoopingCall(self._tick)
+        self._loop.clock = self.clock
+        self._loop.start(self.window, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self._loop.stop()
+        def stop():
+            user.setCommitter(self.store, None)
+            self.commit()
+            log.msg("Group commit: %s" % (self,))
+        return self.database.call(stop)
+
+    def _tick(self):
+        if self.pending:
+            self.database.call(self.commit).addErrback(log.err,
+                    "Error in group commit")
+
+    def unitDone(self):
+        self.pending = self.pending + 1
+        if self.pending >= self.maxPending:
+            self.commit()
+
+    def commit(self):
+        """
+        Commit everything waiting, now
+        """
+        if not self.pending:
+            return
+        self.store.commit()
+        self.commits = self.commits + 1
+        self.units = self.units + self.pending
+        self.pending = 0
+
+    def rolledBack(self):
+        if self.pending:
+            log.msg("Rolled back %s finished units of work waiting to be "
+                    "committed" % (self.pending,))
+        self.lost = self.lost + self.pending
+        self.pending = 0
+
+    def __str__(self):
+        if self.commits:
+            perCommit = float(self.units) / self.commits
+        else:
+            perCommit = 0.0
+        return '%s units in %s commits (%.1f per commit), %s lost' % (
+                self.units, self.commits, perCommit, self.lost)
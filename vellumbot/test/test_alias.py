@@ -1,5 +1,5 @@
 import unittest
-from ..server import alias
+from ..server import alias, session
 from .. import user
 from playtools import dice
 from playtools.parser import diceparser
@@ -142,10 +142,48 @@ class AliasTestCase(unittest.TestCase):
         self.assertEqual(res, [], 
                 "should not have called smackDownHook here but did")
 
-        # now register and do it again
-        alias.registerAliasHook((u'smack', u'down'), smackDownHook)
+        # now register with a session and do it again
+        ss = session.Session()
+        ss.aliasHooks.register((u'smack', u'down'), smackDownHook)
         _dontcare = alias.resolve(ne1, verbs, parsed_dice=_exp, 
-                temp_modifier=2, )
+                temp_modifier=2, hooks=ss.aliasHooks)
         self.assertEqual(res, [(u'testing alias hooks', 3)], 
                 "should have called smackDownHook here but did not")
 
+        # but not for rolls made in another session
+        _dontcare = alias.resolve(ne1, verbs, parsed_dice=_exp, 
+                temp_modifier=2, hooks=session.Session().aliasHooks)
+        self.assertEqual(len(res), 1)
+
+
+    def test_scopedHooks(self):
+        """
+        Hooks registered with an AliasHooks are called only for rolls made
+        with it, are timed, and don't keep their objects alive
+        """
+        class Tracker(object):
+            def __init__(self):
+                self.rolls = []
+
+            def track(self, user, rolled):
+                self.rolls.append(rolled[0].sum())
+
+        ne1 = user.User()
+        ne1.name = u'scoped'
+        self.store.add(ne1)
+        self.store.commit()
+        _exp = diceparser.parseDice('1d1')
+        verbs = (u'init',)
+
+        mine, theirs = alias.AliasHooks(), alias.AliasHooks()
+        t1, t2 = Tracker(), Tracker()
+        mine.register(verbs, t1.track)
+        theirs.register(verbs, t2.track)
+
+        alias.resolve(ne1, verbs, parsed_dice=_exp, hooks=mine)
+        self.assertEqual((t1.rolls, t2.rolls), ([1], []))
+        self.assertEqual(mine.timings[(verbs, 'track')][0], 1)
+
+        del t1
+        alias.resolve(ne1, verbs, parsed_dice=_exp, hooks=mine)
+        self.assertEqual(mine._hooks[verbs], [])
@@ -0,0 +1,40 @@
+"""
+Test rolling dice in bulk
+"""
+from twisted.trial import unittest
+
+from ..server import bulkdice, diceprogram
+
+
+class BulkDiceTestCase(unittest.TestCase):
+    def checkEngine(self, roll, sums):
+        rolled = roll(500, 6, 3)
+        self.assertEqual(len(rolled), 3)
+        for rolls in rolled:
+            self.assertEqual(len(rolls), 500)
+            self.assertEqual(set(rolls), set(range(1, 7)))
+            self.assertTrue(type(rolls[0]) in (int, long))
+        self.assertEqual(sums(10, 1, 4), [10, 10, 10, 10])
+
+    def test_python(self):
+        """
+        The pure Python engine rolls the right number and size of dice
+        """
+        self.checkEngine(bulkdice._rollPython, bulkdice._sumsPython)
+
+    def test_numpy(self):
+        """
+        The NumPy engine rolls the right number and size of dice
+        """
+        self.checkEngine(bulkdice._rollNumpy, bulkdice._sumsNumpy)
+
+    if bulkdice.nrandom is None:
+        test_numpy.skip = "NumPy is not installed"
+
+    def test_bigPool(self):
+        """
+        Compiled programs for big pools roll through the bulk engine
+        """
+        rolled = diceprogram.compileDice(u'200d1+5').roll(1)
+        self.assertEqual([r.sum() for r in rolled], [206])
+        self.assertEqual(len(rolled[0].format().split('+')), 202)
@@ -19,6 +19,8 @@ class TestD20Session(util.BotTestCase):
         geeEm = lambda *a, **kw: self.anyone('GeeEm', *a, **kw)
         player = lambda *a, **kw: self.anyone('Player', *a, **kw)
         self.addUser(u'GeeEm')
+        # check the matches one per line
+        self.vt.outbound.separator = None
 
         self.vt.userJoined("Player", "#testing")
 
@@ -31,28 +33,30 @@ class TestD20Session(util.BotTestCase):
 "cure moderate wounds": **Cure** Moderate Wounds Conjuration (H ... pell functions like **cure** light wounds , exce ... pt that it **cure**s 2d8 points of dama ... 
 "cure serious wounds": **Cure** Serious Wounds Conjuration (He ... pell functions like **cure** light wounds , exce ... pt that it **cure**s 3d8 points of dama ... '''.split('\n')
 
+        # each person's lines are sent together
         expectations1 = []
         for line in lines1:
             expectations1.append(('Player', '%s \(observed\)' % (re.escape(line),)))
-            expectations1.append(('GeeEm', '<Player>  \.lookup spell cure  ===>  %s' % (re.escape(line),)))
         expectations1.append(('Player', 
             r'Replied to Player with top 5 matches for SPELL "cure" \(observed\)'))
+        for line in lines1:
+            expectations1.append(('GeeEm', '<Player>  \.lookup spell cure  ===>  %s' % (re.escape(line),)))
         expectations1.append(('GeeEm', 
             r'<Player>  \.lookup spell cure  ===>  Replied to Player with top 5 matches for SPELL "cure"'))
 
         player('VellumTalk', '.lookup spell cure', *expectations1)
 
-        expectations2 = []
+        # the channel's line goes first
+        expectations2 = [('#testing', 
+            r'Replied to Player with top 5 matches for SPELL "cure"')]
         for line in lines1:
             expectations2.append(('Player', '%s' % (re.escape(line),)))
-        expectations2.append(('#testing', 
-            r'Replied to Player with top 5 matches for SPELL "cure"'))
 
         player('#testing', '.lookup spell cure', *expectations2)
 
-        # this spell goes over the 420 char limit.  rig it to make this test
+        # this spell goes over the line limit.  rig it to make this test
         # simpler
-        vellumbot.server.irc.MAX_LINE = 600
+        vellumbot.server.irc.MAX_LINE = 1000
         try:
             player('#testing', '.lookup spell cure serious wounds mass', (
                 '#testing', 
@@ -74,10 +78,9 @@ class TestD20Session(util.BotTestCase):
 "heal mount": Heal Mount Conjuration \(Healing\) Le \.\.\.
 "seed heal": Seed: Heal Conjuration \(Healing\) Sp \.\.\.
 "cure critical wounds": Cure Critical Wounds Conjuration \(H \.\.\.'''.split('\n')
-            expectations3 = []
+            expectations3 = [('#testing', 'Replied to Player with top 5 matches for SPELL "heal\*"')]
             for line in lines2:
                 expectations3.append(('Player', line))
-            expectations3.append(('#testing', 'Replied to Player with top 5 matches for SPELL "heal\*"'))
             player('#testing', '.lookup spell heal*', *expectations3)
 
             player('#testing', '.lookup monster mohrg', (
@@ -86,7 +89,7 @@ class TestD20Session(util.BotTestCase):
                 )
             )
         finally:
-            vellumbot.server.irc.MAX_LINE = 420 
+            vellumbot.server.irc.MAX_LINE = 510
 
     def test_lookupFeat(self):
         """
@@ -95,7 +98,9 @@ class TestD20Session(util.BotTestCase):
         geeEm = lambda *a, **kw: self.anyone('GeeEm', *a, **kw)
         self.addUser(u'GeeEm')
         benefit = "Benefit:  In melee, every time you miss because of concealment, you can reroll .*"
-        vellumbot.server.irc.MAX_LINE = 800
+        self.addCleanup(setattr, vellumbot.server.irc, 'MAX_LINE',
+                vellumbot.server.irc.MAX_LINE)
+        vellumbot.server.irc.MAX_LINE = 1000
         geeEm('#testing', '.lookup feat blindfight', (
             '#testing', 
             r'GeeEm: FEAT EXACT: \037Blind-Fight\037   ' + benefit,
@@ -103,8 +108,9 @@ class TestD20Session(util.BotTestCase):
         )
 
         # check the message for "top n matches"
-        expectations = (('GeeEm', r'.*'),)*5 # we don't care what the matches were for this test
-        expectations = expectations + (('#testing', r'Replied to GeeEm with top 5 matches for FEAT "weapon"'),)
+        self.vt.outbound.separator = None
+        expectations = (('#testing', r'Replied to GeeEm with top 5 matches for FEAT "weapon"'),)
+        expectations = expectations + (('GeeEm', r'.*'),)*5 # we don't care what the matches were for this test
 
         geeEm('#testing', '.lookup feat weapon', *expectations)
 
@@ -114,7 +120,9 @@ class TestD20Session(util.BotTestCase):
         """
         geeEm = lambda *a, **kw: self.anyone('GeeEm', *a, **kw)
         self.addUser(u'GeeEm')
-        vellumbot.server.irc.MAX_LINE = 600
+        self.addCleanup(setattr, vellumbot.server.irc, 'MAX_LINE',
+                vellumbot.server.irc.MAX_LINE)
+        vellumbot.server.irc.MAX_LINE = 1000
         geeEm('#testing', '.lookup skill concentration', (
             '#testing', 
             r'GeeEm: SKILL EXACT: \037Concentration\037   Key Ability: Con.*', 
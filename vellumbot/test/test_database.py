@@ -0,0 +1,68 @@
+"""
+Test the database thread
+"""
+import thread
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from vellumbot import user
+from vellumbot.server import database
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = database.Database(lambda: user.userDatabase('sqlite:'))
+        self.db.startService()
+
+    def tearDown(self):
+        return self.db.stopService()
+
+    def addUser(self, name):
+        u = user.User()
+        u.name = name
+        self.db.store.add(u)
+        return thread.get_ident()
+
+    def test_run(self):
+        """
+        Units of work are done in order, in a thread other than the
+        reactor's, and committed
+        """
+        d1 = self.db.run(self.addUser, u'one')
+        d2 = self.db.run(self.addUser, u'two')
+        def added(ident):
+            self.assertNotEqual(ident, thread.get_ident())
+            return self.db.call(lambda: [u.name for u in
+                self.db.store.find(user.User).order_by(user.User.name)])
+        d2.addCallback(added)
+        d2.addCallback(self.assertEqual, [u'one', u'two'])
+        return d1.addCallback(lambda _: d2)
+
+    def test_failure(self):
+        """
+        A unit of work that fails is rolled back, and its Deferred fails
+        """
+        def fail():
+            self.addUser(u'one')
+            raise ValueError()
+        d = self.assertFailure(self.db.run(fail), ValueError)
+        d.addCallback(lambda _: self.db.call(
+            lambda: self.db.store.find(user.User).count()))
+        return d.addCallback(self.assertEqual, 0)
+
+    def test_stopped(self):
+        """
+        Work asked for once the database is stopping is refused, not done in
+        the reactor thread; the work asked for before it is finished
+        """
+        d1 = self.db.run(self.addUser, u'one')
+        stopped = self.db.stopService()
+        d2 = self.assertFailure(self.db.call(lambda: None), database.Stopped)
+        d = defer.gatherResults([d1, stopped, d2])
+        def check(_):
+            self.assertIdentical(self.db.pool, None)
+            return self.assertFailure(self.db.run(self.addUser, u'two'),
+                    database.Stopped)
+        # tearDown stops it again, which does nothing
+        return d.addCallback(check)
@@ -0,0 +1,38 @@
+"""
+Test compiled dice programs
+"""
+from twisted.trial import unittest
+
+from ..server import diceprogram, linesyntax
+
+
+class DiceProgramTestCase(unittest.TestCase):
+    def test_interning(self):
+        """
+        Everyone rolling the same expression shares one program
+        """
+        p1 = diceprogram.compileDice(u'3d6+2')
+        self.assertTrue(p1 is diceprogram.compileDice(u'3d6+2'))
+        self.assertTrue(p1 is diceprogram.programFor(
+            linesyntax.parseDice(u'3d6+2')))
+
+    def test_roll(self):
+        """
+        Compiled programs roll the same results dice.roll would
+        """
+        p = diceprogram.compileDice(u'2d1+3x4')
+        self.assertNotEqual(p.roll, p._interpret)
+        rolled = p.roll(2)
+        self.assertEqual([r.sum() for r in rolled], [7, 7, 7, 7])
+        self.assertEqual(rolled[0].format(), p._interpret(2)[0].format())
+
+        for n in range(100):
+            [r] = diceprogram.compileDice(u'1d6').roll()
+            self.assertTrue(1 <= r.sum() <= 6)
+
+    def test_uncompiled(self):
+        """
+        Expressions the compiler doesn't handle are still rolled
+        """
+        [r] = diceprogram.compileDice(u'500').roll()
+        self.assertEqual(r.sum(), 500)
@@ -1,8 +1,10 @@
 import operator
 
 from twisted.test.proto_helpers import StringTransport
+from twisted.internet import defer, task
 
-from vellumbot.server import irc
+from vellumbot.server import irc, ratelimit, d20session
+from vellumbot.server.database import Database
 from vellumbot.user import User, userDatabase
 import vellumbot.server.session
 
@@ -40,13 +42,13 @@ class IRCTestCase(util.BotTestCase):
         geeEm('VellumTalk', '.aliases GeeEm', 
               ('GeeEm', r'Aliases for GeeEm:   init=20'))
         geeEm('VellumTalk', '.aliases GeeEm Player',   
-               ('GeeEm', 'Aliases for GeeEm:   init=20'), 
-               ('GeeEm', 'Aliases for Player:   \(none\)'))
+               ('GeeEm', 'Aliases for GeeEm:   init=20 \| '
+                   'Aliases for Player:   \(none\)'))
         geeEm('VellumTalk', '.unalias foobar', 
               ('GeeEm', r'\*\* No alias "foobar" for GeeEm'))
         geeEm('#testing',  'hello [argh 20] [foobar 30]', 
-              ('#testing', r'GeeEm, you rolled: argh 20 = \[20\]'),
-              ('#testing', r'GeeEm, you rolled: foobar 30 = \[30\]'))
+              ('#testing', r'GeeEm, you rolled: argh 20 = \[20\] \| '
+                  r'GeeEm, you rolled: foobar 30 = \[30\]'))
         geeEm('#testing',  '[argh +1]', 
               ('#testing', r'GeeEm, you rolled: argh \+1 = \[20\+1 = 21\]'))
         geeEm('#testing',  'I will [kill 20] them @all', 
@@ -56,6 +58,21 @@ class IRCTestCase(util.BotTestCase):
         geeEm('VellumTalk', '.aliases', 
               ('GeeEm', r'Aliases for GeeEm:   argh=20, foobar=30, kill=20'))
 
+    def test_odds(self):
+        """
+        The odds of a dice expression can be asked for
+        """
+        geeEm = lambda *a, **kw: self.anyone('GeeEm', *a, **kw)
+        ugm = self.addUser(u"GeeEm")
+
+        geeEm('#testing', '.odds 3d6 vs 18', ('#testing',
+            r'3d6: 3 to 18, average 10\.50, most likely 10 or 11 \(12\.50%\)\.  '
+            r'18 or better: 0\.46%'))
+        geeEm('#testing', '.odds 3d6 vs x', 
+            ('#testing', r'\*\* "x" is not a number'))
+        geeEm('#testing', '.odds', 
+            ('#testing', r'\*\* Usage: \.odds <dice> \[vs <target>\]'))
+
     def test_aliasesForMissing(self):
         """
         The bot does not barf when we try to access the aliases of an unknown
@@ -127,6 +144,92 @@ class IRCTestCase(util.BotTestCase):
         geeEm('VellumTalk', '.aliases grimlock1', 
               ('GeeEm', 'Aliases for grimlock1:   bitchslap=1000'))
 
+    def test_oneCommitPerMessage(self):
+        """
+        Everything a message does in the database is committed once, and
+        if it fails, none of it is kept
+        """
+        geeEm = lambda *a, **kw: self.anyone('GeeEm', *a, **kw)
+        self.addUser(u"GeeEm")
+        store = self.vt.store
+        commits = []
+        commit = store.commit
+        def countingCommit():
+            commits.append(1)
+            commit()
+        store.commit = countingCommit
+
+        geeEm('#testing', '*grimlock1 does a [smack down1 1000]',
+              ('#testing', 'grimlock1, you rolled: smack down1 1000 = \[1000\]'))
+        self.assertEqual(len(commits), 1)
+
+        def respondTo_boom(request, actor, args):
+            actor.setAlias((u'boom',), u'1d6')
+            raise ValueError("boom")
+        ss = self.vt.findSessions('#testing')[0]
+        ss.respondTo_boom = respondTo_boom
+        self.vt.privmsg('GeeEm!a@b', '#testing', '.boom')
+        self.vt.work.flush()
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(len(commits), 1)
+        gm = self.vt.store.find(User, User.name == u'GeeEm').one()
+        self.assertEqual(gm.getAlias((u'boom',)), None)
+
+    def test_inboundLimits(self):
+        """
+        Only lines the bot answers are charged to the user and channel, and
+        the bot says it's ignoring someone in a paced notice
+        """
+        self.vt.inbound = ratelimit.InboundLimiter(self.vt._limitNotice,
+                2, 0.0, 100, 0.0)
+        self.vt.userJoined("Player", "#testing")
+        for msg in ["ok, let's go", 'bob: roll 1d20', 'Bob, [1d20]',
+                'lol [']:
+            self.vt.privmsg('Player!a@b', '#testing', msg)
+        self.assertEqual(self.vt.inbound.allowed, 0)
+
+        for n in range(3):
+            self.vt.privmsg('Player!a@b', '#testing', '[1d20]')
+        self.assertEqual((self.vt.inbound.allowed, self.vt.inbound.dropped),
+                (2, 1))
+        # queued with everything else, not sent at once
+        self.assertFalse('NOTICE' in self.transport.value())
+        self.vt.work.flush()
+        self.vt.outbound.flush()
+        self.assertEqual([l for l in self.transport.value().splitlines()
+            if l.startswith('NOTICE')], ["NOTICE Player :Player: you're "
+                "asking too much too fast; I'll ignore you for a few "
+                "seconds."])
+
+    def test_threadedDatabase(self):
+        """
+        With a database thread, the bot still answers, from the reactor
+        """
+        db = Database(lambda: userDatabase('sqlite:'))
+        db.startService()
+        self.addCleanup(db.stopService)
+        transport = StringTransport()
+        vt = irc.VellumTalk()
+        self.addCleanup(vt.resetter.stop)
+        vt.factory = irc.VellumTalkFactory('#vellum')
+        vt.factory.database = db
+        vt.factory.serverEncoding = 'utf-8'
+        vt.performLogin = 0
+        vt.makeConnection(transport)
+        vt.responding = 1
+
+        def addUser():
+            u = User()
+            u.name = u'Player'
+            db.store.add(u)
+        d = vt.signedOn()
+        d.addCallback(lambda _: db.run(addUser))
+        d.addCallback(lambda _: vt.privmsg('Player!a@b', 'VellumTalk', '.hello'))
+        def answered(_):
+            self.assertEqual(transport.value().splitlines()[-1],
+                    'PRIVMSG Player :Hello Player.')
+        return d.addCallback(answered)
+
     def test_connectionMade(self):
         # set up a protocol instance similar to what we do in BotTestCase.setUp
         transport = StringTransport()
@@ -150,6 +253,21 @@ class IRCTestCase(util.BotTestCase):
         self.vt.signedOn()
         self.assertTrue(self.vt.defaultSession.isDefaultSession)
 
+    def test_signonFails(self):
+        """
+        If the default session can't be found on signon, the error is logged
+        and the bot disconnects instead of joining its channel
+        """
+        self.vt.store.find(d20session.D20Session,
+            d20session.D20Session.name == u'#@@default@@').remove()
+        self.vt.defaultSession = None
+        self.vt.factory = irc.VellumTalkFactory('#vellum')
+        self.transport.clear()
+        self.vt.signedOn()
+        self.assertEqual(len(self.flushLoggedErrors(AttributeError)), 1)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertFalse('JOIN' in self.transport.value())
+
     def test_botJoinLeave(self):
         """
         When the bot joins a channel, users in there are hooked up correctly.
@@ -161,9 +279,15 @@ class IRCTestCase(util.BotTestCase):
         self.assertEqual(_xyz.name, u'#xyz')
         self.assertEqual(self.vt.responding, 1)
 
-        # When IRC sends us some names, check that the box is aware of them.
+        # When IRC sends us some names, check that the box is aware of them
+        # once they have all arrived.
+        self.vt.irc_RPL_NAMREPLY('_ignored1_', ('_ignored2_', '_ignored3_', '#xyz', 
+            'Player1 @Player2'))
         self.vt.irc_RPL_NAMREPLY('_ignored1_', ('_ignored2_', '_ignored3_', '#xyz', 
-            'Player1 Player2 Player3'))
+            '+Player3'))
+        self.assertEqual(len(_xyz.subSessions), 0)
+        self.vt.irc_RPL_ENDOFNAMES('_ignored1_', ('_ignored2_', '#xyz',
+            'End of /NAMES list.'))
         subs = sorted(map(operator.attrgetter('name'), _xyz.subSessions))
         self.assertEqual(subs, [u'Player1', u'Player2', u'Player3'])
 
@@ -172,6 +296,37 @@ class IRCTestCase(util.BotTestCase):
         self.assertEqual(self.vt.findSessions(u'#xyz'),
                 [self.vt.defaultSession])
 
+    def test_namesWhileBusy(self):
+        """
+        The replies of a second NAMES, arriving before the database thread
+        has added the nicks of the first, are kept for their own ENDOFNAMES
+        """
+        self.vt.joined("#xyz")
+        _xyz = self.vt.findSessions(u'#xyz')[0]
+        queued = []
+        def later(f, *a, **kw):
+            d = defer.Deferred()
+            queued.append(lambda: d.callback(f(*a, **kw)))
+            return d
+        self.patch(self.vt.database, 'call', later)
+
+        names = lambda nicks: self.vt.irc_RPL_NAMREPLY('_ignored1_',
+                ('_ignored2_', '_ignored3_', '#xyz', nicks))
+        end = lambda: self.vt.irc_RPL_ENDOFNAMES('_ignored1_',
+                ('_ignored2_', '#xyz', 'End of /NAMES list.'))
+        names('Player1')
+        end()
+        names('@Player2')
+        self.assertEqual(self.vt._names['#xyz'][2], ['Player2'])
+        end()
+        self.assertEqual(len(queued), 2)
+        queued.pop(0)()
+        subs = sorted(map(operator.attrgetter('name'), _xyz.subSessions))
+        self.assertEqual(subs, [u'Player1'])
+        queued.pop(0)()
+        subs = sorted(map(operator.attrgetter('name'), _xyz.subSessions))
+        self.assertEqual(subs, [u'Player1', u'Player2'])
+
     def test_joinKickLeaveQuit(self):
         """
         When a user joins, I add them to a session.  When kicked, I remove them.
@@ -246,6 +401,110 @@ class IRCTestCase(util.BotTestCase):
         self.assertTrue(self.vt.store.find(User, 
             User.name==u'Player1').one() is not None)
 
+    def test_renameInTwoChannels(self):
+        """
+        A user in two of the bot's channels can change nicks
+        """
+        self.vt.joined("#testing1")
+        self.vt.joined("#testing2")
+        self.vt.userJoined("Player", "#testing1")
+        self.vt.userJoined("Player", "#testing2")
+        self.vt.userRenamed("Player", "Player1")
+        self.assertEqual(self.vt.findSessions("player1"),
+                self.vt.findSessions("#testing1") +
+                self.vt.findSessions("#testing2"))
+        self.assertEqual(self.vt.store.find(User,
+            User.name==u'Player').one(), None)
+
+    def test_sessionEncoding(self):
+        """
+        Nicks that quit or change are decoded with the encoding of each
+        session they're in
+        """
+        self.vt.joined("#latin")
+        latin = self.vt.findSessions("#latin")[0]
+        self.vt.sessionIndex.removeSession(latin)
+        latin.encoding = u'latin-1'
+        self.vt.sessionIndex.addSession(latin)
+        self.vt.userJoined("J\xf6rg", "#latin")
+        self.assertEqual([u.name for u in latin.subSessions], [u'J\xf6rg'])
+        self.vt.userRenamed("J\xf6rg", "J\xf6rg2")
+        self.assertEqual([u.name for u in latin.subSessions], [u'J\xf6rg2'])
+        self.vt.userQuit("J\xf6rg2", "bye")
+        self.assertEqual(list(latin.subSessions), [])
+
+    def test_lineThenRename(self):
+        """
+        A line said before a nick change is answered before the change is
+        made, as said by the old nick
+        """
+        testing = self.vt.findSessions("#testing")[0]
+        self.vt.userJoined("GeeEm", "#testing")
+        self.vt.privmsg('GeeEm!a@b', '#testing', '.gm')
+        self.vt.userRenamed("GeeEm", "GeeEm2")
+        self.vt.work.flush()
+        self.assertEqual([u.name for u in testing.observers], [u'GeeEm2'])
+        self.assertEqual(self.vt.store.find(User,
+            User.name==u'GeeEm').count(), 0)
+
+    def test_netsplit(self):
+        """
+        During a netsplit, joins, quits and renames are queued and applied
+        together on the next reactor tick
+        """
+        clock = task.Clock()
+        self.vt.membership.clock = clock
+        testing = self.vt.findSessions("#testing")[0]
+        self.vt.joined("#testing2")
+        testing2 = self.vt.findSessions("#testing2")[0]
+        for nick in 'Player', 'GeeEm', 'Other':
+            self.vt.userJoined(nick, "#testing")
+        self.vt.userJoined("Player", "#testing2")
+        self.anyone('GeeEm', '#testing', '.gm', ('#testing', r'GeeEm is now a GM'))
+
+        self.vt.userQuit("Player", "irc.example.net hub.example.org")
+        self.vt.userRenamed("GeeEm", "GeeEm_")
+        self.vt.userRenamed("GeeEm_", "GeeEm2")
+        self.vt.userJoined("Newbie", "#testing2")
+        self.vt.userQuit("Other", "irc.example.net hub.example.org")
+        self.vt.userJoined("Other", "#testing")
+        self.assertEqual(len(self.vt.membership.events), 6)
+        self.assertTrue(testing.matchNick(u'Player'))
+
+        clock.advance(0)
+        self.assertEqual(self.vt.membership.events, [])
+        self.assertEqual(sorted(u.name for u in testing.subSessions),
+                [u'GeeEm2', u'Other'])
+        self.assertEqual(sorted(u.name for u in testing2.subSessions),
+                [u'Newbie'])
+        self.assertEqual([u.name for u in testing.observers], [u'GeeEm2'])
+        self.assertEqual(self.vt.findSessions("geeem_"),
+                [self.vt.defaultSession])
+        self.assertEqual(self.vt.store.find(User,
+            User.name.is_in([u'GeeEm', u'GeeEm_'])).count(), 0)
+        self.assertEqual(self.vt.store.find(User,
+            User.name==u'GeeEm2').count(), 1)
+
+        # the burst lingers a while, then events are handled directly again
+        clock.advance(self.vt.membership.burstLinger + 1)
+        self.vt.userJoined("Player", "#testing")
+        self.assertTrue(testing.matchNick(u'Player'))
+
+    def test_joinFlood(self):
+        """
+        Many joins in one second are a burst too
+        """
+        clock = task.Clock()
+        self.vt.membership.clock = clock
+        rate = self.vt.membership.burstRate
+        for n in range(rate + 5):
+            self.vt.userJoined("Player%s" % (n,), "#testing")
+        testing = self.vt.findSessions("#testing")[0]
+        self.assertEqual(len(testing.subSessions), rate)
+        clock.advance(0)
+        self.assertEqual(len(testing.subSessions), rate + 5)
+        self.assertEqual(self.vt.membership.queued, 5)
+
     def test_observers(self):
         """
         Check that the gm gets the correct observer messages (including no
@@ -292,6 +551,33 @@ class IRCTestCase(util.BotTestCase):
            ('Superman', r'Superman, you rolled: stabtastic 23 = \[23\]')
            )
 
+    def test_coalesceObserved(self):
+        """
+        Several replies to one person go in one line, and observers get
+        theirs in one line too
+        """
+        player = lambda *a, **kw: self.anyone('Player', *a, **kw)
+        geeEm = lambda *a, **kw: self.anyone('GeeEm', *a, **kw)
+        self.addUser(u'Player')
+        self.addUser(u'GeeEm')
+        geeEm('#testing', '.gm', 
+              ('#testing', r'GeeEm is now a GM and will observe private messages for session #testing'))
+        self.vt.userJoined("Player", "#testing")
+
+        def respondTo_three(request, actor, args):
+            return vellumbot.server.session.ResponseGroup(*[
+                vellumbot.server.session.Response(u'match %s' % (n,), request)
+                for n in range(3)])
+        self.vt.defaultSession.respondTo_three = respondTo_three
+        player('VellumTalk', '.three',
+            ('Player', r'match 0 \(observed\) \| match 1 \(observed\) \| '
+                r'match 2 \(observed\)$'),
+            ('GeeEm', r'<Player>  \.three  ===>  match 0 \| '
+                r'<Player>  \.three  ===>  match 1 \| '
+                r'<Player>  \.three  ===>  match 2$'),
+            )
+        self.assertEqual(self.vt.outbound.coalesced, 4)
+
     def test_nickOrderSensitive(self):
         """
         Observer/observee order is respected (fixed a bug)
@@ -341,15 +627,45 @@ class IRCTestCase(util.BotTestCase):
         nick = ''.join(["%dBilly"%(n%10) for n in range(80)])
         message = "Hello %s" % (nick,) + "."
 
+        width = self.vt.lineBudget(nick)
+        self.assertEqual(width, irc.MIN_LINE)
         lines = []
-        for n in range((len(nick)/irc.MAX_LINE) + 1):
-            lines.append((nick, message[n*irc.MAX_LINE:(n+1)*irc.MAX_LINE]+r'$'))
+        for n in range((len(message) / width) + 1):
+            lines.append((nick, message[n*width:(n+1)*width]+r'$'))
 
         veryLongNick = lambda *a, **kw: self.anyone(nick, *a, **kw)
         self.addUser(nick.decode('utf-8'))
 
         veryLongNick("VellumTalk", ".hello", *lines)
 
+    def test_lineBudget(self):
+        """
+        The text of a line is as long as the server allows, given the bot's
+        nick!user@host, once the server has said what that is
+        """
+        prefix = ':VellumTalk!%s PRIVMSG #testing :' % (irc.UNKNOWN_USERHOST,)
+        self.assertEqual(self.vt.lineBudget('#testing'), 510 - len(prefix))
+        self.vt.irc_JOIN('VellumTalk!~vt@example.org', ['#other'])
+        self.assertEqual(self.vt.lineBudget('#testing'),
+                510 - len(':VellumTalk!~vt@example.org PRIVMSG #testing :'))
+        self.assertEqual(self.vt.lineBudget('GeeEm'),
+                self.vt.lineBudget('#testing') + 3)
+
+        # nothing is lost or mangled splitting a long reply
+        text = u' '.join([u'\xe9p\xe9e%s' % (n,) for n in range(200)])
+        self.transport.clear()
+        self.vt._sendMessages([('#testing', text.encode('utf-8'),
+            irc.outbound.CHANNEL)])
+        self.vt.outbound.flush()
+        sent = self.transport.value().splitlines()
+        for line in sent:
+            # as the server relays it, the line is full, but not too full
+            relayed = len(':VellumTalk!~vt@example.org ' + line)
+            self.assertTrue(500 < relayed <= 510 or line is sent[-1],
+                    relayed)
+        self.assertEqual(u' '.join([l.split(' :', 1)[1].decode('utf-8')
+            for l in sent]), text)
+
     def test_splitTextIRCWise(self):
         """
         Test the function that breaks irc lines up
@@ -380,3 +696,9 @@ class IRCTestCase(util.BotTestCase):
         r4 = irc.splitTextIRCWise(s_unbreakable2, 72)
         self.assertEqual(r4, s4_lines)
 
+        # UTF-8 characters aren't split, even in a word too long for a line
+        s_utf8 = (u'\xe9' * 10).encode('utf-8')
+        self.assertEqual(irc.splitTextIRCWise(s_utf8, 5),
+                [(u'\xe9' * 2).encode('utf-8')] * 5)
+        self.assertEqual(irc.splitTextIRCWise('a\n\nb  \n', 72), ['a', 'b'])
+
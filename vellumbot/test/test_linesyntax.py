@@ -109,3 +109,84 @@ class LinesyntaxTestCase(unittest.TestCase):
                                                 "[cast][fireball] to @grimlock1 and @grimlock2.")
         #
 
+
+    def test_productionsCompiledOnce(self):
+        """
+        Each root production is compiled once and its processor is reused,
+        without leaking state from one parse into the next
+        """
+        prod = linesyntax.getProduction("verbPhraseRoot")
+        self.assertTrue(prod is linesyntax.getProduction("verbPhraseRoot"))
+
+        vp1 = linesyntax.parseVerbPhrase("[woo +2]")
+        vp2 = linesyntax.parseVerbPhrase("[1d20+1]")
+        self.assertFalse(vp1 is vp2)
+        self.assertEqual(str(vp1), 'woo +2')
+        self.assertEqual(vp2.nonDiceWords, None)
+        self.assertEqual(vp2.dieModifier, None)
+
+    def test_parseCache(self):
+        """
+        Repeated verb phrases and dice expressions come from the caches,
+        the phrases frozen and the expressions copied, so nobody can change
+        them for everyone else
+        """
+        vpc = linesyntax.verbPhraseCache
+        hits = vpc.hits
+        vp1 = linesyntax.parseVerbPhrase("[smack   down 1d20+2]")
+        vp2 = linesyntax.parseVerbPhrase("[smack\tdown 1d20+2]")
+        self.assertTrue(vp1 is vp2)
+        self.assertEqual(vpc.hits, hits + 1)
+        self.assertRaises(AttributeError, setattr, vp1, 'dieModifier', 3)
+        self.assertEqual(str(vp1), 'smack down d20+2')
+
+        d1 = linesyntax.parseDice('3d6+2')
+        d1.dieModifier = 5
+        hits = linesyntax.diceCache.hits
+        d2 = linesyntax.parseDice('3d6+2')
+        self.assertEqual(linesyntax.diceCache.hits, hits + 1)
+        self.assertFalse(d1 is d2)
+        self.assertEqual(d2.format(), '3d6+2')
+
+    def test_scanSentence(self):
+        """
+        Actors, bracketed verb candidates and targets are all found in one
+        scan, including an unclosed bracket that swallows the rest
+        """
+        scan = linesyntax.scanSentence
+        self.assertEqual(scan(u"*ninja [attack @x] @shara [cast"),
+                ([u'ninja'], [u'[attack @x]'], [u'x', u'shara']))
+        self.assertEqual(scan(u"[a [b] c] **d @ @e1_"),
+                ([u'd'], [u'[a [b]'], [u'e1_']))
+        self.assertEqual(scan(u"nothing here"), ([], [], []))
+
+    def test_splitArgs(self):
+        """
+        Command arguments are split like shlex.split would split them
+        """
+        split = linesyntax.splitArgs
+        self.assertEqual(split(u"  bob   bob "), [u'bob', u'bob'])
+        self.assertEqual(split(u""), [])
+        self.assertEqual(split(u"'do obly' doo"), [u'do obly', u'doo'])
+        self.assertEqual(split(u'a"b c"d \\\\ e\\ f ""'),
+                [u'ab cd', u'\\', u'e f', u''])
+        self.assertEqual(split(u'"a\\"b\\c"'), [u'a"b\\c'])
+        self.assertRaises(ValueError, split, u"q'r")
+        self.assertRaises(ValueError, split, u"trailing\\")
+
+    def test_classifier(self):
+        """
+        Lines that cannot be commands or contain verb phrases are dismissed
+        before parsing, and counted
+        """
+        c = linesyntax.LineClassifier()
+        for line in [u"lalala", u"*woop1", u"testbot n", u"tesTBotfoo",
+                u"just chatting here", u"I think @shara is a *ninja"]:
+            self.assertFalse(c.mightBeSyntax(line), line)
+        self.assertEqual(c.hits, 6)
+
+        for line in [u".gm", u"  .hello", u"TestBot, n", u"VellumBot:foo",
+                u"I [attack 1d6+1] @grimlock1", u"[foo", u"n: o p. q'r"]:
+            self.assertTrue(c.mightBeSyntax(line), line)
+        self.assertEqual(c.misses, 7)
+        self.assertEqual(c.hitRate(), 6/13.)
@@ -0,0 +1,47 @@
+"""
+Test the LRU cache
+"""
+from twisted.trial import unittest
+
+from ..util import lru
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_eviction(self):
+        """
+        The least recently used item is the one discarded when the cache is
+        full, and lookups are counted
+        """
+        c = lru.LRUCache(2)
+        c['a'] = 1
+        c['b'] = 2
+        self.assertEqual(c.get('a'), 1)
+        c['c'] = 3
+        self.assertFalse('b' in c)
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual(c.get('c'), 3)
+        self.assertEqual(len(c), 2)
+        self.assertEqual((c.hits, c.misses), (2, 1))
+        self.assertEqual(c.hitRate(), 2/3.)
+
+        c['a'] = 10
+        c['d'] = 4
+        self.assertEqual(c.get('a'), 10)
+        self.assertFalse('c' in c)
+
+    def test_resize(self):
+        """
+        Shrinking the cache discards the oldest items
+        """
+        c = lru.LRUCache(3)
+        for n, k in enumerate('abc'):
+            c[k] = n
+        c.resize(1)
+        self.assertEqual(len(c), 1)
+        self.assertTrue('c' in c)
+        self.assertEqual(c.pop('c'), 2)
+        self.assertEqual(c.pop('c', 'gone'), 'gone')
+        c['c'] = 2
+        c.clear()
+        self.assertEqual(len(c), 0)
+        c['z'] = 26
+        self.assertEqual(c.get('z'), 26)
@@ -0,0 +1,90 @@
+"""
+Test exact dice odds
+"""
+from __future__ import division
+
+from twisted.trial import unittest
+
+from ..server import odds, linesyntax
+
+
+class OddsTestCase(unittest.TestCase):
+    def test_pool(self):
+        """
+        Pools are the exact distribution of the sum of their dice, and are
+        cached
+        """
+        d = odds.pool(3, 6)
+        self.assertEqual((d.lowest, d.highest(), d.total), (3, 18, 216))
+        self.assertEqual(d.ways[:4], [1, 3, 6, 10])
+        self.assertEqual(d.probability(10), 27 / 216)
+        self.assertEqual(d.atLeast(18), 1 / 216)
+        self.assertEqual(d.atLeast(-5), 1.0)
+        self.assertEqual(d.mean(), 10.5)
+        self.assertEqual(d.mostLikely(), [10, 11])
+        self.assertTrue(d is odds.pool(3, 6))
+
+        big = odds.pool(40, 6)
+        self.assertEqual(big.total, 6 ** 40)
+        self.assertEqual(big.mean(), 140)
+
+    def test_distribution(self):
+        """
+        Parsed expressions, including constants, get distributions
+        """
+        dist, repeat = odds.distribution(linesyntax.parseDice(u'1d20+5x3'))
+        self.assertEqual((dist.lowest, dist.highest(), repeat), (6, 25, 3))
+        self.assertEqual(dist.atLeast(16), 0.5)
+
+        dist, repeat = odds.distribution(linesyntax.parseDice(u'500'))
+        self.assertEqual((dist.lowest, dist.highest()), (500, 500))
+
+        self.assertEqual(odds.distribution(linesyntax.parseDice(u'1000d6')),
+                None)
+
+    def test_keptPool(self):
+        """
+        Pools that keep their highest or lowest dice have exact
+        distributions, and are cached
+        """
+        d = odds.keptPool(4, 6, 3)
+        self.assertEqual((d.lowest, d.highest(), d.total), (3, 18, 6 ** 4))
+        self.assertEqual(d.ways[:3], [1, 4, 10])
+        self.assertEqual(d.ways[-1], 21)
+        self.assertTrue(d is odds.keptPool(4, 6, 3))
+
+        d = odds.keptPool(2, 20, 1, highest=False)
+        self.assertEqual((d.lowest, d.highest(), d.total), (1, 20, 400))
+        self.assertEqual(d.ways[0], 39)
+        self.assertEqual(d.ways[-1], 1)
+
+        # keeping every die is the same as the plain pool
+        self.assertEqual(odds.keptPool(3, 6, 3).ways, odds.pool(3, 6).ways)
+
+    def test_keptDistribution(self):
+        """
+        Filtered expressions get distributions, unless the pool is too big
+        """
+        dist, repeat = odds.distribution(linesyntax.parseDice(u'4d6h3'))
+        self.assertEqual((dist.lowest, dist.highest(), repeat), (3, 18, 1))
+        self.assertEqual(dist.probability(18), 21 / 1296)
+
+        dist, repeat = odds.distribution(linesyntax.parseDice(u'2d20l1'))
+        self.assertEqual((dist.lowest, dist.highest()), (1, 20))
+        self.assertEqual(dist.atLeast(20), 1 / 400)
+
+        self.assertEqual(odds.steps(linesyntax.parseDice(u'200d20h50')), None)
+        self.assertEqual(
+            odds.distribution(linesyntax.parseDice(u'200d20h50')), None)
+
+    def test_formatOdds(self):
+        """
+        Odds are reported with the chance of meeting a target
+        """
+        dist = odds.pool(1, 20).shifted(5)
+        self.assertEqual(odds.formatOdds(u'1d20+5', dist, 1, 16),
+            u'1d20+5: 6 to 25, average 15.50, most likely 6-25 (5.00%).  '
+            u'16 or better: 50.00%')
+        self.assertEqual(odds.formatOdds(u'2d6', odds.pool(2, 6), 2),
+            u'2d6: 2 to 12, average 7.00, most likely 7 (16.67%) on each of '
+            u'2 rolls')
@@ -0,0 +1,130 @@
+"""
+Test the pacing of lines sent
+"""
+from twisted.trial import unittest
+from twisted.internet import task
+
+from vellumbot.server import outbound
+
+
+class OutboundQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.queue = outbound.OutboundQueue(
+                lambda target, line: self.sent.append((target, line)),
+                1.0, 3, lambda target: 20, None, self.clock)
+
+    def test_rate(self):
+        """
+        burst lines go at once, and then one every interval
+        """
+        for n in range(5):
+            self.queue.queue('#testing', str(n), outbound.CHANNEL)
+        self.assertEqual(self.sent, [])
+        self.clock.advance(0)
+        self.assertEqual([l for t, l in self.sent], ['0', '1', '2'])
+        self.assertEqual(self.queue.depths(), [2, 0, 0])
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.sent), 3)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.sent), 4)
+        self.clock.advance(1.0)
+        self.assertEqual(len(self.sent), 5)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        # the bucket fills up again while idle
+        self.clock.advance(10)
+        for n in range(4):
+            self.queue.queue('#testing', str(n), outbound.CHANNEL)
+        self.clock.advance(0)
+        self.assertEqual(len(self.sent), 8)
+        self.assertEqual(self.queue.sent, [8, 0, 0])
+        self.assertEqual(self.queue.depths(), [1, 0, 0])
+        self.assertEqual(self.queue.longestWait[outbound.CHANNEL], 2.0)
+        self.assertEqual(self.queue.mostQueued, 5)
+
+    def test_lanes(self):
+        """
+        Waiting channel lines are sent before private ones, and private ones
+        before bulk
+        """
+        for n in range(4):
+            self.queue.queue('GeeEm', 'help %s' % (n,), outbound.BULK)
+        self.clock.advance(0)
+        self.queue.queue('GeeEm', 'lookup', outbound.PRIVATE)
+        self.queue.queue('#testing', 'dice', outbound.CHANNEL)
+        self.clock.advance(0)
+        self.clock.advance(1)
+        self.clock.advance(1)
+        self.clock.advance(1)
+        self.assertEqual([l for t, l in self.sent[3:]], ['dice', 'lookup',
+            'help 3'])
+
+    def test_flush(self):
+        """
+        flush sends everything, and stop forgets everything
+        """
+        for n in range(5):
+            self.queue.queue('#testing', str(n))
+        self.queue.flush()
+        self.assertEqual(len(self.sent), 5)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.queue.queue('#testing', 'x')
+        self.clock.advance(0)
+        self.queue.queue('#testing', 'y')
+        self.queue.stop()
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_coalesce(self):
+        """
+        Lines for one target queued in the same turn are joined where they
+        fit, as are lines joining one still waiting
+        """
+        self.queue.separator = ' | '
+        for n in range(4):
+            self.queue.queue('GeeEm', 'geeem %s' % (n,))
+            self.queue.queue('Player', 'player %s' % (n,))
+        self.queue.queue('GeeEm', 'x' * 20)
+        self.clock.advance(0)
+        self.assertEqual(self.sent, [
+            ('GeeEm', 'geeem 0 | geeem 1'),
+            ('GeeEm', 'geeem 2 | geeem 3'),
+            ('GeeEm', 'x' * 20),
+            ])
+        self.assertEqual(self.queue.coalesced, 4)
+
+        self.queue.queue('Player', 'player 4')
+        self.clock.advance(0)
+        self.clock.advance(1)
+        self.clock.advance(1)
+        self.assertEqual(self.sent[3:], [
+            ('Player', 'player 0 | player 1'),
+            ('Player', 'player 2 | player 3'),
+            ])
+        self.clock.advance(1)
+        self.assertEqual(self.sent[5:], [('Player', 'player 4')])
+        self.assertEqual(self.queue.coalesced, 4)
+
+        self.assertEqual(outbound.coalesce(['a', 'b', 'c'], '/', 3),
+                ['a/b', 'c'])
+
+    def test_notices(self):
+        """
+        Notices are paced with everything else, sent with notice, and never
+        joined with other lines
+        """
+        notices = []
+        self.queue.notice = lambda target, line: notices.append(
+                (target, line))
+        self.queue.separator = ' | '
+        self.queue.queue('Player', 'a')
+        self.queue.queue('Player', 'slow down', notice=True)
+        self.queue.queue('Player', 'b')
+        self.queue.queue('Player', 'really', notice=True)
+        self.clock.advance(0)
+        self.assertEqual(self.sent, [('Player', 'a | b')])
+        self.assertEqual(notices, [('Player', 'slow down'),
+            ('Player', 'really')])
+        self.assertEqual(self.queue.sent, [0, 3, 0])
@@ -0,0 +1,112 @@
+"""
+Test the limits on what users and channels can ask of the bot
+"""
+from twisted.trial import unittest
+from twisted.internet import task
+
+from vellumbot.server import ratelimit
+
+
+class CostTestCase(unittest.TestCase):
+    def cost(self, msg):
+        return ratelimit.cost(msg, 'VellumTalk')
+
+    def test_cost(self):
+        """
+        Most lines cost 1, but commands, many verbs and targets, and huge
+        dice pools cost more
+        """
+        self.assertEqual(self.cost('[1d20+2]'), 1)
+        self.assertEqual(self.cost('.roll 1d20'), 1)
+        self.assertEqual(self.cost('vellumtalk: roll 1d20'), 1)
+        self.assertEqual(self.cost('.lookup spell fireball'), 5)
+        self.assertEqual(self.cost('.HELP'), 3)
+        self.assertEqual(self.cost('.odds 1d20+3 vs 15'), 2)
+        # the odds of a big pool take more work
+        self.assertEqual(self.cost('.odds 100d10'), 10)
+        self.assertEqual(self.cost('.odds 4d6h3'), 2)
+        self.assertEqual(self.cost('.odds'), 2)
+        self.assertEqual(self.cost('[1d20] [1d6] @foo @bar @baz'), 6)
+        self.assertEqual(self.cost('[300d6]'), 4)
+        self.assertEqual(self.cost('[50d6x4]'), 3)
+
+    def test_notForMe(self):
+        """
+        Lines the bot won't answer cost nothing: chatter, commands for
+        someone else, and lines without a real verb phrase
+        """
+        for msg in ['ok, let\'s go', 'bob: roll 1d20', 'Bob, [1d20]',
+                '.', '. ', 'lol [', '[] [ ]', '*a *b [1d20]']:
+            self.assertEqual(self.cost(msg), 0, msg)
+        self.assertEqual(self.cost('see [here] [1d20]!'), 2)
+
+
+class InboundLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.notices = []
+        self.limiter = ratelimit.InboundLimiter(
+                lambda target, text: self.notices.append(target),
+                5, 1.0, 8, 1.0, self.clock)
+
+    def test_user(self):
+        """
+        A user gets burst tokens, and then rate a second; they're told once
+        when they start being ignored
+        """
+        allow = self.limiter.allow
+        self.failUnless(allow('Bob', '#x', 3))
+        self.failUnless(allow('bob', '#x', 2))
+        self.failIf(allow('Bob', '#x', 1))
+        self.failIf(allow('Bob', '#x', 1))
+        self.assertEqual(self.notices, ['Bob'])
+        # others aren't affected
+        self.failUnless(allow('Alice', '#x', 1))
+        self.clock.advance(1)
+        self.failUnless(allow('Bob', '#x', 1))
+        self.failIf(allow('Bob', '#x', 1))
+        self.assertEqual(self.notices, ['Bob', 'Bob'])
+        self.assertEqual((self.limiter.allowed, self.limiter.dropped,
+            self.limiter.spent, self.limiter.limited), (4, 3, 7, 2))
+
+    def test_channel(self):
+        """
+        A channel has its own bucket, and a user denied by it keeps their
+        tokens; private messages only cost the user
+        """
+        allow = self.limiter.allow
+        for who in ['a', 'b', 'c', 'd']:
+            self.failUnless(allow(who, '#x', 2))
+        self.failIf(allow('e', '#X', 1))
+        self.failIf(allow('f', '#x', 1))
+        self.assertEqual(self.notices, ['#X'])
+        self.failUnless(allow('e', None, 5))
+
+    def test_free(self):
+        """
+        Lines that cost nothing are neither limited nor counted
+        """
+        for n in range(20):
+            self.failUnless(self.limiter.allow('Bob', '#x', 0))
+        self.assertEqual((self.limiter.allowed, self.limiter.users.buckets,
+            self.limiter.channels.buckets), (0, {}, {}))
+
+    def test_tooExpensive(self):
+        """
+        A line costing more than a full bucket costs a full bucket
+        """
+        self.failUnless(self.limiter.allow('Bob', None, 50))
+        self.failIf(self.limiter.allow('Bob', None, 1))
+
+    def test_sweep(self):
+        """
+        Buckets are forgotten once they've filled up
+        """
+        self.limiter.allow('Bob', '#x', 5)
+        self.limiter.allow('Alice', '#x', 1)
+        self.clock.advance(2)
+        self.limiter.users.sweep()
+        self.assertEqual(self.limiter.users.buckets.keys(), ['bob'])
+        self.clock.advance(3)
+        self.limiter.users.sweep()
+        self.assertEqual(self.limiter.users.buckets, {})
@@ -1,8 +1,9 @@
 
 from twisted.trial import unittest
+from twisted.internet import task
 
 from ..server.irc import Request
-from ..server import session
+from ..server import session, writebehind
 from . import util
 from .. import user
 
@@ -135,4 +136,98 @@ class ResponseGroupTestCase(unittest.TestCase, UserAddingTestMixin):
 
 
 class SessionTestCase(util.BotTestCase):
-    pass
+    def test_failedCommand(self):
+        """
+        Outside of tests, a command that fails gets an apology, and undoes
+        only what it did, not the units of work waiting for a group commit
+        """
+        self.addCleanup(setattr, session, 'TESTING', True)
+        session.TESTING = False
+        clock = task.Clock()
+        gc = writebehind.GroupCommit(self.vt.database, 0.2, 50, clock)
+        gc.startService()
+        self.addCleanup(gc.stopService)
+        store = self.vt.store
+
+        def addUser(name):
+            u = user.User()
+            u.name = name
+            store.add(u)
+        def fail(self, request, actor, args):
+            addUser(u'Doomed')
+            raise ValueError(u'no such luck')
+        self.patch(session.Session, 'respondTo_hello', fail)
+
+        self.vt.userJoined('GeeEm', '#testing')
+        user.unitOfWork(store, addUser, u'Waiting')
+        self.anyone('GeeEm', '#testing', '.hello',
+                ('#testing', r'\*\* Sorry, GeeEm: no such luck'))
+        self.assertEqual((gc.commits, gc.lost), (0, 0))
+        clock.advance(0.2)
+        store.rollback()
+        names = set(store.find(user.User).values(user.User.name))
+        self.assertIn(u'Waiting', names)
+        self.assertIn(u'GeeEm', names)
+        self.assertNotIn(u'Doomed', names)
+
+
+class SessionIndexTestCase(unittest.TestCase, UserAddingTestMixin):
+    """
+    Sessions can be found by channel name or member nick
+    """
+    def setUp(self):
+        UserAddingTestMixin.setUp(self)
+        self.index = session.SessionIndex()
+
+    def makeSession(self, name):
+        ss = session.Session()
+        ss.name = name
+        self.store.add(ss)
+        return ss
+
+    def test_find(self):
+        """
+        Membership changes keep the index up to date, whatever the case of
+        the nick
+        """
+        one = self.makeSession(u'#one')
+        two = self.makeSession(u'#two')
+        one.addNick(u'Player')
+        self.index.addSession(one)
+        self.index.addSession(two)
+        self.assertEqual(self.index.find('#two'), [two])
+        self.assertEqual(self.index.find('player'), [one])
+
+        two.addNick(u'PLAYER', u'GeeEm')
+        self.assertEqual(self.index.find('Player'), [one, two])
+        self.assertTrue(two.matchNick(u'geeem'))
+
+        one.rename(u'Player', u'Superman')
+        self.assertEqual(self.index.find('Player'), [two])
+        self.assertEqual(self.index.find('superman'), [one])
+
+        two.removeNick(u'GeeEm')
+        self.assertEqual(self.index.find('GeeEm'), [])
+        self.assertFalse(two.matchNick(u'GeeEm'))
+
+        self.index.removeSession(one)
+        self.assertEqual(self.index.find('#one'), [])
+        self.assertEqual(self.index.find('Superman'), [])
+        self.assertIdentical(one.index, None)
+        self.assertEqual(len(self.index), 1)
+
+    def test_addManyNicks(self):
+        """
+        A channel full of nicks, some already known in another case, are
+        all added as members and users
+        """
+        ss = self.makeSession(u'#big')
+        known = self.addUser(u'Player7')
+        nicks = [u'Player%s' % (n,) for n in range(600)]
+        nicks[7] = u'PLAYER7'
+        ss.addNick(*nicks)
+        self.assertEqual(len(ss.subSessions), 600)
+        self.assertEqual(self.store.find(user.User).count(), 600)
+        self.assertTrue(user.userMapFor(self.store).find(u'player7') is known)
+        self.assertEqual(user.userMapFor(self.store).find(u'player599').name,
+                u'Player599')
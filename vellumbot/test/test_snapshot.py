@@ -0,0 +1,156 @@
+"""
+Test the in-memory user database and its snapshots
+"""
+import sqlite3
+import threading
+
+from twisted.trial import unittest
+from twisted.internet import defer, task, threads
+
+from vellumbot import user
+from vellumbot.usersql import SQL_SCRIPT
+from vellumbot.server import snapshot, database
+
+
+class SnapshotsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.filename = self.mktemp()
+        connection = sqlite3.connect(self.filename)
+        for sql in SQL_SCRIPT:
+            connection.execute(sql)
+        connection.execute("INSERT INTO user VALUES ('Shara', ?, 'utf-8', "
+                "'shara')", (user.DEFAULT_NETWORK,))
+        connection.execute("INSERT INTO alias VALUES ('Shara', ?, 'init', "
+                "'1d20+4')", (user.DEFAULT_NETWORK,))
+        connection.commit()
+        connection.close()
+        self.clock = task.Clock()
+        self.db = database.Database(
+                lambda: user.memoryDatabase('sqlite:' + self.filename),
+                threaded=False)
+        self.snapshots = snapshot.Snapshots(self.db, self.filename, 60,
+                self.clock)
+        self.snapshots.startService()
+
+    def tearDown(self):
+        if self.snapshots.running:
+            return self.snapshots.stopService()
+
+    def saved(self):
+        store = user.userDatabase('sqlite:' + self.filename)
+        tables = user.tableRows(store)
+        store.close()
+        return tables
+
+    def test_load(self):
+        """
+        The memory database starts with what was in the file
+        """
+        store = self.db.store
+        shara = user.userMapFor(store).find(u'shara')
+        self.assertEqual(shara.getAlias((u'init',)), u'1d20+4')
+        self.assertEqual(store.execute("PRAGMA database_list").get_one()[2],
+                u'')
+
+    def test_snapshot(self):
+        """
+        Changes are written to the file only when there are some, and when
+        the service stops
+        """
+        store = self.db.store
+        shara = user.userMapFor(store).find(u'shara')
+        d = self.snapshots.snapshot()
+        def unchanged(_):
+            self.assertEqual(self.snapshots.snapshots, 0)
+            shara.setAlias((u'hit',), u'1d8')
+            store.commit()
+            return self.snapshots.snapshot()
+        def changed(_):
+            self.assertEqual(self.snapshots.snapshots, 1)
+            self.assertTrue((u'Shara', user.DEFAULT_NETWORK, u'hit', u'1d8')
+                    in self.saved()[1])
+            shara.removeAlias(u'hit')
+            store.commit()
+            return self.snapshots.stopService()
+        def stopped(_):
+            self.assertEqual(self.snapshots.snapshots, 2)
+            self.assertEqual(self.saved(), user.tableRows(store))
+        return d.addCallback(unchanged).addCallback(changed
+                ).addCallback(stopped)
+
+    def test_threaded(self):
+        """
+        With a database thread, the rows are copied there, not in the
+        reactor
+        """
+        self.snapshots.stopService()
+        db = database.Database(
+                lambda: user.memoryDatabase('sqlite:' + self.filename))
+        db.startService()
+        self.addCleanup(db.stopService)
+        self.snapshots = snapshot.Snapshots(db, self.filename, 60, self.clock)
+        self.snapshots.startService()
+        # before the database stops
+        self.addCleanup(self.snapshots.stopService)
+        copiedIn = []
+        tableRows = user.tableRows
+        def recordingTableRows(store):
+            copiedIn.append(threading.currentThread())
+            return tableRows(store)
+        self.patch(user, 'tableRows', recordingTableRows)
+
+        def change(store):
+            shara = user.userMapFor(store).find(u'shara')
+            shara.setAlias((u'hit',), u'1d8')
+        d = db.run(change, db.store)
+        d.addCallback(lambda _: self.snapshots.snapshot())
+        def written(_):
+            self.assertEqual(self.snapshots.snapshots, 1)
+            self.assertEqual(len(copiedIn), 1)
+            self.assertNotIdentical(copiedIn[0], threading.currentThread())
+            self.assertTrue((u'Shara', user.DEFAULT_NETWORK, u'hit', u'1d8')
+                    in self.saved()[1])
+        return d.addCallback(written)
+
+    def test_stopWhileWriting(self):
+        """
+        Stopping while a snapshot is being written copies the rows before
+        the database stops, and writes them after that snapshot
+        """
+        self.snapshots.stopService()
+        db = database.Database(
+                lambda: user.memoryDatabase('sqlite:' + self.filename))
+        db.startService()
+        self.addCleanup(db.stopService)
+        self.snapshots = snapshot.Snapshots(db, self.filename, 60, self.clock)
+        self.snapshots.startService()
+        writing = []
+        def slowWrite(write, filename, tables):
+            writing.append(defer.Deferred())
+            return writing[-1].addCallback(lambda _:
+                write(filename, tables))
+        self.patch(threads, 'deferToThread', slowWrite)
+
+        def change(store, expression):
+            shara = user.userMapFor(store).find(u'shara')
+            shara.setAlias((u'hit',), expression)
+        d = db.run(change, db.store, u'1d8')
+        d.addCallback(lambda _: self.snapshots._tick())
+        d.addCallback(lambda _: db.run(change, db.store, u'2d8'))
+        def stop(_):
+            self.assertEqual(len(writing), 1)
+            stopped = self.snapshots.stopService()
+            dbStopped = db.stopService()
+            writing[0].callback(None)
+            def next(_):
+                # the database stopped, but the rows were copied first
+                self.assertIdentical(db.pool, None)
+                self.assertEqual(len(writing), 2)
+                writing[1].callback(None)
+                return stopped
+            return dbStopped.addCallback(next)
+        def written(_):
+            self.assertEqual(self.snapshots.snapshots, 2)
+            self.assertTrue((u'Shara', user.DEFAULT_NETWORK, u'hit', u'2d8')
+                    in self.saved()[1])
+        return d.addCallback(stop).addCallback(written)
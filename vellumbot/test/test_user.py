@@ -1,7 +1,10 @@
 """
 Test user
 """
+import sqlite3
+
 from vellumbot import user
+from vellumbot.usersql import SQL_SCRIPT
 
 from twisted.trial import unittest
 
@@ -15,3 +18,132 @@ class UserTestCase(unittest.TestCase):
         self.assertEqual(user.parseURI('sqlite:foo.db'), ('foo.db', 'sqlite:foo.db', ))
         self.assertEqual(user.parseURI('sqlite://foo.db'), ('/foo.db', 'sqlite://foo.db', ))
 
+
+
+class AliasCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store = user.userDatabase('sqlite:')
+        self.u = user.User()
+        self.u.name = u'Shara'
+        self.store.add(self.u)
+        self.store.commit()
+
+    def test_writeThrough(self):
+        """
+        Aliases are read from the cache once loaded, and setAlias and
+        removeAlias keep the cache current
+        """
+        u = self.u
+        cache = user.aliasCacheFor(self.store)
+        self.assertTrue(cache is user.aliasCacheFor(self.store))
+
+        u.setAlias((u'smack', u'down'), u'1d20+2')
+        self.assertEqual(u.getAlias((u'smack', u'down')), u'1d20+2')
+        self.assertTrue((u'Shara', u.network) in cache)
+
+        # the database is no longer consulted
+        self.store.execute("DELETE FROM alias")
+        self.assertEqual(u.getAliases(), {u'smack down': u'1d20+2'})
+
+        u.setAlias((u'init',), u'1d20+4')
+        self.assertEqual(u.getAlias((u'init',)), u'1d20+4')
+        self.assertEqual(u.removeAlias(u'init'), 1)
+        self.assertEqual(u.getAlias((u'init',)), None)
+
+    def test_warmAndEvict(self):
+        """
+        Users can be loaded in bulk, and are forgotten when idle
+        """
+        now = [1000.0]
+        cache = user.AliasCache(self.store, maxIdle=100, clock=lambda: now[0])
+        self.u.setAlias((u'init',), u'1d20+4')
+        other = user.User()
+        other.name = u'GeeEm'
+        self.store.add(other)
+
+        cache.warm([self.u, other])
+        self.assertEqual(cache.get((u'Shara', self.u.network)),
+                {u'init': u'1d20+4'})
+        self.assertEqual(cache.get((u'GeeEm', other.network)), {})
+
+        now[0] = 1050.0
+        cache.get((u'Shara', self.u.network))
+        now[0] = 1120.0
+        cache.evictIdle()
+        self.assertTrue((u'Shara', self.u.network) in cache)
+        self.assertFalse((u'GeeEm', other.network) in cache)
+
+
+class UserMapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store = user.userDatabase('sqlite:')
+        self.u = user.User()
+        self.u.name = u'Shara'
+        self.store.add(self.u)
+        self.store.commit()
+
+    def test_find(self):
+        """
+        Users are found by name in any case, and then without a query
+        """
+        self.assertEqual(self.u.foldedName, u'shara')
+        users = user.userMapFor(self.store)
+        self.assertTrue(users is user.userMapFor(self.store))
+        self.assertTrue(users.find(u'SHARA') is self.u)
+        self.assertEqual(users.find(u'Sh_ra'), None)
+
+        self.store.execute("UPDATE user SET foldedName = 'x'")
+        self.assertTrue(users.find(u'shara') is self.u)
+        users.discard(self.u)
+        self.assertEqual(users.find(u'shara'), None)
+
+    def test_migrate(self):
+        """
+        A database from before foldedName gets the column, filled in
+        """
+        self.store.execute("DROP INDEX user_foldedName")
+        self.store.execute("CREATE TABLE olduser AS SELECT name, network, "
+                "encoding FROM user")
+        self.store.execute("DROP TABLE user")
+        self.store.execute("ALTER TABLE olduser RENAME TO user")
+        self.store.execute("INSERT INTO user VALUES (?, 'x', 'utf-8')",
+                (u'\xc9owyn',))
+        self.store.commit()
+
+        user.migrate(self.store)
+        rows = sorted(self.store.execute("SELECT name, foldedName FROM user"))
+        self.assertEqual(rows, [(u'Shara', u'shara'),
+            (u'\xc9owyn', u'\xe9owyn')])
+        indexes = [r[1] for r in self.store.execute("PRAGMA index_list(user)")]
+        self.assertTrue('user_foldedName' in indexes)
+
+
+class TuningTestCase(unittest.TestCase):
+    def setUp(self):
+        self.filename = self.mktemp()
+        connection = sqlite3.connect(self.filename)
+        for sql in SQL_SCRIPT:
+            connection.execute(sql)
+        connection.commit()
+        connection.close()
+
+    def test_profile(self):
+        """
+        The settings of a profile are applied, and reported
+        """
+        store = user.userDatabase('sqlite:' + self.filename,
+                user.SQLITE_PROFILES['fast'])
+        settings = user.sqliteSettings(store)
+        self.assertTrue('journal_mode=wal' in settings, settings)
+        self.assertTrue('synchronous=1' in settings, settings)
+        self.assertTrue('cache_size=-32000' in settings, settings)
+        self.assertTrue('busy_timeout=5000' in settings, settings)
+        self.assertTrue('temp_store=2' in settings, settings)
+        store.close()
+
+    def test_badSetting(self):
+        """
+        Settings that aren't a plain word or number are refused
+        """
+        self.assertRaises(ValueError, user.userDatabase,
+                'sqlite:' + self.filename, {'cacheSize': '1; DROP TABLE user'})
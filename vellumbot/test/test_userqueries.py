@@ -0,0 +1,51 @@
+"""
+Test the plain SQL user queries
+"""
+from twisted.trial import unittest
+
+from vellumbot import user, userqueries
+
+
+class UserQueriesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store = user.userDatabase('sqlite:')
+        self.u = user.User()
+        self.u.name = u'Shara'
+        self.store.add(self.u)
+        self.network = self.u.network
+
+    def test_findUser(self):
+        """
+        Users are found in any case, including ones not yet flushed
+        """
+        self.assertEqual(userqueries.findUser(self.store, u'sHARA',
+            self.network), (u'Shara', self.network, u'utf-8'))
+        self.assertEqual(userqueries.findUser(self.store, u'Shara', u'x'),
+                None)
+
+    def test_upsertAndDelete(self):
+        """
+        Setting an alias twice leaves one alias, and deleting says how many
+        were removed
+        """
+        args = (self.store, u'Shara', self.network)
+        userqueries.upsertAlias(*args + (u'init', u'1d20'))
+        userqueries.upsertAlias(*args + (u'init', u'1d20+4'))
+        userqueries.upsertAlias(*args + (u'hit', u'1d8'))
+        self.assertEqual(sorted(userqueries.aliases(*args)),
+                [(u'hit', u'1d8'), (u'init', u'1d20+4')])
+        self.assertEqual(sorted(userqueries.aliasesOfMany(self.store,
+            [u'Shara', u'GeeEm'], self.network)),
+            [(u'Shara', u'hit', u'1d8'), (u'Shara', u'init', u'1d20+4')])
+
+        self.assertEqual(userqueries.deleteAlias(*args + (u'init',)), 1)
+        self.assertEqual(userqueries.deleteAlias(*args + (u'init',)), 0)
+        self.assertEqual(userqueries.aliases(*args), [(u'hit', u'1d8')])
+
+    def test_upsertOldSqlite(self):
+        """
+        With an sqlite too old for ON CONFLICT, aliases are updated or
+        inserted all the same
+        """
+        self.patch(userqueries, 'HAS_UPSERT', False)
+        self.test_upsertAndDelete()
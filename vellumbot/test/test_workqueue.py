@@ -0,0 +1,122 @@
+"""
+Test the queues of lines waiting to be answered
+"""
+from twisted.trial import unittest
+from twisted.internet import task, defer
+
+from vellumbot.server import workqueue
+
+
+class WorkQueuesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.done = []
+        self.work = workqueue.WorkQueues(3, 2, workqueue.DROP_NEWEST,
+                self.clock)
+
+    def add(self, key, item):
+        return self.work.add(key, self.done.append, (key, item))
+
+    def tick(self):
+        """
+        Run the calls due now, as one turn of the reactor would, but not the
+        calls they make (which task.Clock.advance would also run)
+        """
+        due = [c for c in self.clock.getDelayedCalls()
+                if c.getTime() <= self.clock.seconds()]
+        for call in due:
+            self.clock.calls.remove(call)
+            call.called = 1
+            call.func(*call.args, **call.kw)
+
+    def test_turns(self):
+        """
+        Keys take turns, budget pieces of work each tick, and each key's
+        work is done in order
+        """
+        for n in range(3):
+            self.add('#busy', n)
+        self.add('#quiet', 0)
+        self.add('bob', 0)
+        self.assertEqual(self.done, [])
+        self.tick()
+        self.assertEqual(self.done, [('#busy', 0), ('#quiet', 0)])
+        self.tick()
+        self.assertEqual(self.done[2:], [('bob', 0), ('#busy', 1)])
+        self.tick()
+        self.assertEqual(self.done[4:], [('#busy', 2)])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual((self.work.done, len(self.work),
+            self.work.mostQueued), (5, 0, 3))
+
+        # and it starts again
+        self.add('#quiet', 1)
+        self.tick()
+        self.assertEqual(self.done[5:], [('#quiet', 1)])
+
+    def test_waits(self):
+        """
+        Work that returns a Deferred holds up the rest until it fires, and
+        the result is passed on
+        """
+        slow = defer.Deferred()
+        results = []
+        self.work.add('#a', lambda: slow).addCallback(results.append)
+        self.add('#b', 0)
+        self.tick()
+        self.tick()
+        self.assertEqual(self.done, [])
+        slow.callback('answered')
+        self.assertEqual(results, ['answered'])
+        self.tick()
+        self.assertEqual(self.done, [('#b', 0)])
+
+    def test_dropNewest(self):
+        """
+        Work added to a full queue is dropped
+        """
+        for n in range(4):
+            d = self.add('#busy', n)
+        self.failureResultOf(d, workqueue.Dropped)
+        self.work.flush()
+        self.assertEqual(self.done, [('#busy', 0), ('#busy', 1), ('#busy', 2)])
+        self.assertEqual(self.work.dropped, 1)
+
+    def test_dropOldest(self):
+        """
+        With DROP_OLDEST, the oldest work waiting is dropped instead
+        """
+        self.work.overflow = workqueue.DROP_OLDEST
+        first = self.add('#busy', 0)
+        for n in range(1, 4):
+            self.add('#busy', n)
+        self.failureResultOf(first, workqueue.Dropped)
+        self.work.flush()
+        self.assertEqual(self.done, [('#busy', 1), ('#busy', 2), ('#busy', 3)])
+
+    def test_flushKeys(self):
+        """
+        The work for some keys can be done at once, leaving the rest to
+        wait for their turns
+        """
+        self.add('#a', 0)
+        self.add('#b', 0)
+        self.add('#a', 1)
+        self.work.flush(['#a', '#c'])
+        self.assertEqual(self.done, [('#a', 0), ('#a', 1)])
+        self.tick()
+        self.assertEqual(self.done[2:], [('#b', 0)])
+        self.tick()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_stop(self):
+        """
+        stop forgets the work waiting, and says so to whoever is waiting
+        for it
+        """
+        d = self.add('#a', 0)
+        self.work.stop()
+        self.failureResultOf(d, defer.CancelledError)
+        self.tick()
+        self.assertEqual(self.done, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
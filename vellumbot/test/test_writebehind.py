@@ -0,0 +1,92 @@
+"""
+Test group commit
+"""
+from twisted.trial import unittest
+from twisted.internet import task
+
+from vellumbot import user
+from vellumbot.server import writebehind, database
+
+
+class GroupCommitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store = user.userDatabase('sqlite:')
+        self.clock = task.Clock()
+        self.commits = []
+        commit = self.store.commit
+        def countingCommit():
+            self.commits.append(1)
+            commit()
+        self.store.commit = countingCommit
+        db = database.Database(lambda: self.store, threaded=False)
+        self.gc = writebehind.GroupCommit(db, 0.2, 3, self.clock)
+        self.gc.startService()
+
+    def tearDown(self):
+        if self.gc.running:
+            self.gc.stopService()
+
+    def addUser(self, name):
+        u = user.User()
+        u.name = name
+        self.store.add(u)
+
+    def test_window(self):
+        """
+        Units finishing within the window share one commit
+        """
+        user.unitOfWork(self.store, self.addUser, u'one')
+        user.unitOfWork(self.store, self.addUser, u'two')
+        self.assertEqual(self.commits, [])
+        self.clock.advance(0.2)
+        self.assertEqual(len(self.commits), 1)
+        self.assertEqual((self.gc.units, self.gc.pending), (2, 0))
+
+    def test_maxPending(self):
+        """
+        Enough waiting units are committed without waiting for the window
+        """
+        for name in u'one', u'two', u'three':
+            user.unitOfWork(self.store, self.addUser, name)
+        self.assertEqual(len(self.commits), 1)
+        self.clock.advance(0.2)
+        self.assertEqual(len(self.commits), 1)
+
+    def test_stop(self):
+        """
+        Stopping commits what is waiting, and units commit alone again
+        """
+        user.unitOfWork(self.store, self.addUser, u'one')
+        self.gc.stopService()
+        self.assertEqual(len(self.commits), 1)
+        user.unitOfWork(self.store, self.addUser, u'two')
+        self.assertEqual(len(self.commits), 2)
+
+    def test_rollback(self):
+        """
+        A failed unit rolls back only itself, not the units waiting with it
+        """
+        def fail():
+            self.addUser(u'two')
+            raise ValueError()
+        user.unitOfWork(self.store, self.addUser, u'one')
+        self.assertRaises(ValueError, user.unitOfWork, self.store, fail)
+        self.assertEqual((self.gc.pending, self.gc.lost), (1, 0))
+        self.clock.advance(1)
+        self.assertEqual(len(self.commits), 1)
+        self.assertEqual(list(self.store.find(user.User).values(
+            user.User.name)), [u'one'])
+
+    def test_rollbackUnflushed(self):
+        """
+        A unit whose changes can't even be flushed rolls back everything
+        """
+        def fail():
+            self.addUser(u'one')
+            raise ValueError()
+        user.unitOfWork(self.store, self.addUser, u'one')
+        self.assertRaises(ValueError, user.unitOfWork, self.store, fail)
+        self.assertEqual(self.gc.lost, 1)
+        self.clock.advance(1)
+        self.assertEqual(self.commits, [])
+        self.assertEqual(self.store.find(user.User).count(), 0)
@@ -74,6 +74,8 @@ class BotTestCase(unittest.TestCase, DiffTestCaseMixin):
         vt.factory = FakeFactory()
         vt.factory.store = user.userDatabase('sqlite:')
         vt.factory.serverEncoding = 'utf-8'
+        # tests ask a lot of the bot at once
+        vt.factory.userLimit = vt.factory.channelLimit = (10000, 10000.0)
 
         vt.performLogin = 0
         vt.defaultSession = vt.factory.store.find(d20session.D20Session,
@@ -101,5 +103,8 @@ class BotTestCase(unittest.TestCase, DiffTestCaseMixin):
         """
         r = ResponseTest(self.transport, who, channel, target, *recipients)
         self.vt.privmsg(r.user, r.channel, r.sent)
+        # don't wait for the next reactor turn, or for the rate limit
+        self.vt.work.flush()
+        self.vt.outbound.flush()
         r.check(self)
 
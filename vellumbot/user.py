@@ -1,11 +1,24 @@
 """
 Users and user acquisition
 """
+import itertools
+import os
+import re
+import sys
+import time
+import weakref
+
 from storm import locals
 from zope.interface import implements
 
 from .server.fs import fs
 from .server.interface import IMessageRecipient
+from .util import lru
+from . import userqueries
+from .userqueries import MAX_VARIABLES
+
+
+DEFAULT_NETWORK = u'TODO FIXME'   # TODO - see vellumbot.server.irc.VellumTalk.signedOn
 
 
 class User(object):
@@ -13,10 +26,15 @@ class User(object):
     __storm_table__ = 'user'
     __storm_primary__ = ('name', 'network')
     name = locals.Unicode()       # nick of the user
-    network = locals.Unicode(default=u'TODO FIXME')    # TODO - see vellumbot.server.irc.VellumTalk.signedOn
+    network = locals.Unicode(default=DEFAULT_NETWORK)
     encoding = locals.Unicode(default=u'utf-8')   # the preferred encoding of the user
+    foldedName = locals.Unicode() # name.lower(), for case-insensitive lookups
     implements(IMessageRecipient)
 
+    def __storm_pre_flush__(self):
+        if self.name is not None:
+            self.foldedName = self.name.lower()
+
     def __eq__(self, other):
         return (self.name, self.network) == (other.name, other.network)
 
@@ -26,15 +44,44 @@ class User(object):
     def __repr__(self):
         return '<%s named %s@%s>' % (self.__class__.__name__, self.name, self.network)
 
+    def _cachedAliases(self):
+        """
+        The cached dict of my aliases, loading it if necessary, or None if I
+        can't be cached
+        """
+        store = locals.Store.of(self)
+        if store is None or self.name is None:
+            return None
+        cache = aliasCacheFor(store)
+        key = (self.name, self.network)
+        aliases = cache.get(key)
+        if aliases is None:
+            aliases = dict(userqueries.aliases(store, self.name, self.network))
+            cache.put(key, aliases)
+        return aliases
+
     def getAliases(self, default={}):
         """
         All the user's aliases as a dict
         """
+        aliases = self._cachedAliases()
+        if aliases is not None:
+            return aliases.copy()
         ret = {}
         for a in self.aliases:
             ret[a.words] = a.expression
         return ret
 
+    def getAlias(self, words):
+        """
+        The expression for one alias, or None
+        """
+        assert type(words) is tuple
+        aliases = self._cachedAliases()
+        if aliases is None:
+            aliases = self.getAliases()
+        return aliases.get(u' '.join(words), None)
+
     def setAlias(self, words, expression):
         """
         Create a new alias for the user or redefine an existing
@@ -42,31 +89,25 @@ class User(object):
         assert type(words) is tuple
         words = u' '.join(words)
         store = locals.Store.of(self)
-        al = store.find(Alias, Alias.user==self, Alias.words==words).one()
-        if al is None:
-            al = Alias()
-            al.user = self
-            al.words = words
-            al.expression = expression
-            store.add(al)
-        else:
-            al.expression = expression
-        store.commit()
+        userqueries.upsertAlias(store, self.name, self.network, words,
+                expression)
+        aliases = aliasCacheFor(store).get((self.name, self.network))
+        if aliases is not None:
+            aliases[words] = expression
 
     def removeAlias(self, words):
         """
-        Remove an alias from my list and from the database
+        Remove an alias from my list and from the database, returning the
+        number removed (0 or 1)
         """
-        l = self.aliases.count()
         store = locals.Store.of(self)
-        al = store.find(Alias, Alias.user==self, Alias.words==words).one()
-        if al is not None:
-            self.aliases.remove(al)
-            store.remove(al)
-            store.commit()
-        assert store.find(Alias, 
-                Alias.user==self, Alias.words==words).one() is None
-        return al
+        removed = userqueries.deleteAlias(store, self.name, self.network,
+                words)
+        if removed:
+            aliases = aliasCacheFor(store).get((self.name, self.network))
+            if aliases is not None:
+                aliases.pop(words, None)
+        return removed
 
 
 class Alias(object):
@@ -89,6 +130,300 @@ User.aliases = locals.ReferenceSet((User.name, User.network),
         (Alias.userName, Alias.userNetwork))
 
 
+class AliasCache(object):
+    """
+    The aliases of recently active users, as dicts kept in memory so that
+    resolving an alias needs no query.  Keyed on (name, network).
+
+    User.setAlias and User.removeAlias write through to the cache.  Users
+    whose aliases go unused for maxIdle seconds are forgotten; the check is
+    made at most every sweepInterval seconds, when the cache is used.
+    """
+    sweepInterval = 60
+
+    def __init__(self, store, maxIdle=1800, clock=time.time):
+        self.store = store
+        self.maxIdle = maxIdle
+        self.clock = clock
+        self._aliases = {}
+        self._lastUsed = {}
+        self._lastSweep = clock()
+
+    def get(self, key):
+        """
+        The dict of aliases for key, or None if it is not cached
+        """
+        now = self.clock()
+        if now - self._lastSweep > self.sweepInterval:
+            self.evictIdle(now)
+        aliases = self._aliases.get(key, None)
+        if aliases is not None:
+            self._lastUsed[key] = now
+        return aliases
+
+    def put(self, key, aliases):
+        self._aliases[key] = aliases
+        self._lastUsed[key] = self.clock()
+
+    def discard(self, key):
+        """
+        Forget key, if it was cached
+        """
+        self._aliases.pop(key, None)
+        self._lastUsed.pop(key, None)
+
+    def clear(self):
+        self._aliases.clear()
+        self._lastUsed.clear()
+
+    def __contains__(self, key):
+        return key in self._aliases
+
+    def __len__(self):
+        return len(self._aliases)
+
+    def evictIdle(self, now=None):
+        """
+        Forget the aliases of users who have not used them lately
+        """
+        if now is None:
+            now = self.clock()
+        self._lastSweep = now
+        oldest = now - self.maxIdle
+        for key, used in self._lastUsed.items():
+            if used < oldest:
+                self.discard(key)
+
+    def warm(self, users):
+        """
+        Load the aliases of all the users not already cached, in one query
+        per network
+        """
+        byNetwork = {}
+        for u in users:
+            key = (u.name, u.network)
+            if u.name is not None and key not in self._aliases:
+                byNetwork.setdefault(u.network, []).append(u.name)
+        for network, names in byNetwork.items():
+            loaded = dict(((n, network), {}) for n in names)
+            found = userqueries.aliasesOfMany(self.store, names, network)
+            for name, words, expression in found:
+                loaded[(name, network)][words] = expression
+            for key, aliases in loaded.items():
+                self.put(key, aliases)
+
+
+_aliasCaches = weakref.WeakKeyDictionary()
+
+def aliasCacheFor(store):
+    """
+    The AliasCache for the users in store
+    """
+    cache = _aliasCaches.get(store, None)
+    if cache is None:
+        cache = _aliasCaches[store] = AliasCache(store)
+    return cache
+
+
+class UserMap(object):
+    """
+    The User objects of a store, found by case-insensitive name without a
+    query once they've been seen.  Keyed on (folded name, network); holds
+    at most maxsize users.
+
+    Nothing is remembered about names that aren't found.  Call discard
+    when a user is removed or renamed.
+    """
+    def __init__(self, store, maxsize=4096):
+        self.store = store
+        self.users = lru.LRUCache(maxsize)
+
+    def find(self, name, network=DEFAULT_NETWORK):
+        """
+        The user whose name is name in any case, or None
+        """
+        key = (name.lower(), network)
+        user = self.users.get(key, None)
+        if user is None:
+            # most names looked up aren't users, and the plain query says so
+            # much faster than a Storm find
+            found = userqueries.findUser(self.store, name, network)
+            if found is not None:
+                user = self.store.get(User, found[:2])
+                self.users[key] = user
+        return user
+
+    def findMany(self, names, network=DEFAULT_NETWORK):
+        """
+        A dict of folded name => user for each of names that exists, found
+        with one query for those not already mapped
+        """
+        ret = {}
+        wanted = []
+        for name in names:
+            folded = name.lower()
+            user = self.users.get((folded, network), None)
+            if user is not None:
+                ret[folded] = user
+            elif folded not in ret:
+                wanted.append(folded)
+        wanted = list(set(wanted))
+        for n in range(0, len(wanted), MAX_VARIABLES):
+            found = self.store.find(User, User.network == network,
+                    User.foldedName.is_in(wanted[n:n + MAX_VARIABLES]))
+            for user in found:
+                ret[user.foldedName] = user
+                self.users[(user.foldedName, network)] = user
+        return ret
+
+    def discard(self, user):
+        self.users.pop((user.name.lower(), user.network), None)
+
+    def clear(self):
+        self.users.clear()
+
+
+_userMaps = weakref.WeakKeyDictionary()
+
+def userMapFor(store):
+    """
+    The UserMap for the users in store
+    """
+    found = _userMaps.get(store, None)
+    if found is None:
+        found = _userMaps[store] = UserMap(store)
+    return found
+
+
+_unitDepths = weakref.WeakKeyDictionary()
+_committers = weakref.WeakKeyDictionary()
+_savepoints = itertools.count()
+
+def setCommitter(store, committer):
+    """
+    Have committer decide when the units of work on store are committed,
+    instead of committing each one as it finishes.  committer must have
+    unitDone(), called after each unit, and rolledBack(), called when the
+    uncommitted work is thrown away.  Use None to go back to committing
+    every unit.
+    """
+    if committer is None:
+        _committers.pop(store, None)
+    else:
+        _committers[store] = committer
+
+def unitOfWork(store, f, *a, **kw):
+    """
+    Call f(*a, **kw) as one transaction on store: commit once when it
+    returns, or roll back (see rollback) if it raises.  A unit of work
+    begun inside another is part of the outer one.
+
+    If store has a committer (see setCommitter), it is told the unit is
+    done instead, and several units may share one commit.  A unit that
+    fails then undoes only itself (see undoable), not the units waiting
+    with it.
+    """
+    depth = _unitDepths.get(store, 0)
+    _unitDepths[store] = depth + 1
+    try:
+        try:
+            if depth == 0 and store in _committers:
+                ret = undoable(store, f, *a, **kw)
+            else:
+                ret = f(*a, **kw)
+        except:
+            if depth == 0 and store not in _committers:
+                rollback(store)
+            raise
+        if depth == 0:
+            committer = _committers.get(store, None)
+            if committer is None:
+                store.commit()
+            else:
+                committer.unitDone()
+        return ret
+    finally:
+        _unitDepths[store] = depth
+
+
+def rollback(store):
+    """
+    Roll back store, and forget whatever the caches learned since the last
+    commit
+    """
+    store.rollback()
+    aliasCacheFor(store).clear()
+    userMapFor(store).clear()
+    committer = _committers.get(store, None)
+    if committer is not None:
+        committer.rolledBack()
+
+
+def undoable(store, f, *a, **kw):
+    """
+    Call f(*a, **kw) inside a savepoint on store.  If it raises, what it did
+    is undone and the caches forget what they learned since, but the rest
+    of the transaction is kept.
+    """
+    name = 'undoable%s' % (next(_savepoints),)
+    store.execute('SAVEPOINT %s' % (name,), noresult=True)
+    try:
+        ret = f(*a, **kw)
+    except:
+        failure = sys.exc_info()
+        try:
+            # changes not yet flushed are undone with the rest
+            store.flush()
+        except Exception:
+            # but if they can't be flushed, they can't be kept apart from
+            # the rest of the transaction either
+            rollback(store)
+        else:
+            store.execute('ROLLBACK TO SAVEPOINT %s' % (name,),
+                    noresult=True)
+            store.execute('RELEASE SAVEPOINT %s' % (name,), noresult=True)
+            store.invalidate()
+            aliasCacheFor(store).clear()
+            userMapFor(store).clear()
+        raise failure[0], failure[1], failure[2]
+    store.execute('RELEASE SAVEPOINT %s' % (name,), noresult=True)
+    return ret
+
+
+def insertUsers(store, names, network=DEFAULT_NETWORK):
+    """
+    Add new users named names, several to each INSERT.  They aren't loaded
+    into the store; find them to get User objects.
+    """
+    perInsert = MAX_VARIABLES // 4
+    for n in range(0, len(names), perInsert):
+        chunk = names[n:n + perInsert]
+        params = []
+        for name in chunk:
+            params.extend([name, network, u'utf-8', name.lower()])
+        store.execute('INSERT INTO user (name, network, encoding, foldedName) '
+                'VALUES ' + ', '.join(['(?, ?, ?, ?)'] * len(chunk)), params)
+
+
+def migrate(store):
+    """
+    Bring a user database made by an older vellumbot up to date
+    """
+    columns = [row[1] for row in store.execute('PRAGMA table_info(user)')]
+    if 'foldedName' not in columns:
+        store.execute('ALTER TABLE user ADD COLUMN foldedName varchar(100)')
+    # sqlite's lower() only folds ASCII, so fold the names here
+    rows = list(store.execute(
+        'SELECT name, network FROM user WHERE foldedName IS NULL'))
+    for name, network in rows:
+        store.execute('UPDATE user SET foldedName = ? '
+                'WHERE name = ? AND network = ?',
+                (name.lower(), name, network))
+    store.execute('CREATE INDEX IF NOT EXISTS user_foldedName '
+            'ON user (foldedName, network)')
+    store.commit()
+
+
 DB_FILE_NAME = 'sqlite:' + fs.userdb
 
 def parseURI(uri):
@@ -108,11 +443,64 @@ def parseURI(uri):
         fn = uri[7:]
     return (fn, uri)
 
-def userDatabase(uri=DB_FILE_NAME):
+# sqlite settings for the user database.  journalMode, synchronous and
+# busyTimeout (ms) are given to storm when it connects; the rest are set by
+# PRAGMA once the store is made.
+SQLITE_PROFILES = {
+    # whatever sqlite does by default
+    'default': {},
+    # never lose a commit, but let readers and the writer overlap
+    'safe': {'journalMode': 'WAL', 'synchronous': 'FULL',
+        'busyTimeout': 5000, 'cacheSize': -8000, 'tempStore': 'MEMORY'},
+    # a power cut may lose the last commits, but the file stays sound
+    'fast': {'journalMode': 'WAL', 'synchronous': 'NORMAL',
+        'busyTimeout': 5000, 'cacheSize': -32000, 'mmapSize': 268435456,
+        'tempStore': 'MEMORY'},
+    }
+
+_connectPragmas = [('journalMode', 'journal_mode'),
+                   ('synchronous', 'synchronous'),
+                   ]
+_storePragmas = [('cacheSize', 'cache_size'),
+                 ('mmapSize', 'mmap_size'),
+                 ('tempStore', 'temp_store'),
+                 ]
+
+def sqliteSettings(store):
     """
-    Give a user database
+    A one-line report of the sqlite settings store is really using
+    """
+    ret = []
+    for pragma in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size',
+            'busy_timeout', 'temp_store'):
+        try:
+            value = store.execute('PRAGMA %s' % (pragma,)).get_one()
+        except Exception:
+            value = None
+        if value is not None:
+            value = value[0]
+        ret.append('%s=%s' % (pragma, value))
+    store.commit()
+    return ' '.join(ret)
+
+def userDatabase(uri=DB_FILE_NAME, tuning=None):
+    """
+    Give a user database.  tuning is a dict of sqlite settings like those
+    in SQLITE_PROFILES.
     """
     filename, uri = parseURI(uri)
+    tuning = tuning or {}
+    for key, value in tuning.items():
+        if value is not None and not re.match(r'^-?\w+$', str(value)):
+            raise ValueError("Bad sqlite setting %s=%r" % (key, value))
+    options = []
+    for key, pragma in _connectPragmas:
+        if tuning.get(key) is not None:
+            options.append('%s=%s' % (pragma, tuning[key]))
+    if tuning.get('busyTimeout') is not None:
+        options.append('timeout=%s' % (tuning['busyTimeout'] / 1000.0,))
+    if options:
+        uri = '%s?%s' % (uri, '&'.join(options))
     db = locals.create_database(uri)
     if filename is not None:
         # test existence of the database file so as to throw an exception when
@@ -121,11 +509,59 @@ def userDatabase(uri=DB_FILE_NAME):
         # to or not.
         open(filename).close()
         theStore = locals.Store(db)
+        migrate(theStore)
     else:
         theStore = locals.Store(db)
         from .usersql import SQL_SCRIPT
         for sql in SQL_SCRIPT:
             theStore.execute(sql)
+        theStore.commit()
     assert theStore is not None
+    pragmas = [(p, tuning[key]) for key, p in _storePragmas
+            if tuning.get(key) is not None]
+    if pragmas:
+        for pragma, value in pragmas:
+            theStore.execute('PRAGMA %s = %s' % (pragma, value))
+        theStore.commit()
     return theStore
 
+
+# everything kept in a user database, as (table, columns)
+TABLES = [('user', ('name', 'network', 'encoding', 'foldedName')),
+          ('alias', ('userName', 'userNetwork', 'words', 'expression')),
+          ('session', ('name', 'encoding')),
+          ]
+
+def tableRows(store):
+    """
+    A list of the rows of each of TABLES, as lists of tuples
+    """
+    return [store.execute('SELECT %s FROM %s' % (', '.join(columns),
+        table)).get_all() for table, columns in TABLES]
+
+def memoryDatabase(uri=DB_FILE_NAME):
+    """
+    Give a user database kept entirely in memory, loaded with everything in
+    the database at uri if there is one.  See
+    vellumbot.server.snapshot.Snapshots for saving it back there.
+    """
+    theStore = userDatabase('sqlite:')
+    filename, uri = parseURI(uri)
+    if filename is None or not os.path.exists(filename):
+        return theStore
+    source = userDatabase(uri)
+    tables = tableRows(source)
+    source.close()
+    theStore.execute('DELETE FROM session')
+    for (table, columns), rows in zip(TABLES, tables):
+        perInsert = MAX_VARIABLES // len(columns)
+        values = '(%s)' % (', '.join(['?'] * len(columns)),)
+        for n in range(0, len(rows), perInsert):
+            chunk = rows[n:n + perInsert]
+            params = []
+            for row in chunk:
+                params.extend(row)
+            theStore.execute('INSERT INTO %s (%s) VALUES %s' % (table,
+                ', '.join(columns), ', '.join([values] * len(chunk))), params)
+    theStore.commit()
+    return theStore
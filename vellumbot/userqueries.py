@@ -0,0 +1,95 @@
+"""
+Plain SQL for the user and alias queries made for almost every message.
+
+Storm compiles an expression and loads objects for every query it makes,
+which costs more than the query itself does on these small tables.  These
+statements are constant strings with ? parameters, so the sqlite driver
+prepares each one once and then reuses it from its statement cache.  They
+return plain tuples, and leave everything else about users to Storm.
+
+Store.execute flushes the store first, so objects added but not yet
+written are seen by these queries.
+"""
+from storm.databases import sqlite as stormSqlite
+
+# the most parameters old versions of sqlite allow in one statement
+MAX_VARIABLES = 900
+
+# INSERT ... ON CONFLICT DO UPDATE needs sqlite 3.24; before that, aliases
+# are updated and then inserted if there was nothing to update
+HAS_UPSERT = getattr(stormSqlite.sqlite, 'sqlite_version_info',
+        (0,)) >= (3, 24, 0)
+
+FIND_USER = ("SELECT name, network, encoding FROM user"
+             " WHERE foldedName = ? AND network = ?")
+
+ALIASES = ("SELECT words, expression FROM alias"
+           " WHERE userName = ? AND userNetwork = ?")
+
+ALIASES_OF_MANY = ("SELECT userName, words, expression FROM alias"
+                   " WHERE userNetwork = ? AND userName IN (%s)")
+
+UPSERT_ALIAS = ("INSERT INTO alias (userName, userNetwork, words, expression)"
+                " VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (userName, userNetwork, words)"
+                " DO UPDATE SET expression = excluded.expression")
+
+UPDATE_ALIAS = ("UPDATE alias SET expression = ?"
+                " WHERE userName = ? AND userNetwork = ? AND words = ?")
+
+INSERT_ALIAS = ("INSERT INTO alias (userName, userNetwork, words, expression)"
+                " VALUES (?, ?, ?, ?)")
+
+DELETE_ALIAS = ("DELETE FROM alias"
+                " WHERE userName = ? AND userNetwork = ? AND words = ?")
+
+
+def findUser(store, name, network):
+    """
+    (name, network, encoding) of the user whose name is name in any case,
+    or None
+    """
+    return store.execute(FIND_USER, (name.lower(), network)).get_one()
+
+
+def aliases(store, name, network):
+    """
+    A list of (words, expression) for each alias of a user
+    """
+    return store.execute(ALIASES, (name, network)).get_all()
+
+
+def aliasesOfMany(store, names, network):
+    """
+    A list of (name, words, expression) for each alias of the users with
+    names on network
+    """
+    ret = []
+    names = list(names)
+    for n in range(0, len(names), MAX_VARIABLES):
+        chunk = names[n:n + MAX_VARIABLES]
+        sql = ALIASES_OF_MANY % (', '.join(['?'] * len(chunk)),)
+        ret.extend(store.execute(sql, [network] + chunk).get_all())
+    return ret
+
+
+def upsertAlias(store, name, network, words, expression):
+    """
+    Give a user's alias for words a new expression, making the alias if
+    there wasn't one
+    """
+    if HAS_UPSERT:
+        store.execute(UPSERT_ALIAS, (name, network, words, expression),
+                noresult=True)
+    elif not store.execute(UPDATE_ALIAS,
+            (expression, name, network, words)).rowcount:
+        store.execute(INSERT_ALIAS, (name, network, words, expression),
+                noresult=True)
+
+
+def deleteAlias(store, name, network, words):
+    """
+    Remove a user's alias for words, returning the number of aliases removed
+    (0 or 1)
+    """
+    return store.execute(DELETE_ALIAS, (name, network, words)).rowcount
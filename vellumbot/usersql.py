@@ -11,10 +11,15 @@ CREATE TABLE user (
     name varchar(100),
     network varchar(100),
     encoding varchar(100),
+    foldedName varchar(100),
     PRIMARY KEY (name, network)
 );
 ''',
 
+'''
+CREATE INDEX user_foldedName ON user (foldedName, network);
+''',
+
 '''
 CREATE TABLE alias (
     userName varchar(100) references user(name),
@@ -0,0 +1,109 @@
+"""
+A bounded cache that forgets the least recently used items first
+"""
+
+PREV, NEXT, KEY, VALUE = range(4)
+
+
+class LRUCache(object):
+    """
+    A mapping holding at most maxsize items.  When it is full, adding an item
+    discards the item that was used least recently.
+
+    hits and misses count the lookups made with get().
+    """
+    def __init__(self, maxsize=512):
+        assert maxsize > 0, "maxsize must be positive, not %r" % (maxsize,)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._links = {}
+        # the root of a circular doubly-linked list, most recent at root[PREV]
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _append(self, link):
+        root = self._root
+        last = root[PREV]
+        link[PREV] = last
+        link[NEXT] = root
+        last[NEXT] = root[PREV] = link
+
+    def get(self, key, default=None):
+        """
+        The value for key, or default.  Marks key as most recently used.
+        """
+        link = self._links.get(key, None)
+        if link is None:
+            self.misses = self.misses + 1
+            return default
+        self.hits = self.hits + 1
+        self._unlink(link)
+        self._append(link)
+        return link[VALUE]
+
+    def __setitem__(self, key, value):
+        link = self._links.get(key, None)
+        if link is not None:
+            self._unlink(link)
+            link[VALUE] = value
+        else:
+            link = [None, None, key, value]
+            self._links[key] = link
+        self._append(link)
+        self._shrink()
+
+    def pop(self, key, default=None):
+        """
+        Remove key and return its value, or default if it wasn't there
+        """
+        link = self._links.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[VALUE]
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __len__(self):
+        return len(self._links)
+
+    def _shrink(self):
+        root = self._root
+        while len(self._links) > self.maxsize:
+            oldest = root[NEXT]
+            self._unlink(oldest)
+            del self._links[oldest[KEY]]
+
+    def resize(self, maxsize):
+        """
+        Change the number of items held, discarding the oldest if necessary
+        """
+        assert maxsize > 0, "maxsize must be positive, not %r" % (maxsize,)
+        self.maxsize = maxsize
+        self._shrink()
+
+    def clear(self):
+        """
+        Forget all items, but not the hit and miss counts
+        """
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+    def hitRate(self):
+        """
+        The fraction of lookups that found their key
+        """
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def __str__(self):
+        return '%s/%s items, %s hits, %s misses (%.1f%%)' % (len(self),
+                self.maxsize, self.hits, self.misses, self.hitRate() * 100)